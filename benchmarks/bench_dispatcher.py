@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+'''
+Benchmark of the dispatcher's result handler end to end: the cost of
+taking one task result message, from decoding it to its job changes
+being written to an SQLite database and the message acknowledged, as
+jobs grow. It should stay flat rather than grow with the number of
+tasks. The broker is stood in for by a channel which takes every
+message.
+
+Two job shapes are timed: a fan-out, one task with N dependents all in
+flight, and a chain of N tasks each depending on the one before.
+
+Run from the repository root: python benchmarks/bench_dispatcher.py
+'''
+import os
+import sys
+import json
+import time
+import shutil
+import logging
+import tempfile
+
+import pika
+from pika.spec import Basic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.dispatcher import Dispatcher
+
+SIZES = (500, 2000, 8000)
+# Results processed per timing
+RESULTS = 200
+
+CONFIG = '''
+[HUB]
+caretaker_interval=0
+result_cache_size=0
+
+[DATABASE]
+type=HubSqlite
+host={0}
+port=0
+instance=0
+'''
+
+
+class Channel(object):
+    '''Takes every message, keeping the tasks published.'''
+    def __init__(self):
+        self.tasks = []
+
+    def basic_publish(self, exchange, routing_key, properties, body):
+        if routing_key.startswith('task.'):
+            self.tasks.append(body)
+        return True
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        pass
+
+
+class Bench(object):
+
+    def __init__(self, tasks):
+        self.dir = tempfile.mkdtemp()
+        config_file = os.path.join(self.dir, 'dispatcher.conf')
+        with open(config_file, 'w') as f:
+            f.write(CONFIG.format(os.path.join(self.dir, 'hub.db')))
+        self.dispatcher = Dispatcher(config_file)
+        self.channel = self.dispatcher.channel = Channel()
+        self.results = self.dispatcher._locked(self.dispatcher.process_results)
+        self.tag = 0
+        properties = pika.BasicProperties(correlation_id='bench')
+        self.deliver(self.dispatcher._locked(self.dispatcher.process_jobs),
+                     properties, json.dumps({'id': 'j', 'name': 'bench',
+                                             'tasks': tasks}))
+
+    def close(self):
+        self.dispatcher.writer.barrier()
+        shutil.rmtree(self.dir)
+
+    def deliver(self, callback, properties, body):
+        self.tag += 1
+        callback(self.channel, Basic.Deliver(delivery_tag=self.tag),
+                 properties, body)
+
+    def complete(self, body):
+        '''Send the dispatcher a successful result for a published task.'''
+        task = json.loads(body)
+        task.update(status='SUCCESS', data=1)
+        properties = pika.BasicProperties(correlation_id='j')
+        self.deliver(self.results, properties, json.dumps(task))
+
+    def finish(self):
+        '''Wait for the results so far to be written and acknowledged.'''
+        self.dispatcher._ack()
+
+
+def bench_fan_out(n):
+    tasks = [{'id': 't0', 'name': 't0'}] + [
+        {'id': 't%d' % i, 'name': 't%d' % i, 'depends': ['t0']}
+        for i in range(1, n)]
+    bench = Bench(tasks)
+    bench.complete(bench.channel.tasks[0])
+    bench.finish()
+    start = time.time()
+    for body in bench.channel.tasks[1:RESULTS + 1]:
+        bench.complete(body)
+    bench.finish()
+    elapsed = time.time() - start
+    bench.close()
+    return elapsed / RESULTS * 1e6
+
+
+def bench_chain(n):
+    tasks = [{'id': 't0', 'name': 't0'}] + [
+        {'id': 't%d' % i, 'name': 't%d' % i, 'depends': ['t%d' % (i - 1)]}
+        for i in range(1, n)]
+    bench = Bench(tasks)
+    bench.finish()
+    start = time.time()
+    for i in range(RESULTS):
+        bench.complete(bench.channel.tasks[-1])
+    bench.finish()
+    elapsed = time.time() - start
+    bench.close()
+    return elapsed / RESULTS * 1e6
+
+
+def best(bench, n, repeat=3):
+    return min(bench(n) for i in range(repeat))
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level=logging.CRITICAL)
+    print '{0:<8}{1:>16}{2:>16}'.format('tasks', 'fan-out us', 'chain us')
+    for n in SIZES:
+        print '{0:<8}{1:>16.1f}{2:>16.1f}'.format(
+            n, best(bench_fan_out, n), best(bench_chain, n))
@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+'''
+Microbenchmark of result processing in hub.lib.jobs.Job: the cost of
+taking one task result (update_tasks followed by get_next_tasks_to_run)
+as jobs grow. It should stay flat rather than grow with the number of
+tasks.
+
+Two job shapes are timed: a fan-out, one task with N dependents all in
+flight, and a chain of N tasks each depending on the one before.
+
+Run from the repository root: python benchmarks/bench_results.py
+'''
+import os
+import sys
+import json
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.jobs import Job
+from hub.lib.tasks import Task
+
+SIZES = (500, 2000, 8000)
+# Results processed per timing
+RESULTS = 200
+
+
+def fan_out(n):
+    tasks = [{'name': 't0'}] + [{'name': 't%d' % i, 'depends': ['t0']}
+                                for i in range(1, n)]
+    return Job().load(json.dumps({'name': 'fan', 'tasks': tasks}))
+
+
+def chain(n):
+    tasks = [{'name': 't0'}] + [{'name': 't%d' % i,
+                                 'depends': ['t%d' % (i - 1)]}
+                                for i in range(1, n)]
+    return Job().load(json.dumps({'name': 'chain', 'tasks': tasks}))
+
+
+def complete(job, task):
+    '''Feed the job a successful result for task, as the dispatcher does.'''
+    result = Task().load(task.save())
+    result.state.status = 'SUCCESS'
+    result.state.data = 1
+    job.update_tasks(result, force=True)
+    return job.get_next_tasks_to_run()
+
+
+def submit(tasks):
+    for task in tasks:
+        task.state.status = 'SUBMITTED'
+
+
+def bench_fan_out(n):
+    job = fan_out(n)
+    submit(job.get_next_tasks_to_run())
+    submit(complete(job, job.state.tasks[0]))
+    # Lets go of the dependents now in flight, a one-off cost
+    job.get_next_tasks_to_run()
+    start = time.time()
+    for i in range(1, RESULTS + 1):
+        complete(job, job.state.tasks[i])
+    return (time.time() - start) / RESULTS * 1e6
+
+
+def bench_chain(n):
+    job = chain(n)
+    ready = job.get_next_tasks_to_run()
+    start = time.time()
+    for i in range(RESULTS):
+        submit(ready)
+        ready = complete(job, ready[0])
+    return (time.time() - start) / RESULTS * 1e6
+
+
+def best(bench, n, repeat=3):
+    return min(bench(n) for i in range(repeat))
+
+
+if __name__ == '__main__':
+    print '{0:<8}{1:>16}{2:>16}'.format('tasks', 'fan-out us', 'chain us')
+    for n in SIZES:
+        print '{0:<8}{1:>16.1f}{2:>16.1f}'.format(
+            n, best(bench_fan_out, n), best(bench_chain, n))
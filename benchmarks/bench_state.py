@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+'''
+Microbenchmark of hub.lib.common.State against the dict backed State it
+replaced: attribute access, memory per task and save()/load() throughput.
+
+Run from the repository root: python benchmarks/bench_state.py
+'''
+import os
+import sys
+import json
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.common import State
+
+
+class DictState(object):
+    '''
+    The previous State: every field in a dict behind __getattr__ and
+    __setattr__, converting str/unicode on every set.
+    '''
+    def __init__(self):
+        self._state = {}
+        self._dirty = set()
+        self._tracker = None
+
+    def _convert(self, input):
+        if isinstance(input, str):
+            return input.decode('utf-8')
+        elif isinstance(input, unicode):
+            return input.encode('utf-8')
+        else:
+            return input
+
+    def __setattr__(self, name, value):
+        if name.startswith('_'):
+            object.__setattr__(self, name, value)
+        else:
+            unicodename = self._convert(name)
+            unicodevalue = self._convert(value)
+            self.__dict__['_state'][unicodename] = unicodevalue
+            self.mark_dirty(unicodename)
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            return self.__dict__.get(name, None)
+        else:
+            return self.__dict__['_state'].get(name, None)
+
+    def load(self, record):
+        self._record = json.loads(record)
+        self._state = dict(self._state.items() + self._record.items())
+        self.mark_clean()
+        return self
+
+    def save(self):
+        return json.dumps(self._state)
+
+    def mark_dirty(self, *names):
+        self.__dict__['_dirty'].update(names)
+        tracker = self.__dict__['_tracker']
+        if tracker is not None:
+            tracker.add(self.__dict__['_state'].get('id'))
+
+    def mark_clean(self):
+        self.__dict__['_dirty'].clear()
+
+
+RECORD = json.dumps({
+    'id': '6f1c1b2e-0a3d-11e5-8f3c-0800275f1b6a',
+    'parent_id': '6f1c0fba-0a3d-11e5-8f3c-0800275f1b6a',
+    'name': 'multiply_this', 'task_name': 'multiply', 'status': 'PENDING',
+    'args': ['_add.data', 2], 'depends': ['add'], 'timeout': 30,
+    'start_time': 1433245843.25, 'host': 'node1'})
+
+
+def size_of(state):
+    '''Bytes held by a loaded state, not counting the values themselves.'''
+    size = sys.getsizeof(state) + sys.getsizeof(state._dirty)
+    if hasattr(state, '__dict__'):
+        size += sys.getsizeof(state.__dict__)
+        size += sys.getsizeof(state.__dict__['_state'])
+        size += sys.getsizeof(state.__dict__.get('_record', {}))
+    else:
+        size += sys.getsizeof(state._extra)
+    return size
+
+
+def bench(cls, number=200000):
+    setup = ('from __main__ import {0} as cls, RECORD\n'
+             'state = cls().load(RECORD)'.format(cls.__name__))
+    results = {}
+    for name, stmt, n in [('get', 'state.status', number),
+                          ('get unset', 'state.data', number),
+                          ('set', "state.status = 'RUNNING'", number),
+                          ('load', 'cls().load(RECORD)', number / 10),
+                          ('save', 'state.save()', number / 10)]:
+        seconds = min(timeit.Timer(stmt, setup).repeat(7, n))
+        results[name] = seconds / n * 1e6
+    results['bytes'] = size_of(cls().load(RECORD))
+    return results
+
+
+if __name__ == '__main__':
+    print '{0:<10}{1:>10}{2:>11}{3:>10}{4:>10}{5:>10}{6:>8}'.format(
+        '', 'get us', 'unset us', 'set us', 'load us', 'save us', 'bytes')
+    for cls in (DictState, State):
+        r = bench(cls)
+        print '{0:<10}{1:>10.3f}{2:>11.3f}{3:>10.3f}{4:>10.2f}{5:>10.2f}' \
+            '{6:>8}'.format(cls.__name__, r['get'], r['get unset'], r['set'],
+                            r['load'], r['save'], r['bytes'])
@@ -13,5 +13,7 @@ setup(
     license='LICENSE',
     description='Python based orchestration engine',
     long_description=open('README.md').read(),
-    install_requires=['pika'],
+    install_requires=['pika>=0.12,<1.0'],
+    # msgpack 1.0 dropped the Python 2 extension module
+    extras_require={'msgpack': ['msgpack>=0.5.2,<1.0']},
 )
@@ -1,20 +1,165 @@
-from hub.lib.client import Client
+'''
+Hub helpers for Salt modules and returners
+
+Everything in a process shares one client connection to the broker,
+made on first use and remade if it drops or the process forks. Task
+updates are sent before the helpers return, except through update(),
+which queues them to be sent in batches from a background thread.
+'''
+import os
 import time
+import atexit
+import logging
+import threading
+
+import hub.lib.config as config
+from hub.lib.client import Client
+from hub.lib.publisher import CONNECTION_ERRORS
+
+CONFIG_FILE = '/usr/local/pkg/hub/etc/hub.conf'
+
+log = logging.getLogger(__name__)
+
+
+class SharedClient(object):
+    '''
+    A Client shared between threads, connecting lazily and reconnecting
+    after the connection is lost. Threads' calls share the connection
+    (see Client) and wait up to timeout seconds for their replies before
+    raising TimeoutError. Queued updates are sent batch_size to a
+    message, at most batch_interval seconds after being queued.
+    '''
+    def __init__(self, config_file=CONFIG_FILE, batch_size=100,
+                 batch_interval=0.5, timeout=60):
+        self.config_file = config_file
+        self.batch_size = int(batch_size)
+        self.batch_interval = float(batch_interval)
+        self.timeout = timeout
+        self._lock = threading.RLock()
+        self._client = None
+        # Process the client was made in; it can't be used after a fork
+        self._pid = None
+        self._cond = threading.Condition()
+        self._updates = []
+        self._flusher = None
+        self._flusher_pid = None
+
+    def client(self):
+        with self._lock:
+            if self._client is None or self._pid != os.getpid():
+                conf = config.setup(self.config_file)
+                self._client = Client(conf.get('HUB', 'broker', 'localhost'),
+                                      timeout=self.timeout)
+                self._pid = os.getpid()
+            return self._client
+
+    def reset(self, client):
+        '''
+        Drop the client, so the next call reconnects, unless another
+        thread has already
+        '''
+        with self._lock:
+            if client is not self._client:
+                return
+            self._client = None
+        if client is not None:
+            try:
+                client.conn.close()
+            except Exception:
+                pass
+
+    def call(self, method, *args, **kwargs):
+        '''
+        Call a Client method, reconnecting and trying again once if the
+        connection has been lost
+        '''
+        client = self.client()
+        try:
+            return getattr(client, method)(*args, **kwargs)
+        except CONNECTION_ERRORS, e:
+            log.warn('Lost connection to broker ({0}); '
+                     'reconnecting'.format(e))
+            self.reset(client)
+            return getattr(self.client(), method)(*args, **kwargs)
+
+    def queue_update(self, taskdata):
+        '''Queue a task update to be sent with the next batch.'''
+        with self._cond:
+            # Threads don't survive a fork either, and the updates the
+            # parent queued are its own to send
+            if self._flusher is None or self._flusher_pid != os.getpid():
+                self._updates = []
+                self._flusher = threading.Thread(target=self._run,
+                                                 name='SaltHubUpdates')
+                self._flusher.daemon = True
+                self._flusher.start()
+                self._flusher_pid = os.getpid()
+            self._updates.append(taskdata)
+            if len(self._updates) >= self.batch_size:
+                self._cond.notify()
+
+    def _take(self):
+        with self._cond:
+            while not self._updates:
+                self._cond.wait()
+            deadline = time.time() + self.batch_interval
+            while len(self._updates) < self.batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            batch = self._updates[:self.batch_size]
+            del self._updates[:self.batch_size]
+            return batch
+
+    def _run(self):
+        while True:
+            self._send(self._take())
+
+    def _send(self, batch):
+        try:
+            self.call('update', batch)
+        except Exception, e:
+            log.error('Failed to send {0} task updates'.format(len(batch)))
+            log.exception(e)
+
+    def flush(self):
+        '''Send every queued update now.'''
+        with self._cond:
+            if self._flusher_pid != os.getpid():
+                self._updates = []
+            batch, self._updates = self._updates, []
+        while batch:
+            self._send(batch[:self.batch_size])
+            del batch[:self.batch_size]
+
+
+shared = SharedClient()
+atexit.register(shared.flush)
+
 
 def update_job(job_id, result='DONE', status='SUCCESS'):
-    client = Client('/usr/local/pkg/hub/etc/hub.conf')
     taskdata = {'status': status, 'data': result, 'id': job_id}
-    client.update(taskdata=taskdata)
+    shared.call('update', taskdata)
+    return True
+
+def update(job_id, result='DONE', status='SUCCESS'):
+    '''
+    Like update_job, but the update is queued and sent in a batch shortly
+    after. Updates still queued when a process ends without running exit
+    handlers (e.g. with os._exit, as Salt's job processes do) are lost
+    unless shared.flush() is called first.
+    '''
+    taskdata = {'status': status, 'data': result, 'id': job_id}
+    shared.queue_update(taskdata)
     return True
 
 def get_job(job_id):
-    client = Client('/usr/local/pkg/hub/etc/hub.conf')
-    response = client.get(job_id)
+    response = shared.call('get', job_id)
     return response
 
 def sleep(secs, name, job_id, parent_id, result, status='SUCCESS'):
     time.sleep(secs)
-    client = Client('/usr/local/pkg/hub/etc/hub.conf')
     taskdata = {'status': status, 'name': name, 'data': result, 'id': job_id, 'parent_id': parent_id }
-    client.update(parent_id, taskdata=taskdata)
-    return True
\ No newline at end of file
+    shared.call('update', taskdata)
+    return True
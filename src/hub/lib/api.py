@@ -6,12 +6,29 @@ from functools import wraps
 # own modules
 import tasks
 
+# Tasks by name, filled in as plugins declaring them are imported
+registry = {}
+
+
+def register(task_obj, name=None):
+    '''
+    Make a task available to workers under its own or the given name
+    '''
+    if name is None:
+        name = task_obj.name
+    registry[name] = task_obj
+    return task_obj
+
 
 def task(*args, **kwargs):
     '''
     Decorator declaring the wrapped function to be a task.
     May be invoked as a simple, argument-less decorator (i.e. ``@task``) or
-    with arguments customizing its behavior (e.g. ``@task(async=True)``).
+    with arguments customizing its behavior (e.g. ``@task(async=True)``,
+    or ``@task(cache=True, ttl=3600)`` for a pure task whose results may be
+    reused for the same arguments).
+    Tasks are registered under the function's name, or under ``name`` if
+    given (e.g. ``@task(name='add')``), so one plugin may export several.
     '''
     # Returns true if @task is passed arguments other than just the
     # plugin's main function (which is implied anyway)
@@ -19,6 +36,7 @@ def task(*args, **kwargs):
 
     # The class used to wrap the function, defaults to WrappedCallableTask
     task_class = kwargs.pop("task_class", tasks.WrappedCallableTask)
+    name = kwargs.pop("name", None)
 
     if not invoked:
         func, args = args[0], ()
@@ -27,7 +45,10 @@ def task(*args, **kwargs):
         '''
         Returns a class with the wrapped function bound as the run method
         '''
-        return task_class(func, *args, **kwargs)
+        task_obj = task_class(func, *args, **kwargs)
+        if name is not None:
+            task_obj.__name__ = task_obj.name = name
+        return register(task_obj)
 
     # If additional args were passed to the decorator then we return the
     # wrapper function so the extra args can be unwrapped
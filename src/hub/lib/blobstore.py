@@ -0,0 +1,191 @@
+'''
+Out of band storage for large task data
+
+Task data over a size threshold is stored once, keyed by the digest of its
+encoding, and job records carry a reference to it instead:
+{'$ref': <sha1>, 'size': <bytes>, 'type': <content type>}
+
+Classes:
+BlobStore - Base class.
+FileBlobStore - Blobs as files in a directory.
+RedisBlobStore - Blobs as Redis keys.
+'''
+# core modules
+import os
+import mmap
+import hashlib
+import logging
+import tempfile
+
+# own modules
+import hub.lib.error as error
+import hub.lib.serializer as serializer
+
+
+def is_ref(value):
+    '''True if value is a reference to a stored blob.'''
+    return isinstance(value, dict) and '$ref' in value
+
+
+class BlobStore(object):
+    '''
+    Base class for blob stores. Values whose encoding reaches threshold
+    bytes are offloaded.
+    '''
+    def __init__(self, threshold=1048576):
+        self.threshold = int(threshold)
+        self.log = logging.getLogger(__name__)
+
+    def _read(self, digest):
+        raise error.MethodNotImplemented('Blob stores must have a _read method')
+
+    def _write(self, digest, blob):
+        raise error.MethodNotImplemented('Blob stores must have a _write method')
+
+    def put(self, value, codec=None, blob=None):
+        '''
+        Store a value, encoded with codec unless already given encoded as
+        blob, and return a reference to it
+        '''
+        if codec is None:
+            codec = serializer.get_codec()
+        if blob is None:
+            blob = codec.dumps(value)
+        digest = hashlib.sha1(blob).hexdigest()
+        self._write(digest, blob)
+        return {'$ref': digest, 'size': len(blob), 'type': codec.content_type}
+
+    def get(self, ref):
+        '''Fetch and decode the value a reference points to.'''
+        blob = self._read(ref['$ref'])
+        if blob is None:
+            raise error.HubError('Blob {0} not found'.format(ref['$ref']))
+        return serializer.get_codec(ref.get('type')).loads(blob)
+
+    def offload(self, value, codec=None):
+        '''
+        Return a reference to value if it's big enough to be stored out of
+        band, otherwise value itself
+        '''
+        if not self.threshold or value is None or \
+                isinstance(value, (bool, int, long, float)):
+            return value
+        if codec is None:
+            codec = serializer.get_codec()
+        blob = codec.dumps(value)
+        if len(blob) < self.threshold:
+            return value
+        return self.put(value, codec, blob)
+
+    def resolve(self, value):
+        '''
+        Return value with any references in it, or in lists and dicts in
+        it, replaced by what they point to
+        '''
+        if is_ref(value):
+            return self.get(value)
+        if isinstance(value, list):
+            return [self.resolve(v) for v in value]
+        if isinstance(value, dict):
+            return dict((k, self.resolve(v)) for k, v in value.iteritems())
+        return value
+
+
+class FileBlobStore(BlobStore):
+    '''
+    Blobs kept as files under a directory (which may be shared between
+    hosts), fanned out by the first two characters of their digest
+    '''
+    def __init__(self, path, threshold=1048576):
+        super(FileBlobStore, self).__init__(threshold)
+        self.path = path
+
+    def _path(self, digest):
+        return os.path.join(self.path, digest[:2], digest)
+
+    def _write(self, digest, blob):
+        path = self._path(digest)
+        if os.path.exists(path):
+            return
+        directory = os.path.dirname(path)
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        # Write aside and rename so readers never see part of a blob
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(blob)
+            os.rename(tmp, path)
+        except:
+            os.unlink(tmp)
+            raise
+
+    def _read(self, digest):
+        try:
+            f = open(self._path(digest), 'rb')
+        except IOError:
+            return None
+        with f:
+            if not os.fstat(f.fileno()).st_size:
+                return ''
+            # Mapped, so only the pages of the blob which are decoded
+            # are read in
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def get(self, ref):
+        blob = self._read(ref['$ref'])
+        if blob is None:
+            raise error.HubError('Blob {0} not found'.format(ref['$ref']))
+        codec = serializer.get_codec(ref.get('type'))
+        if not isinstance(blob, mmap.mmap):
+            return codec.loads(blob)
+        try:
+            # msgpack decodes straight from the mapping through a buffer
+            # (mmap has no memoryview support on Python 2); json wants a
+            # string, so gets a copy
+            if codec.content_type != serializer.JSON:
+                return codec.loads(buffer(blob))
+            return codec.loads(blob[:])
+        finally:
+            blob.close()
+
+
+class RedisBlobStore(BlobStore):
+    '''
+    Blobs kept in Redis under 'blob:<digest>'
+    '''
+    def __init__(self, host, port, instance, threshold=1048576):
+        super(RedisBlobStore, self).__init__(threshold)
+        import redis
+        self.db = redis.StrictRedis(host=host, port=int(port),
+                                    db=int(instance))
+
+    def _write(self, digest, blob):
+        self.db.set('blob:' + digest, blob, nx=True)
+
+    def _read(self, digest):
+        return self.db.get('blob:' + digest)
+
+
+def setup(conf):
+    '''
+    Return the blob store configured in the [BLOBS] section of conf, or
+    None if there isn't one
+    '''
+    if conf is None:
+        return None
+    store = conf.get('BLOBS', 'type', 'none')
+    threshold = conf.get('BLOBS', 'threshold', 1048576)
+    if store == 'none':
+        return None
+    if store == 'file':
+        return FileBlobStore(conf.get('BLOBS', 'path', '/var/lib/hub/blobs'),
+                             threshold)
+    if store == 'redis':
+        return RedisBlobStore(conf.get('BLOBS', 'host', 'localhost'),
+                              conf.get('BLOBS', 'port', 6379),
+                              conf.get('BLOBS', 'instance', 0), threshold)
+    raise error.ConfigError('Unknown blob store type {0}'.format(store))
@@ -2,20 +2,107 @@
 This is the Hub client which submits, updates, queries and deletes jobs
 '''
 import sys
+import time
 import pika
 import json
 import uuid
 import logging
+import threading
 import hub.lib.error as error
+import hub.lib.serializer as serializer
+
+
+class Reply(object):
+    '''
+    The reply to a request, which may not have arrived yet; much like a
+    concurrent.futures Future. Waiting for it takes replies to any of
+    the client's requests off the connection meanwhile. A request the
+    dispatcher couldn't answer raises HubError, saying why, in place of
+    a result.
+    '''
+    def __init__(self, client, corr_id, decode=None):
+        self.client = client
+        self.corr_id = corr_id
+        # Applied to the reply body when it arrives
+        self.decode = decode
+        self._done = False
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+
+    def done(self):
+        return self._done
+
+    def result(self, timeout=None):
+        '''
+        The reply body, waiting up to timeout seconds (forever if None)
+        for it to arrive before raising TimeoutError
+        '''
+        if not self._done and not self.client.wait([self], timeout):
+            raise error.TimeoutError(
+                'No reply to request {0} within {1}s'.format(self.corr_id,
+                                                             timeout))
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def add_done_callback(self, callback):
+        '''
+        Call callback(reply) when the reply arrives, or now if it has
+        '''
+        if self._done:
+            callback(self)
+        else:
+            self._callbacks.append(callback)
+
+    def cancel(self):
+        '''Stop waiting for the reply; it is dropped if it comes.'''
+        self.client._replies.pop(self.corr_id, None)
+
+    def set_result(self, result):
+        if self.decode is not None and result is not None:
+            result = self.decode(result)
+        self._result = result
+        self._finish()
+
+    def set_exception(self, exception):
+        self._exception = exception
+        self._finish()
+
+    def _finish(self):
+        self._done = True
+        for callback in self._callbacks:
+            try:
+                callback(self)
+            except Exception, e:
+                self.client.log.exception(e)
+        self._callbacks = []
 
 
 class Client(object):
     '''
     Class representing things that can submit and query jobs.
+
+    Requests can be sent without waiting for their replies with the
+    *_async methods, which return a Reply. Any number of requests may be
+    outstanding at once; their replies come back on one queue and are
+    matched up by correlation id.
     '''
-    def __init__(self, broker):
+    # Longest time spent waiting on the connection between checks of
+    # whether what's being waited for has arrived
+    poll_interval = 1
+
+    def __init__(self, broker, serializer_name=None, timeout=None):
         self.broker = broker
         self.log = logging.getLogger(__name__)
+        # Encoding of requests; the dispatcher replies in kind
+        self.codec = serializer.get_codec(serializer_name)
+        # Seconds blocking calls wait for a reply, None for ever
+        self.timeout = timeout
+        # Correlation id -> Reply still to arrive
+        self._replies = {}
+        # Held while using the connection
+        self._lock = threading.RLock()
         self.conn = pika.BlockingConnection(pika.ConnectionParameters(
                                             host=self.broker))
         self.channel = self.conn.channel()
@@ -26,66 +113,193 @@ class Client(object):
                                    queue=self.callback_queue)
 
     def on_response(self, channel, method, properties, body):
-        if self.corr_id == properties.correlation_id:
-            self.response = body
+        reply = self._replies.pop(properties.correlation_id, None)
+        if reply is None:
+            self.log.debug('Dropping reply to unknown request {0}'.format(
+                           properties.correlation_id))
+            return
+        if properties.content_type == serializer.TEXT:
+            reply.set_exception(error.HubError(str(body)))
+        else:
+            reply.set_result(str(body))
+
+    def wait(self, replies=None, timeout=None):
+        '''
+        Take replies off the connection until the given replies (by
+        default every outstanding one) have all arrived, or for at most
+        timeout seconds. Returns True if they all arrived.
+        '''
+        if replies is None:
+            replies = self._replies.values()
+        deadline = None
+        if timeout is not None:
+            deadline = time.time() + timeout
+        waiting = 0
+        while True:
+            while waiting < len(replies) and replies[waiting].done():
+                waiting += 1
+            if waiting == len(replies):
+                return True
+            time_limit = self.poll_interval
+            if deadline is not None:
+                time_limit = min(time_limit, deadline - time.time())
+                if time_limit <= 0:
+                    return False
+            with self._lock:
+                # Another thread may have taken the reply while this one
+                # waited for the connection
+                if not replies[waiting].done():
+                    self.conn.process_data_events(time_limit=time_limit)
+
+    def _encode(self, record):
+        '''
+        Encode a job or task record. Records may be given as JSON text,
+        which is re-encoded if the client uses another codec.
+        '''
+        if isinstance(record, basestring):
+            if self.codec.content_type == serializer.JSON:
+                return record
+            record = json.loads(record)
+        return self.codec.dumps(record)
 
     def _post(self, jobid, request_type, blocking=True, taskdata=None,
-              job=None):
+              job=None, jobs=None):
         '''
-        Send job to messaging system
+        Send job to messaging system. Returns the reply if blocking,
+        otherwise a Reply to wait for it with. Updates get no reply.
         '''
+        decode = None
         if request_type is 'create':
-            self.routing_key = 'hub_jobs'
-            self.body = job
+            routing_key = 'hub_jobs'
+            body = self._encode(job)
+        elif request_type is 'create_many':
+            routing_key = 'hub_jobs'
+            body = self.codec.dumps([json.loads(record)
+                                     if isinstance(record, basestring)
+                                     else record for record in jobs])
+            decode = self.codec.loads
         elif request_type is 'update':
-            self.routing_key = 'hub_results'
-            self.body = taskdata
+            routing_key = 'hub_results'
+            body = self._encode(taskdata)
         elif request_type is 'get':
-            self.routing_key = 'hub_status'
-            self.body = json.dumps(jobid)
+            routing_key = 'hub_status'
+            body = self.codec.dumps(jobid)
 
-        self.response = None
         if request_type is 'update':
-            self.corr_id = str(jobid)
+            corr_id = str(jobid)
         else:
-            self.corr_id = str(uuid.uuid4())
-        _prop = pika.BasicProperties(content_type='application/json',
+            corr_id = str(uuid.uuid4())
+        reply = Reply(self, corr_id, decode)
+        _prop = pika.BasicProperties(content_type=self.codec.content_type,
                                      reply_to=self.callback_queue,
-                                     correlation_id=self.corr_id)
-        self.channel.basic_publish(exchange='',
-                                   routing_key=self.routing_key,
-                                   properties=_prop,
-                                   body=self.body)
+                                     correlation_id=corr_id)
+        with self._lock:
+            if request_type is not 'update':
+                self._replies[corr_id] = reply
+            self.channel.basic_publish(exchange='',
+                                       routing_key=routing_key,
+                                       properties=_prop,
+                                       body=body)
+        if request_type is 'update':
+            reply.set_result(None)
         if blocking is True:
-            while self.response is None:
-                self.conn.process_data_events()
-        return str(self.response)
+            return reply.result(self.timeout)
+        return reply
 
     def create(self, job):
         '''
-        Posts a new job
+        Posts a new job. Raises HubError if its id is taken.
         '''
         self.log.info('Submitting new job to queue')
         res = self._post(None, 'create', blocking=True, job=job)
         return res
 
+    def create_async(self, job):
+        '''
+        Posts a new job without waiting; returns a Reply for its job id
+        '''
+        return self._post(None, 'create', blocking=False, job=job)
+
+    def create_many(self, jobs, batch_size=1000):
+        '''
+        Posts new jobs, batch_size to a message, and returns their ids
+        '''
+        self.log.info('Submitting {0} new jobs to queue'.format(len(jobs)))
+        replies = [self.create_many_async(jobs[i:i + batch_size])
+                   for i in range(0, len(jobs), batch_size)]
+        job_ids = []
+        for reply in replies:
+            job_ids.extend(reply.result(self.timeout))
+        return job_ids
+
+    def create_many_async(self, jobs):
+        '''
+        Posts new jobs in one message without waiting; returns a Reply for
+        the list of their ids
+        '''
+        return self._post(None, 'create_many', blocking=False, jobs=jobs)
+
     def update(self, taskdata):
         '''
-        Update a job
+        Update a job. taskdata may be a list of task records, sent in one
+        message.
         '''
         self.log.info('Submitting task results to queue')
-        res = self._post('update_task', 'update', blocking=False,
-                         taskdata=taskdata)
-        return res
+        self._post('update_task', 'update', blocking=False,
+                   taskdata=taskdata)
 
-    def get(self, jobid=None):
+    def update_async(self, taskdata):
         '''
-        Get status on a current job
+        Update a job; returns a Reply which is done once the update is sent
+        '''
+        return self._post('update_task', 'update', blocking=False,
+                          taskdata=taskdata)
+
+    def get(self, jobid=None, resolve=False, fields=None, task_fields=None,
+            **filters):
+        '''
+        Get status on a current job. With resolve, job output kept in the
+        blob store is fetched by the dispatcher in place of references;
+        fields and task_fields cut down what is returned. Raises HubError
+        if there's no such job.
+
+        Without a job id, returns an iterator over the records of jobs
+        matching the filters instead (see search).
         ''' 
         if jobid is None:
-            jobid = 'all'  # Keyword recoginised by dispatcher
             self.log.info('Requesting status for all jobs')
-        else:
-            self.log.info('Requesting status for job {0}'.format(jobid))
-        res = self._post(jobid, 'get', blocking=True)
-        return res
+            return self.search(fields=fields, task_fields=task_fields,
+                               **filters)
+        self.log.info('Requesting status for job {0}'.format(jobid))
+        return self.get_async(jobid, resolve, fields, task_fields).result(
+            self.timeout)
+
+    def get_async(self, jobid, resolve=False, fields=None, task_fields=None):
+        '''
+        Get status on a current job without waiting; returns a Reply
+        '''
+        if resolve or fields is not None or task_fields is not None:
+            jobid = {'id': jobid, 'resolve': resolve, 'fields': fields,
+                     'task_fields': task_fields}
+        return self._post(jobid, 'get', blocking=False)
+
+    def search(self, status=None, name=None, since=None, until=None,
+               fields=None, task_fields=None, page_size=100):
+        '''
+        Iterate over the records of jobs matching all of the given filters,
+        oldest first, fetching a page of page_size jobs at a time as
+        needed. status may be a list of statuses; since and until bound
+        the jobs' start times. fields and task_fields (e.g. ['id',
+        'status']) cut down the records returned.
+        '''
+        query = {'status': status, 'name': name, 'since': since,
+                 'until': until, 'fields': fields, 'task_fields': task_fields,
+                 'limit': page_size}
+        query = dict((k, v) for k, v in query.iteritems() if v is not None)
+        while True:
+            page = self.codec.loads(self._post(query, 'get', blocking=True))
+            for record in page['jobs']:
+                yield record
+            if page['next'] is None:
+                return
+            query['after'] = page['next']
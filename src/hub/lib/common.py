@@ -10,6 +10,9 @@ import logging
 import traceback
 from signal import SIGTERM
 
+# Own modules
+import hub.lib.serializer as serializer
+
 # 3rd part modules
 import json
 
@@ -18,10 +21,24 @@ class State(object):
     '''
     Class representing a unit of work's state.
     Essentially a dictionary which can be easily de/serialised
-    for passing through the messaging network.
+    for passing through the messaging network. Well known fields are
+    kept in slots and anything else in an overflow dict. Fields which
+    are unset read as None; well known fields set to None aren't saved.
     '''
+    FIELDS = ('id', 'parent_id', 'name', 'task_name', 'status', 'args',
+              'depends', 'data', 'tasks', 'timeout', 'start_time',
+              'end_time', 'attempt')
+    __slots__ = FIELDS + ('_extra', '_dirty', '_tracker')
+
     def __init__(self):
-        self._state = {}
+        # Bypass __setattr__, this is on the hot path of every load
+        for slot in _SLOT_DESCRIPTORS:
+            slot.__set__(self, None)
+        _setattr(self, '_extra', {})
+        # Keys changed since the state was last loaded or persisted
+        _setattr(self, '_dirty', set())
+        # Optional set shared with a parent job, told our id when we change
+        _setattr(self, '_tracker', None)
 
     def __repr__(self):
         return '%s' % self._state
@@ -29,38 +46,148 @@ class State(object):
     def __str__(self):
         return '%s' % self._state
 
-    def _convert(self, input):
-        if isinstance(input, str):
-            return input.decode('utf-8')
-        elif isinstance(input, unicode):
-            return input.encode('utf-8')
-        else:
-            return input
-
     def __setattr__(self, name, value):
-        if name.startswith('_'):
-            object.__setattr__(self, name, value)
+        if name[0] == '_':
+            _setattr(self, name, value)
+            return
+        slot = _SLOTS.get(name)
+        if slot is not None:
+            slot.__set__(self, value)
         else:
-            unicodename = self._convert(name)
-            unicodevalue = self._convert(value)
-            self.__dict__['_state'][unicodename] = unicodevalue
+            self._extra[name] = value
+        self._dirty.add(name)
+        if self._tracker is not None:
+            self._tracker.add(self.id)
 
     def __getattr__(self, name):
-        if name.startswith('_'):
-            return self.__dict__.get(name, None)
-        else:
-            return self.__dict__['_state'].get(name, None)
-
-    def load(self, record):
-        '''Load job state from json object.'''
-        self._record = json.loads(record)
+        # Only called for fields which aren't well known
+        if name.startswith('__'):
+            raise AttributeError(name)
+        if name[0] == '_':
+            return None
+        return self._extra.get(name)
+
+    def _get_state(self):
+        # Field by field rather than a loop over FIELDS, which takes twice
+        # as long; every save goes through here
+        state = {}
+        value = self.id
+        if value is not None:
+            state['id'] = value
+        value = self.parent_id
+        if value is not None:
+            state['parent_id'] = value
+        value = self.name
+        if value is not None:
+            state['name'] = value
+        value = self.task_name
+        if value is not None:
+            state['task_name'] = value
+        value = self.status
+        if value is not None:
+            state['status'] = value
+        value = self.args
+        if value is not None:
+            state['args'] = value
+        value = self.depends
+        if value is not None:
+            state['depends'] = value
+        value = self.data
+        if value is not None:
+            state['data'] = value
+        value = self.tasks
+        if value is not None:
+            state['tasks'] = value
+        value = self.timeout
+        if value is not None:
+            state['timeout'] = value
+        value = self.start_time
+        if value is not None:
+            state['start_time'] = value
+        value = self.end_time
+        if value is not None:
+            state['end_time'] = value
+        value = self.attempt
+        if value is not None:
+            state['attempt'] = value
+        if self._extra:
+            state.update(self._extra)
+        return state
+
+    def _set_state(self, state):
+        for slot in _SLOT_DESCRIPTORS:
+            slot.__set__(self, None)
+        self._extra = {}
+        self._update(state)
+
+    # The state as a plain dict; assigning it doesn't mark anything dirty
+    _state = property(_get_state, _set_state)
+
+    def __getstate__(self):
+        return self._state, self._dirty
+
+    def __setstate__(self, pickled):
+        state, dirty = pickled
+        self.__init__()
+        self._update(state)
+        self._dirty.update(dirty)
+
+    def _update(self, record):
+        extra = self._extra
+        for name, value in record.iteritems():
+            slot = _SLOTS.get(name)
+            if slot is not None:
+                slot.__set__(self, value)
+            else:
+                extra[name] = value
+
+    def load(self, record, codec=None):
+        '''
+        Load job state from a record, json unless given a codec, or from
+        a record already decoded
+        '''
+        if not isinstance(record, dict):
+            if codec is None:
+                codec = serializer.get_codec()
+            record = codec.loads(record)
         # merge state with record info
-        self._state = dict(self._state.items() + self._record.items())
+        self._update(record)
+        self.mark_clean()
         return self
 
-    def save(self):
-        '''Save job state to json object.'''
-        return json.dumps(self._state)
+    def save(self, codec=None):
+        '''Save job state to a record, json unless given a codec.'''
+        if codec is None:
+            codec = serializer.get_codec()
+        return codec.dumps(self._state)
+
+    def copy(self):
+        '''Shallow copy of the state, including which keys are dirty.'''
+        state = State()
+        for slot in _SLOT_DESCRIPTORS:
+            slot.__set__(state, slot.__get__(self, State))
+        state._extra = dict(self._extra)
+        state._dirty = set(self._dirty)
+        return state
+
+    def mark_dirty(self, *names):
+        '''Flag keys as changed since the last load or persist.'''
+        self._dirty.update(names)
+        if self._tracker is not None:
+            self._tracker.add(self.id)
+
+    def mark_clean(self):
+        '''Forget changes, e.g. once they've been persisted.'''
+        self._dirty.clear()
+
+    def get_dirty(self):
+        '''Return the keys changed since the last load or persist.'''
+        return self._dirty
+
+_setattr = object.__setattr__
+# Slot descriptors of the well known State fields
+_SLOTS = dict((name, State.__dict__[name]) for name in State.FIELDS)
+_SLOT_DESCRIPTORS = _SLOTS.values()
 
 
 class ExternalTaskState(object):
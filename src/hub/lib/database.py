@@ -3,56 +3,398 @@ Database persistance
 
 Classes:
 HubDatabase - Base class.
+HubDatabasePool - Pool of long lived database handles.
 '''
 import json
+import time
+import Queue
 import logging
+import threading
+from itertools import islice
+from contextlib import contextmanager
+
+import hub.lib.error as error
+import hub.lib.serializer as serializer
+from hub.lib.jobs import project
 
 class HubDatabase():
     '''
     Base class for databases in this application
     '''
-    pass
+    # Exceptions meaning the handle is unusable and should be replaced
+    connection_errors = ()
+    # Encoding of the job and task records handed back by getjob/gettask
+    codec = serializer.get_codec()
+
+    def close(self):
+        pass
+
+    def begin(self):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Run the with block as one (possibly nested) unit of work
+        '''
+        self.begin()
+        try:
+            yield self
+        except:
+            self.rollback()
+            raise
+        self.commit()
+
+    def _deadline(self, state):
+        '''
+        Time by which a submitted task must have finished, if it has one,
+        or at which a task waiting to be retried is due
+        '''
+        if state.get('status') == 'RETRYING':
+            return state.get('retry_at')
+        if state.get('timeout') and state.get('start_time'):
+            return state['start_time'] + state['timeout']
+        return None
+
+class HubDatabasePool(object):
+    '''
+    Pool of long lived database handles, reconnecting on failure
+    '''
+    def __init__(self, backend, host, port, instance, size=4, timeout=None,
+                 **options):
+        self.backend = backend
+        self.host = host
+        self.port = port
+        self.instance = instance
+        self.size = int(size)
+        self.timeout = timeout
+        self.options = options
+        self.log = logging.getLogger(__name__)
+        # Handle bound to a thread for the length of a transaction
+        self._local = threading.local()
+        # Most recently used handle first so a hot handle stays hot
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._stats = {'checkouts': 0, 'waits': 0, 'reconnects': 0,
+                       'errors': 0}
+
+    def _count(self, stat):
+        with self._lock:
+            self._stats[stat] += 1
+
+    def _connect(self):
+        try:
+            return self.backend(self.host, self.port, self.instance,
+                                **self.options)
+        except error.HubError:
+            raise
+        except Exception, e:
+            raise error.DatabaseError('Failed to connect to database '
+                                      '{0}: {1}'.format(self.host, e), e)
+
+    def checkout(self):
+        '''
+        Take a handle from the pool, creating one if the pool isn't full
+        '''
+        self._count('checkouts')
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            create = self._created < self.size
+            if create:
+                self._created += 1
+        if create:
+            try:
+                return self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        self._count('waits')
+        try:
+            return self._idle.get(timeout=self.timeout)
+        except Queue.Empty:
+            raise error.DatabaseError('Timed out waiting for a database '
+                                      'handle')
+
+    def checkin(self, db):
+        self._idle.put(db)
+
+    @contextmanager
+    def connection(self):
+        '''
+        Check out a handle for the duration of a with block
+        '''
+        db = self.checkout()
+        try:
+            yield db
+        finally:
+            self.checkin(db)
+
+    def reconnect(self, db):
+        '''
+        Replace a broken handle with a fresh one
+        '''
+        self._count('reconnects')
+        try:
+            db.close()
+        except Exception:
+            pass
+        return self._connect()
+
+    @contextmanager
+    def transaction(self):
+        '''
+        Check out a handle and run the with block, and every call() made
+        from this thread inside it, as a single transaction
+        '''
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            with db.transaction():
+                yield db
+            return
+        db = self.checkout()
+        self._local.db = db
+        try:
+            with db.transaction():
+                yield db
+        except db.connection_errors, e:
+            # Nothing to retry: the work done so far is lost with the handle
+            self._count('errors')
+            db = self.reconnect(db)
+            raise error.DatabaseError('Database transaction failed: '
+                                      '{0}'.format(e), e)
+        finally:
+            self._local.db = None
+            self.checkin(db)
+
+    def call(self, method, *args, **kwargs):
+        '''
+        Run a backend method on a pooled handle, retrying once on a new
+        handle if the connection turns out to be broken. Raises
+        DatabaseError if it still is.
+        '''
+        db = getattr(self._local, 'db', None)
+        if db is not None:
+            return getattr(db, method)(*args, **kwargs)
+        db = self.checkout()
+        try:
+            try:
+                return getattr(db, method)(*args, **kwargs)
+            except db.connection_errors, e:
+                self._count('errors')
+                self.log.warn('Database {0} failed ({1}); reconnecting'.format(
+                              method, e))
+                db = self.reconnect(db)
+                try:
+                    return getattr(db, method)(*args, **kwargs)
+                except db.connection_errors, e:
+                    raise error.DatabaseError('Database {0} failed: '
+                                              '{1}'.format(method, e), e)
+        finally:
+            self.checkin(db)
+
+    def stats(self):
+        '''
+        Return pool usage counters for monitoring
+        '''
+        with self._lock:
+            stats = dict(self._stats)
+            stats['size'] = self.size
+            stats['created'] = self._created
+        stats['idle'] = self._idle.qsize()
+        stats['in_use'] = stats['created'] - stats['idle']
+        return stats
+
+    def close(self):
+        while True:
+            try:
+                db = self._idle.get_nowait()
+            except Queue.Empty:
+                break
+            db.close()
+            with self._lock:
+                self._created -= 1
 
 class HubRedis(HubDatabase):
-    
-    def __init__(self, host, port, instance, user=None, password=None ):
+    '''
+    Redis backend. Jobs and tasks are hashes, each with its encoded record
+    in its 'job' or 'task' field; a job's record leaves out its tasks,
+    whose ids are listed in its 'tasks' field, so a change to one task
+    only rewrites that task. Jobs are listed in the JOBS sorted set
+    scored by start time, and incomplete tasks are kept in
+    the INCOMPLETE set and, if they have a timeout, in the DEADLINES
+    sorted set scored by deadline. Live dispatcher instances are in the
+    INSTANCES sorted set scored by expiry. Cached task results are keys
+    'result:<key>' expiring with them, listed in the RESULTS sorted set
+    scored by last use; the RESULT_VERSIONS hash maps the names of the
+    tasks they're for to the version of the task which made them.
+    '''
+    # Task fields which move a task in or out of the deadline index
+    DEADLINE_KEYS = frozenset(['status', 'start_time', 'timeout', 'retry_at'])
+    # Shard leases are keys expiring with the lease, holding the owner
+    ACQUIRE_LEASE = """
+        local owner = redis.call('get', KEYS[1])
+        if owner == false or owner == ARGV[1] then
+            redis.call('set', KEYS[1], ARGV[1], 'PX', ARGV[2])
+            return 1
+        end
+        return 0"""
+    RELEASE_LEASE = """
+        if redis.call('get', KEYS[1]) == ARGV[1] then
+            return redis.call('del', KEYS[1])
+        end
+        return 0"""
+
+    def __init__(self, host, port, instance, user=None, password=None,
+                 **options):
         self.host = host
         self.port = int(port)
         self.user = user
         self.password = password
         self.instance = int(instance)
+        self.codec = serializer.get_codec(options.get('serializer'))
         import redis
         self.db = redis.StrictRedis(host=self.host,port=self.port,db=self.instance) 
+        self.connection_errors = (redis.exceptions.ConnectionError,
+                                  redis.exceptions.TimeoutError)
         self.log = logging.getLogger(__name__)
 
-    def updatejob(self, job):
-        self.putjob(job)
+    def close(self):
+        self.db.connection_pool.disconnect()
+
+    def _encode(self, value):
+        '''
+        Redis only stores strings and numbers; encode anything else
+        '''
+        if isinstance(value, (basestring, int, long, float)) and \
+                not isinstance(value, bool):
+            return value
+        return self.codec.dumps(value)
+
+    def _mapping(self, state, keys=None, exclude=()):
+        if keys is None:
+            keys = state.keys()
+        return dict((k, self._encode(state[k])) for k in keys
+                    if k in state and k not in exclude)
+
+    def _writejob(self, job, full):
+        '''
+        Write the job, its tasks and INCOMPLETE set membership as a single
+        MULTI/EXEC transaction (one round trip). Unless full, only fields
+        and tasks changed since the job was loaded or last written go out.
+        '''
+        pipe = self.db.pipeline(transaction=True)
+        job_keys = None if full else \
+            [k for k in job.state.get_dirty() if k != 'tasks']
+        if full or job_keys:
+            record = job.state._state
+            record.pop('tasks', None)
+            mapping = self._mapping(record, job_keys)
+            mapping['job'] = self.codec.dumps(record)
+            mapping['tasks'] = self.codec.dumps(job.task_ids())
+            pipe.hset(job.state.id, mapping=mapping)
+        incomplete = []
+        complete = []
+        # Incomplete tasks with a timeout, by deadline
+        deadlines = {}
+        failed = job.state.status == 'FAILED'
+        tasks = job.state.tasks if full else job.dirty_tasks()
+        for task in tasks:
+            task_keys = None if full else task.state.get_dirty()
+            mapping = self._mapping(task.state._state, task_keys)
+            mapping['task'] = task.save(self.codec)
+            pipe.hset(task.state.id, mapping=mapping)
+            if task_keys is not None and \
+                    not self.DEADLINE_KEYS.intersection(task_keys):
+                continue
+            #Do this so that if the parent is failed we don't keep in INCOMPLETE
+            if failed or task.state.status in ['SUCCESS', 'FAILED', 'PENDING']:
+                complete.append(task.state.id)
+            else:
+                incomplete.append(task.state.id)
+                deadline = self._deadline(task.state._state)
+                if deadline is not None:
+                    deadlines[task.state.id] = deadline
+        if failed and job_keys is not None and 'status' in job_keys:
+            complete = list(job.task_ids())
+            incomplete = []
+            deadlines = {}
+        if incomplete:
+            pipe.sadd('INCOMPLETE', *incomplete)
+        if complete:
+            self.log.debug("Removing tasks {0} from INCOMPLETE".format(complete))
+            pipe.srem('INCOMPLETE', *complete)
+        undated = [task_id for task_id in complete + incomplete
+                   if task_id not in deadlines]
+        if full:
+            # Index of jobs by start time, for searches
+            pipe.zadd('JOBS', {job.state.id: job.state.start_time or 0},
+                      nx=True)
+        if deadlines:
+            pipe.zadd('DEADLINES', deadlines)
+        if undated:
+            pipe.zrem('DEADLINES', *undated)
+        pipe.execute()
         return True
+
+    def updatejob(self, job):
+        return self._writejob(job, full=False)
     
     def putjob(self, job):
-        self.db.hset(job.state.id, 'job', job)
-        for k, v in job.state._state.iteritems():
-            self.db.hset(job.state.id, k, v)
-        for task in job.state.tasks:
-            self.db.hset(task.state.id, 'task', task)
-            for k, v in task.state._state.iteritems():
-                self.db.hset(task.state.id, k, v)
-                if k == "status" and v not in ['SUCCESS', 'FAILED', 'PENDING']:
-                    self.db.sadd('INCOMPLETE', task.state.id)
-                elif k == "status":
-                    self.log.debug("Removing task {0} from INCOMPLETE".format(task.state.id))
-                    self.db.srem('INCOMPLETE', task.state.id)
-                #Do this so that if the parent is failed we don't keep in INCOMPLETE
-                if k =="status" and job.state.status =="FAILED":
-                    self.log.debug("Removing task {0} from INCOMPLETE".format(task.state.id))
-                    self.db.srem('INCOMPLETE', task.state.id)
-                self.db.hset(task.state.id, k, v)
-                
-        return True
+        return self._writejob(job, full=True)
     
     def getjob(self, jobid):
-        ret = self.db.hget(jobid, 'job')
-        return ret
+        record, task_ids = self.db.hmget(jobid, 'job', 'tasks')
+        if record is None:
+            return None
+        return self.codec.dumps(self._assemble([(record, task_ids)])[0])
+
+    def _assemble(self, jobs, tasks=True):
+        '''
+        Job records from the ('job', 'tasks') fields read from their
+        hashes, with their tasks (if wanted) read in one round trip.
+        Records written before the tasks were kept apart hold them whole,
+        and maybe out of date: they're read afresh all the same.
+        '''
+        records = []
+        pipe = self.db.pipeline(transaction=False)
+        for record, task_ids in jobs:
+            record = self.codec.loads(record)
+            if task_ids is not None:
+                task_ids = self.codec.loads(task_ids)
+            else:
+                task_ids = [task['id'] for task in record.get('tasks') or []]
+            if not tasks:
+                record.pop('tasks', None)
+                task_ids = []
+            for task_id in task_ids:
+                pipe.hget(task_id, 'task')
+            records.append((record, len(task_ids)))
+        found = iter(pipe.execute())
+        for record, count in records:
+            if count:
+                record['tasks'] = [self.codec.loads(task) for task
+                                   in islice(found, count)
+                                   if task is not None]
+        return [record for record, count in records]
+
+    def findjobs(self, job_ids):
+        '''Those of the given job ids which are in the database.'''
+        pipe = self.db.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hexists(job_id, 'job')
+        return [job_id for job_id, found in zip(job_ids, pipe.execute())
+                if found]
     
     def gettask(self, taskid):
         ret = self.db.hget(taskid, 'task')
@@ -62,133 +404,631 @@ class HubRedis(HubDatabase):
         ret = self.db.hget(taskid, 'parent_id')
         return ret
     
-    def getincompletetasks(self):
-        ret = self.db.smembers('INCOMPLETE')
-        return ret
+    def gettaskdeadlines(self, until=None, limit=None):
+        '''
+        Return (task id, job id, deadline) of incomplete tasks with a
+        deadline no later than until, soonest first
+        '''
+        until = '+inf' if until is None else until
+        if limit:
+            found = self.db.zrangebyscore('DEADLINES', '-inf', until, start=0,
+                                          num=int(limit), withscores=True)
+        else:
+            found = self.db.zrangebyscore('DEADLINES', '-inf', until,
+                                          withscores=True)
+        pipe = self.db.pipeline(transaction=False)
+        for task_id, deadline in found:
+            pipe.hget(task_id, 'parent_id')
+        return [(task_id, job_id, deadline) for (task_id, deadline), job_id
+                in zip(found, pipe.execute())]
+
+    def heartbeat(self, instance, ttl):
+        '''
+        Record a dispatcher instance as live for ttl seconds and return
+        the ids of every live instance
+        '''
+        now = time.time()
+        pipe = self.db.pipeline(transaction=True)
+        pipe.zadd('INSTANCES', {instance: now + ttl})
+        pipe.zremrangebyscore('INSTANCES', '-inf', '({0}'.format(now))
+        pipe.zrange('INSTANCES', 0, -1)
+        return pipe.execute()[-1]
+
+    def retire(self, instance):
+        self.db.zrem('INSTANCES', instance)
+
+    def acquirelease(self, shard, owner, ttl):
+        '''
+        Take, or renew, the lease on a shard for ttl seconds if it's free,
+        expired or already owner's. Returns True if owner holds it.
+        '''
+        return bool(self.db.eval(self.ACQUIRE_LEASE, 1,
+                                 'lease:{0}'.format(shard), owner,
+                                 int(ttl * 1000)))
+
+    def releaselease(self, shard, owner):
+        self.db.eval(self.RELEASE_LEASE, 1, 'lease:{0}'.format(shard), owner)
+
+    def putresult(self, key, task_name, value, ttl, version=''):
+        '''
+        Cache a task result under key for ttl seconds, made by the given
+        version of the task
+        '''
+        pipe = self.db.pipeline(transaction=True)
+        pipe.set('result:' + key, self.codec.dumps(value),
+                 px=max(int(ttl * 1000), 1))
+        pipe.zadd('RESULTS', {key: time.time()})
+        pipe.hset('RESULT_VERSIONS', task_name, version)
+        pipe.execute()
+
+    def getresult(self, key):
+        '''
+        Return [value] of the task result cached under key, or None if
+        there isn't one
+        '''
+        value = self.db.get('result:' + key)
+        if value is None:
+            return None
+        return [self.codec.loads(value)]
+
+    def touchresults(self, used):
+        '''Record when cached results were last used, given by key.'''
+        self.db.zadd('RESULTS', used, xx=True)
+
+    def getresulttypes(self):
+        '''
+        The names of the tasks results have been cached for, mapped to
+        the version of the task which made the latest
+        '''
+        return self.db.hgetall('RESULT_VERSIONS')
+
+    def dropresulttype(self, task_name):
+        '''Stop caching results of a task.'''
+        self.db.hdel('RESULT_VERSIONS', task_name)
+
+    def trimresults(self, max_entries):
+        '''Drop the least recently used cached results beyond max_entries.'''
+        excess = self.db.zcard('RESULTS') - max_entries
+        if excess <= 0:
+            return
+        keys = self.db.zrange('RESULTS', 0, excess - 1)
+        pipe = self.db.pipeline(transaction=True)
+        pipe.delete(*['result:' + key for key in keys])
+        pipe.zrem('RESULTS', *keys)
+        pipe.execute()
+
+    def searchjobs(self, status=None, name=None, since=None, until=None,
+                   fields=None, task_fields=None, after=None, limit=100):
+        '''
+        Return a page of up to limit job records matching the filters, by
+        start time, and the cursor to pass as after for the next page
+        (None after the last page). Jobs are found through the JOBS sorted
+        set and filtered on their status, name and start_time fields
+        before their records are read.
+        '''
+        if isinstance(status, basestring):
+            status = [status]
+        limit = int(limit)
+        if after is not None:
+            start = int(after)
+        elif since is not None:
+            start = self.db.zcount('JOBS', '-inf', '({0}'.format(since))
+        else:
+            start = 0
+        matches = []
+        while len(matches) < limit:
+            found = self.db.zrange('JOBS', start, start + limit - 1,
+                                   withscores=True)
+            if not found:
+                return self._records(matches, fields, task_fields), None
+            pipe = self.db.pipeline(transaction=False)
+            for job_id, start_time in found:
+                pipe.hmget(job_id, 'status', 'name')
+            for (job_id, start_time), (job_status, job_name) in \
+                    zip(found, pipe.execute()):
+                if until is not None and start_time > until:
+                    return self._records(matches, fields, task_fields), None
+                start += 1
+                if status is not None and job_status not in status:
+                    continue
+                if name is not None and job_name != name:
+                    continue
+                matches.append(job_id)
+                if len(matches) == limit:
+                    break
+        return self._records(matches, fields, task_fields), start
+
+    def _records(self, job_ids, fields, task_fields):
+        pipe = self.db.pipeline(transaction=False)
+        for job_id in job_ids:
+            pipe.hmget(job_id, 'job', 'tasks')
+        jobs = [(record, task_ids) for record, task_ids in pipe.execute()
+                if record is not None]
+        records = self._assemble(jobs, fields is None or 'tasks' in fields)
+        return [project(record, fields, task_fields) for record in records]
     
 class HubSqlite(HubDatabase):
+    '''
+    SQLite backend. Well known fields are native, indexed columns; any
+    other fields are kept as a JSON blob in the 'extra' column.
+    '''
+    SCHEMA_VERSION = 1
+    # Dispatcher instances and the shards they hold (see hub.lib.sharding)
+    LEASE_SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS hub_leases (
+               shard INTEGER PRIMARY KEY,
+               owner TEXT,
+               expires REAL)""",
+        """CREATE TABLE IF NOT EXISTS hub_instances (
+               id TEXT PRIMARY KEY,
+               expires REAL)""",
+    )
+    # Cached results of tasks declared cacheable (see hub.lib.resultstore)
+    RESULT_SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS hub_result_cache (
+               key TEXT PRIMARY KEY,
+               task_name TEXT,
+               value BLOB,
+               expires REAL,
+               used REAL)""",
+        "CREATE INDEX IF NOT EXISTS hub_result_cache_used ON hub_result_cache (used)",
+        """CREATE TABLE IF NOT EXISTS hub_result_types (
+               task_name TEXT PRIMARY KEY,
+               version TEXT)""",
+    )
+    JOB_COLUMNS = ('id', 'name', 'status', 'start_time', 'end_time')
+    TASK_COLUMNS = ('id', 'parent_id', 'name', 'task_name', 'status',
+                    'start_time', 'end_time', 'timeout')
+    # hub_jobs(id) is indexed by virtue of being the primary key
+    SCHEMA = (
+        """CREATE TABLE IF NOT EXISTS hub_jobs (
+               id TEXT PRIMARY KEY,
+               name TEXT,
+               status TEXT,
+               start_time REAL,
+               end_time REAL,
+               extra TEXT)""",
+        """CREATE TABLE IF NOT EXISTS hub_tasks (
+               id TEXT PRIMARY KEY,
+               parent_id TEXT,
+               name TEXT,
+               task_name TEXT,
+               status TEXT,
+               start_time REAL,
+               end_time REAL,
+               timeout REAL,
+               deadline REAL,
+               extra TEXT)""",
+        "CREATE INDEX IF NOT EXISTS hub_tasks_parent_id ON hub_tasks (parent_id)",
+        "CREATE INDEX IF NOT EXISTS hub_tasks_status ON hub_tasks (status)",
+        "CREATE INDEX IF NOT EXISTS hub_tasks_deadline ON hub_tasks (deadline)",
+        "CREATE INDEX IF NOT EXISTS hub_jobs_status ON hub_jobs (status)",
+        "CREATE INDEX IF NOT EXISTS hub_jobs_start_time ON hub_jobs (start_time)",
+    ) + LEASE_SCHEMA + RESULT_SCHEMA
+    INSERT_JOB = "INSERT INTO hub_jobs ({0}, extra) VALUES ({1}?)".format(
+        ', '.join(JOB_COLUMNS), '?, ' * len(JOB_COLUMNS))
+    # The deadline column is derived, it's set only while a task is running
+    # or waiting to be retried
+    INSERT_TASK = ("INSERT INTO hub_tasks ({0}, deadline, extra) "
+                   "VALUES ({1}?, ?)".format(', '.join(TASK_COLUMNS),
+                                             '?, ' * len(TASK_COLUMNS)))
+    UPDATE_JOB = "UPDATE hub_jobs SET {0}=?, extra=? WHERE id=?".format(
+        '=?, '.join(JOB_COLUMNS))
+    UPDATE_TASK = ("UPDATE hub_tasks SET {0}=?, deadline=?, extra=? "
+                   "WHERE id=?".format('=?, '.join(TASK_COLUMNS)))
     
-    def __init__(self, host, port, instance, user=None, password=None ):
+    def __init__(self, host, port, instance, user=None, password=None,
+                 **options):
         self.host = host
         self.user = user
         self.password = password
+        # Records are returned in this encoding, and the extra column too
+        # unless it's json
+        self.codec = serializer.get_codec(options.get('serializer'))
+        self._depth = 0
         import sqlite3
-        self.conn = sqlite3.connect(self.host)
+        # Handles are pooled and may be checked out by any thread, but
+        # never by two at once. Transactions are managed explicitly.
+        self.conn = sqlite3.connect(self.host, check_same_thread=False,
+                                    isolation_level=None)
         self.conn.row_factory = self._dict_factory
         self.db = self.conn.cursor()
+        self.connection_errors = (sqlite3.OperationalError,
+                                  sqlite3.ProgrammingError)
         self.log = logging.getLogger(__name__)
-        
+        # Let status lookups read while results are being written
+        self.db.execute('PRAGMA journal_mode=WAL')
+        self.db.execute('PRAGMA synchronous=NORMAL')
+        self._setup_schema()
+
+    def close(self):
+        self.conn.close()
+
+    def begin(self):
+        '''
+        Start a unit of work; units started inside it join its transaction
+        '''
+        if self._depth == 0:
+            self.db.execute('BEGIN')
+        self._depth += 1
+
+    def commit(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self.db.execute('COMMIT')
+
+    def rollback(self):
+        self._depth -= 1
+        if self._depth == 0:
+            self.db.execute('ROLLBACK')
+
     def _dict_factory(self, cursor, row):
         d = {}
         for idx, col in enumerate(cursor.description):
             d[col[0]] = row[idx]
         return d
+
+    def _schema_version(self):
+        return self.db.execute('PRAGMA user_version').fetchone()[
+            'user_version']
+
+    def _setup_schema(self):
+        '''
+        Create the schema on an empty database, upgrade tables from before
+        the schema was managed and refuse an unknown version
+        '''
+        if self._schema_version() == self.SCHEMA_VERSION:
+            return
+        # Other handles may be setting up the same file at the same time;
+        # only one at a time gets past here, and finds out what the last
+        # one did
+        self.db.execute('BEGIN IMMEDIATE')
+        try:
+            self._create_schema(self._schema_version())
+        except:
+            self.db.execute('ROLLBACK')
+            raise
+        self.db.execute('COMMIT')
+
+    def _create_schema(self, version):
+        if version == self.SCHEMA_VERSION:
+            return
+        if version != 0:
+            raise error.DatabaseError(
+                'Database {0} has schema version {1}, expected {2}'.format(
+                    self.host, version, self.SCHEMA_VERSION))
+        self.db.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                        "AND name IN ('hub_jobs', 'hub_tasks')")
+        tables = [row['name'] for row in self.db.fetchall()]
+        if tables:
+            self.log.info('Upgrading database {0} to schema version {1}'.format(
+                          self.host, self.SCHEMA_VERSION))
+            self._migrate(tables)
+        else:
+            for statement in self.SCHEMA:
+                self.db.execute(statement)
+        self.db.execute('PRAGMA user_version={0}'.format(self.SCHEMA_VERSION))
+
+    def _migrate(self, tables):
+        '''
+        Copy jobs and tasks out of tables from before the schema was
+        managed, with a column of JSON per field, into the schema
+        '''
+        for table in tables:
+            self.db.execute('ALTER TABLE {0} RENAME TO {0}_old'.format(table))
+        for statement in self.SCHEMA:
+            self.db.execute(statement)
+        old = self.conn.cursor()
+        if 'hub_jobs' in tables:
+            old.execute('SELECT * FROM hub_jobs_old')
+            self.db.executemany(self.INSERT_JOB, (
+                self._row(self._old_state(row), self.JOB_COLUMNS)
+                for row in old))
+            self.db.execute('DROP TABLE hub_jobs_old')
+        if 'hub_tasks' in tables:
+            old.execute('SELECT * FROM hub_tasks_old')
+            self.db.executemany(self.INSERT_TASK, (
+                self._task_row(self._old_state(row)) for row in old))
+            self.db.execute('DROP TABLE hub_tasks_old')
+
+    def _old_state(self, row):
+        return dict((k, json.loads(v)) for k, v in row.iteritems()
+                    if v is not None)
+
+    def _row(self, state, columns, exclude=()):
+        '''
+        Split a state into native column values and a blob of the rest,
+        JSON text or, with a binary codec, a BLOB
+        '''
+        values = [state.get(k) for k in columns]
+        extra = dict((k, v) for k, v in state.iteritems()
+                     if k not in columns and k not in exclude)
+        if self.codec.content_type == serializer.JSON:
+            values.append(json.dumps(extra))
+        else:
+            values.append(buffer(self.codec.dumps(extra)))
+        return values
+
+    def _task_row(self, state):
+        values = self._row(state, self.TASK_COLUMNS)
+        deadline = None
+        if state.get('status') in ('SUBMITTED', 'RUNNING', 'RETRYING'):
+            deadline = self._deadline(state)
+        values.insert(-1, deadline)
+        return values
+
+    def _record(self, row):
+        '''
+        Merge a row's native columns and blob back into one dict
+        '''
+        extra = row.pop('extra')
+        row.pop('deadline', None)
+        record = dict((k, v) for k, v in row.iteritems() if v is not None)
+        if isinstance(extra, buffer):
+            record.update(self.codec.loads(str(extra)))
+        elif extra:
+            record.update(json.loads(extra))
+        return record
     
     def putjob(self,job):
-        for task in job.state.tasks:
-            keys = []
-            values =[]
-            for k, v in task.state._state.iteritems():
-                keys.append(str(k))
-                values.append(json.dumps(v))
-            columns = ', '.join(task.state._state.keys())
-            qmarks = ', '.join('?' * len(task.state._state))
-
-            qry = "INSERT INTO hub_tasks ({0}) VALUES ({1})".format(columns,qmarks)
-            self.db.execute(qry, tuple(values))
-        keys = []
-        tasks = job.state._state.pop('tasks')
-        values=[]
-        for k, v in job.state._state.iteritems():
-            keys.append(str(k))
-            values.append(json.dumps(v))
-        columns = ', '.join(job.state._state.keys())
-        qmarks = ', '.join('?' * len(job.state._state))
-        job.state._state['tasks'] = tasks
-        qry = "INSERT INTO hub_jobs ({0}) VALUES ({1})".format(columns,qmarks)
-        self.db.execute(qry, tuple(values))
-        self.conn.commit()
+        with self.transaction():
+            self.db.executemany(self.INSERT_TASK, [
+                self._task_row(task.state._state)
+                for task in job.state.tasks])
+            values = self._row(job.state._state, self.JOB_COLUMNS,
+                               exclude=('tasks',))
+            self.db.execute(self.INSERT_JOB, values)
         
     def updatejob(self,job):
-        for task in job.state.tasks:
-            keys = []
-            values =[]
-            for k, v in task.state._state.iteritems():
-                keys.append(str(k))
-                values.append(json.dumps(v))
-            columns = '=?,'.join(task.state._state.keys()) + '=?'
-            qry = "UPDATE hub_tasks SET {0} WHERE id=?".format(columns)
-            values.append(json.dumps(task.state.id))
-            self.db.execute(qry, tuple(values))
-        keys = []
-        tasks = job.state._state.pop('tasks')
-        values=[]
-        for k, v in job.state._state.iteritems():
-            keys.append(str(k))
-            values.append(json.dumps(v))
-        columns = '=?,'.join(job.state._state.keys()) + '=?'
-        job.state._state['tasks'] = tasks
-        qry = "UPDATE hub_jobs SET {0} WHERE id=?".format(columns)
-        values.append(json.dumps(job.state.id))
-        self.db.execute(qry, tuple(values))
-        self.conn.commit()
+        '''
+        Rewrite only the rows of tasks changed since the job was loaded or
+        last written; whole rows keep the statements cacheable
+        '''
+        rows = []
+        for task in job.dirty_tasks():
+            values = self._task_row(task.state._state)
+            values.append(task.state.id)
+            rows.append(values)
+        with self.transaction():
+            self.db.executemany(self.UPDATE_TASK, rows)
+            if [k for k in job.state.get_dirty() if k != 'tasks']:
+                values = self._row(job.state._state, self.JOB_COLUMNS,
+                                   exclude=('tasks',))
+                values.append(job.state.id)
+                self.db.execute(self.UPDATE_JOB, values)
 
     def getjob(self,jobid):
-        qry = "SELECT * FROM hub_tasks WHERE parent_id='{0}'".format(json.dumps(jobid))
-        self.db.execute(qry)
-        tasks = self.db.fetchall()
-        for task in tasks:
-            dellist=[]
-            for k,v in task.iteritems():
-                if v is None:
-                    dellist.append(k)
-            for k in dellist:
-                task.pop(k) 
-            for k,v in task.iteritems():
-                task[k]=json.loads(v.encode())
-        
-        qry = "SELECT * FROM hub_jobs WHERE id='{0}'".format(json.dumps(jobid))
-        self.db.execute(qry)
+        self.db.execute("SELECT * FROM hub_jobs WHERE id=?", (jobid,))
         job = self.db.fetchone()
         if job is None:
-            ret = None
-        else:
+            return None
+        job = self._record(job)
+        self.db.execute("SELECT * FROM hub_tasks WHERE parent_id=? "
+                        "ORDER BY rowid", (jobid,))
+        job['tasks'] = [self._record(task) for task in self.db.fetchall()]
+        return self.codec.dumps(job)
 
-            dellist=[]
-            for k,v in job.iteritems():
-                if v is None:
-                    dellist.append(k)
-            for k in dellist:
-                job.pop(k) 
-
-            for k,v in job.iteritems():
-                job[k]=json.loads(v.encode())
-            job['tasks'] = tasks
-            ret = json.dumps(job)
-        return ret
+    def findjobs(self, job_ids):
+        '''Those of the given job ids which are in the database.'''
+        found = []
+        # SQLite takes at most 999 parameters
+        for i in range(0, len(job_ids), 500):
+            chunk = job_ids[i:i + 500]
+            self.db.execute("SELECT id FROM hub_jobs WHERE id IN ({0})".format(
+                            ', '.join('?' * len(chunk))), chunk)
+            found.extend(row['id'] for row in self.db.fetchall())
+        return found
         
     def getjobid(self, taskid):
-        qry = "SELECT parent_id FROM hub_tasks WHERE id='{0}'".format(json.dumps(taskid))
-        self.db.execute(qry)
-        ret = json.loads(self.db.fetchone()['parent_id'])
-        return ret
+        self.db.execute("SELECT parent_id FROM hub_tasks WHERE id=?", (taskid,))
+        row = self.db.fetchone()
+        if row is None:
+            return None
+        return row['parent_id']
     
-    def getincompletetasks(self):
-        qry = "SELECT id FROM hub_tasks WHERE status='\"SUBMITTED\"' or status='\"RUNNING\"'"
-        ret = []
-        for row in self.db.execute(qry):
-            ret.append(json.loads(row['id']))
-        return ret
+    def gettaskdeadlines(self, until=None, limit=None):
+        '''
+        Return (task id, job id, deadline) of incomplete tasks with a
+        deadline no later than until, soonest first
+        '''
+        qry = "SELECT id, parent_id, deadline FROM hub_tasks " \
+              "WHERE deadline IS NOT NULL"
+        params = []
+        if until is not None:
+            qry += " AND deadline <= ?"
+            params.append(until)
+        qry += " ORDER BY deadline"
+        if limit:
+            qry += " LIMIT ?"
+            params.append(int(limit))
+        return [(row['id'], row['parent_id'], row['deadline'])
+                for row in self.db.execute(qry, params)]
+
+    def heartbeat(self, instance, ttl):
+        '''
+        Record a dispatcher instance as live for ttl seconds and return
+        the ids of every live instance
+        '''
+        now = time.time()
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO hub_instances (id, expires) "
+                            "VALUES (?, ?)", (instance, now + ttl))
+            self.db.execute("DELETE FROM hub_instances WHERE expires < ?",
+                            (now,))
+        return [row['id'] for row in self.db.execute(
+                "SELECT id FROM hub_instances").fetchall()]
+
+    def retire(self, instance):
+        with self.transaction():
+            self.db.execute("DELETE FROM hub_instances WHERE id=?", (instance,))
+
+    def acquirelease(self, shard, owner, ttl):
+        '''
+        Take, or renew, the lease on a shard for ttl seconds if it's free,
+        expired or already owner's. Returns True if owner holds it.
+        '''
+        now = time.time()
+        with self.transaction():
+            self.db.execute("INSERT OR IGNORE INTO hub_leases (shard, owner, "
+                            "expires) VALUES (?, NULL, 0)", (shard,))
+            self.db.execute("UPDATE hub_leases SET owner=?, expires=? "
+                            "WHERE shard=? AND (owner=? OR owner IS NULL "
+                            "OR expires < ?)",
+                            (owner, now + ttl, shard, owner, now))
+            taken = self.db.rowcount == 1
+        return taken
+
+    def releaselease(self, shard, owner):
+        with self.transaction():
+            self.db.execute("UPDATE hub_leases SET owner=NULL, expires=0 "
+                            "WHERE shard=? AND owner=?", (shard, owner))
+
+    def putresult(self, key, task_name, value, ttl, version=''):
+        '''
+        Cache a task result under key for ttl seconds, made by the given
+        version of the task
+        '''
+        now = time.time()
+        if self.codec.content_type == serializer.JSON:
+            value = json.dumps(value)
+        else:
+            value = buffer(self.codec.dumps(value))
+        with self.transaction():
+            self.db.execute("INSERT OR REPLACE INTO hub_result_cache (key, "
+                            "task_name, value, expires, used) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (key, task_name, value, now + ttl, now))
+            self.db.execute("INSERT OR REPLACE INTO hub_result_types "
+                            "(task_name, version) VALUES (?, ?)",
+                            (task_name, version))
+
+    def getresult(self, key):
+        '''
+        Return [value] of the task result cached under key, or None if
+        there isn't one
+        '''
+        row = self.db.execute("SELECT value FROM hub_result_cache "
+                              "WHERE key=? AND expires > ?",
+                              (key, time.time())).fetchone()
+        if row is None:
+            return None
+        if isinstance(row['value'], buffer):
+            return [self.codec.loads(str(row['value']))]
+        return [json.loads(row['value'])]
+
+    def touchresults(self, used):
+        '''Record when cached results were last used, given by key.'''
+        with self.transaction():
+            self.db.executemany("UPDATE hub_result_cache SET used=? "
+                                "WHERE key=?",
+                                [(when, key) for key, when in used.items()])
+
+    def getresulttypes(self):
+        '''
+        The names of the tasks results are cached for, mapped to the
+        version of the task which made the latest
+        '''
+        return dict((row['task_name'], row['version']) for row in
+                    self.db.execute("SELECT task_name, version FROM "
+                                    "hub_result_types").fetchall())
+
+    def dropresulttype(self, task_name):
+        '''Stop caching results of a task, and drop those cached.'''
+        with self.transaction():
+            self.db.execute("DELETE FROM hub_result_types WHERE task_name=?",
+                            (task_name,))
+            self.db.execute("DELETE FROM hub_result_cache WHERE task_name=?",
+                            (task_name,))
+
+    def trimresults(self, max_entries):
+        '''
+        Drop expired cached results, and the least recently used beyond
+        max_entries
+        '''
+        with self.transaction():
+            self.db.execute("DELETE FROM hub_result_cache WHERE expires <= ?",
+                            (time.time(),))
+            self.db.execute("DELETE FROM hub_result_cache WHERE key IN "
+                            "(SELECT key FROM hub_result_cache "
+                            "ORDER BY used DESC LIMIT -1 OFFSET ?)",
+                            (int(max_entries),))
+
+    def _columns(self, fields, columns):
+        '''
+        Columns to select for the given fields; just those if they're all
+        native columns, so the extra blob needn't be read
+        '''
+        if fields is not None and set(fields) <= set(columns):
+            return ', '.join(fields)
+        return '*'
+
+    def searchjobs(self, status=None, name=None, since=None, until=None,
+                   fields=None, task_fields=None, after=None, limit=100):
+        '''
+        Return a page of up to limit job records matching the filters, in
+        the order they were created, and the cursor to pass as after for
+        the next page (None after the last page). status may be a list;
+        since and until bound the job start time. Records are cut down to
+        fields and task_fields (see jobs.project).
+        '''
+        conditions = []
+        params = []
+        if status is not None:
+            if isinstance(status, basestring):
+                status = [status]
+            conditions.append('status IN ({0})'.format(
+                              ', '.join('?' * len(status))))
+            params.extend(status)
+        if name is not None:
+            conditions.append('name = ?')
+            params.append(name)
+        if since is not None:
+            conditions.append('start_time >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('start_time <= ?')
+            params.append(until)
+        if after is not None:
+            conditions.append('rowid > ?')
+            params.append(int(after))
+        qry = 'SELECT rowid AS cursor, {0} FROM hub_jobs'.format(
+              self._columns(fields, self.JOB_COLUMNS))
+        if conditions:
+            qry += ' WHERE ' + ' AND '.join(conditions)
+        # One more than asked for, to tell whether there's another page
+        qry += ' ORDER BY rowid LIMIT ?'
+        params.append(int(limit) + 1)
+        rows = self.db.execute(qry, params).fetchall()
+        cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            cursor = rows[-1]['cursor']
+        jobs = []
+        for row in rows:
+            row.pop('cursor')
+            if 'extra' in row:
+                jobs.append(self._record(row))
+            else:
+                jobs.append(dict((k, v) for k, v in row.iteritems()
+                                 if v is not None))
+        if jobs and (fields is None or 'tasks' in fields):
+            self._add_tasks(jobs, task_fields)
+        return [project(job, fields, task_fields) for job in jobs], cursor
 
-#        for k, v in job.state._state.iteritems():
-#            self.log.info('k: {0}, v: {1}'.format(k,v))
-#            if k == 'tasks':
-#                pass
-#            else:
-#                self.db.execute('INSERT INTO hub_jobs ({0}) VALUES ({1})'.format(k,v))
-#            for task in job.state.tasks:
-#                for k, v in task.state._state.iteritems():
-#                    self.db.execute('INSERT INTO hub_tasks ({0}) VALUES ({1})'.format(k,v))
-    #def getjob(self, jobid):
-     #   tasks = 
-        
\ No newline at end of file
+    def _add_tasks(self, jobs, task_fields):
+        by_id = {}
+        for job in jobs:
+            job['tasks'] = []
+            by_id[job['id']] = job
+        columns = self._columns(task_fields, self.TASK_COLUMNS)
+        if columns != '*' and 'parent_id' not in task_fields:
+            columns += ', parent_id'
+        qry = 'SELECT {0} FROM hub_tasks WHERE parent_id IN ({1}) ' \
+              'ORDER BY rowid'.format(columns, ', '.join('?' * len(by_id)))
+        for row in self.db.execute(qry, by_id.keys()).fetchall():
+            if 'extra' in row:
+                task = self._record(row)
+            else:
+                task = dict((k, v) for k, v in row.iteritems()
+                            if v is not None)
+            by_id[row['parent_id']]['tasks'].append(task)
@@ -5,22 +5,40 @@ This is the Hub dispatcher which performs job management functions
 # core modules
 import sys
 import uuid
+import random
 import logging
 import traceback
 import time
 import threading
+import functools
 
 # own modules
 import hub.lib.error as error
 import hub.lib.config as config
-from hub.lib.jobs import Job
+from hub.lib.jobs import Job, FINISHED, project
 from hub.lib.tasks import Task
 from hub.lib.common import Daemon
+from hub.lib.database import HubDatabasePool
+from hub.lib.jobstore import JobCache, JobWriter
+from hub.lib.scheduler import Scheduler
+from hub.lib.sharding import ShardMap
+from hub.lib.resultstore import ResultCache
+from hub.lib.publisher import CONNECTION_ERRORS
+import hub.lib.serializer as serializer
+import hub.lib.routing as routing
+import hub.lib.blobstore as blobstore
 
 # 3rd party modules
 import pika
 import json
 
+CONFIG_FILE = '/usr/local/pkg/hub/etc/dispatcher.conf'
+# Ids of jobs submitted without one are derived from the submitting
+# message's correlation id, so a redelivered submission names the same jobs
+JOB_NAMESPACE = uuid.UUID('9b7b4a1e-4f0c-4c4e-9d55-1f7f2a0c6e3d')
+# Queue messages the dispatcher can't handle are set aside in
+DEAD_LETTERS = 'hub_dead_letters'
+
 
 class DispatcherDaemon(Daemon):
     '''
@@ -39,7 +57,14 @@ class Dispatcher():
     '''
     Class representing dispatcher that performs job management functions
     '''
-    def __init__(self):
+    # Seconds to wait before taking more messages when one had to be put
+    # back for want of the database or the broker
+    retry_interval = 1
+    # Ids of the jobs the message being handled has read or changed, or
+    # None between messages
+    _touched = None
+
+    def __init__(self, config_file=CONFIG_FILE):
         '''
         Setup connection to broker and listen for incoming jobs and results
         '''
@@ -47,7 +72,7 @@ class Dispatcher():
         self.registered_jobs = {}
         # Setup config
         try:
-            self.conf = config.setup('/usr/local/pkg/hub/etc/dispatcher.conf')
+            self.conf = config.setup(config_file)
         except error.ConfigError, e:
             print e.msg
             raise e
@@ -56,69 +81,554 @@ class Dispatcher():
         self.databasePort = self.conf.get('DATABASE','port')
         self.databaseInstance = self.conf.get('DATABASE','instance')
         
+        # Encoding of the tasks sent to workers; replies to clients are
+        # sent in whatever encoding they asked in
+        self.codec = serializer.get_codec(
+            self.conf.get('HUB', 'serializer', 'json'))
+        # Encoding of job records kept by the database
+        db_serializer = self.conf.get('DATABASE', 'serializer', 'json')
+        self.db_codec = serializer.get_codec(db_serializer)
         self.databaseModule = __import__('hub.lib.database',fromlist = [self.databaseType])
         self.db = getattr(self.databaseModule, self.databaseType)
-        self.ct_lock = threading.Lock()
-        
-        #threading.Thread(target=self._caretaker).start()
-        #self._caretaker()
+        # Seconds over which writes from bursts of messages are coalesced
+        self.commit_interval = float(
+            self.conf.get('DATABASE', 'commit_interval', 0))
+        self.pool = HubDatabasePool(self.db, self.databaseHost,
+                                    self.databasePort, self.databaseInstance,
+                                    self.conf.get('DATABASE', 'pool_size', 4),
+                                    serializer=db_serializer)
+        # Live jobs are kept in memory and written to the database behind
+        # the scenes; it is only read for jobs which aren't cached
+        self.cache = JobCache(self.conf.get('DATABASE', 'job_cache_size', 1000))
+        self.writer = JobWriter(self.pool, self.commit_interval)
+        # Held while handling a message or a scheduled call
+        self.job_lock = threading.RLock()
+        # Fails tasks which run past their timeout. Its calls are run on
+        # the connection thread, as the channel isn't thread safe
+        self.scheduler = Scheduler(self._handoff)
+        # Seconds between sweeps of the database for overdue tasks, and
+        # how many to expire per query
+        self.caretaker_interval = float(
+            self.conf.get('HUB', 'caretaker_interval', 60))
+        self.caretaker_batch = int(self.conf.get('HUB', 'caretaker_batch', 500))
+        # Jobs returned per page of a status query by default, and at most
+        self.search_page_size = int(
+            self.conf.get('HUB', 'search_page_size', 100))
+        self.search_page_limit = int(
+            self.conf.get('HUB', 'search_page_limit', 1000))
+        # Where workers keep large task data, for resolving job output
+        self.blobs = blobstore.setup(self.conf)
+        # With shards set, jobs are split between however many dispatcher
+        # instances are running (see hub.lib.sharding); every instance
+        # must be given the same number
+        self.shards = None
+        shards = int(self.conf.get('HUB', 'shards', 0))
+        if shards:
+            self.shards = ShardMap(self.pool, shards,
+                                   self.conf.get('HUB', 'instance_id', ''),
+                                   self.conf.get('HUB', 'lease_ttl', 30))
+        # Shard -> [(queue, consumer tag)] of its queues being consumed
+        self.consumers = {}
+        # Messages are acknowledged a batch at a time, once the job changes
+        # they made are in the database: after half of prefetch messages
+        # or ack_interval seconds, whichever comes first
+        self.prefetch = int(self.conf.get('HUB', 'prefetch', 200))
+        self.ack_interval = float(self.conf.get('HUB', 'ack_interval', 0.2))
+        # (method, properties, body, ids of the jobs it touched) of each
+        # message handled but not yet acknowledged
+        self._unacked = []
+        # Priority levels of the task queues (0 for none); workers must be
+        # given the same number
+        self.task_priorities = int(self.conf.get('HUB', 'task_priorities', 0))
+        # Longest a failed task waits to be retried, in seconds
+        self.max_backoff = float(self.conf.get('HUB', 'max_backoff', 3600))
+        # Results of tasks declared cacheable, reused for the same task run
+        # with the same arguments; result_cache_size=0 turns this off
+        self.results = None
+        result_cache_size = int(
+            self.conf.get('HUB', 'result_cache_size', 10000))
+        if result_cache_size:
+            self.results = ResultCache(
+                self.pool, self.conf.get('HUB', 'result_cache_ttl', 86400),
+                result_cache_size)
 
-    def _caretaker(self):
-        self.log.info("Caretaker waiting on lock...")
-        
-        self.ct_lock.acquire()
-        self.log.info("Caretaker Running...")
-        dbI=self.db(self.databaseHost,self.databasePort,self.databaseInstance)
-        incomplete = dbI.getincompletetasks()
-        for task_id in incomplete:
-            jobid = dbI.getjobid(task_id)
-            jobrecord = dbI.getjob(jobid)
-            #TODO get task record not job record
-            job = Job().load(jobrecord)
-            for task in job.state.tasks:
-                if task.state.id == task_id and task.state.timeout and task.state.start_time:
-                    if task.state.timeout < (time.time() - task.state.start_time):
-                        self.log.info("Setting task {0} from job {1} as FAILED".format(task.state.id,job.state.id))
-                        task.state.status = 'FAILED'
-                        task.state.end_time = time.time()
-                        job.state.status = 'FAILED'
-                        job.state.end_time = time.time()                        
-                        job.save()
-                        dbI.updatejob(job)
-        self.ct_lock.release()            
+    def _caretaker(self, shard=None):
+        '''
+        Rebuild the deadlines of incomplete tasks (of one shard's jobs if
+        given) from the database's deadline index, e.g. after a restart.
+        Tasks which are already overdue expire at once.
+        '''
+        self.log.info("Caretaker restoring task deadlines...")
+        for task_id, jobid, deadline in self.pool.call('gettaskdeadlines'):
+            if shard is not None and self.shards.shard_of(jobid) != shard:
+                continue
+            self.scheduler.schedule(task_id, deadline, self._expire_task,
+                                    jobid, task_id)
+
+    def _sweep(self):
+        '''
+        Expire tasks the database says are overdue, a batch at a time,
+        in case the scheduler missed them. Only their own jobs are loaded.
+        '''
+        now = time.time()
+        seen = set()
+        try:
+            while True:
+                overdue = self.pool.call('gettaskdeadlines', now,
+                                         self.caretaker_batch)
+                # Tasks which can't be expired (e.g. their job is gone)
+                # come back every time
+                fresh = [t for t in overdue if t[0] not in seen]
+                for task_id, jobid, deadline in fresh:
+                    seen.add(task_id)
+                    if not self._owns(jobid):
+                        continue
+                    self.scheduler.cancel(task_id)
+                    self._expire_task(jobid, task_id)
+                if not fresh or len(overdue) < self.caretaker_batch:
+                    break
+                # Once written, expired tasks drop out of the index
+                self.writer.barrier()
+            if seen:
+                self.log.info("Caretaker expired {0} tasks".format(len(seen)))
+        finally:
+            self.scheduler.schedule('caretaker',
+                                    time.time() + self.caretaker_interval,
+                                    self._sweep)
+
+    def _handoff(self, callback, args):
+        '''Have the connection thread run a scheduled call which is due.'''
+        self.conn.add_callback_threadsafe(functools.partial(callback, *args))
+
+    def _watch_timeout(self, job, task):
+        '''
+        Schedule a submitted task to be failed if it's still incomplete
+        once its timeout is up
+        '''
+        if task.state.timeout and task.state.start_time:
+            self.log.debug("Task {0} timeout in {1}".format(
+                           task.state.id, str(task.state.timeout)))
+            self.scheduler.schedule(
+                task.state.id, task.state.start_time + task.state.timeout,
+                self._expire_task, job.state.id, task.state.id)
+
+    def _task_done(self, task):
+        '''Stop watching a task's timeout once it has finished.'''
+        if task.state.status in FINISHED:
+            self.scheduler.cancel(task.state.id)
+
+    def _expire_task(self, job_id, task_id):
+        '''
+        Fail a task, and its job, which has run past its timeout (unless
+        it is to be retried), or resubmit a task whose retry is due
+        '''
+        with self.job_lock:
+            if not self._owns(job_id):
+                return
+            job = self._get_job(job_id)
+            if job is None:
+                return
+            task = job.get_task(task_id)
+            if task is None or task.state.status in FINISHED:
+                return
+            if task.state.status == 'RETRYING':
+                if (task.state.retry_at or 0) <= time.time():
+                    self.log.info('Retrying task {0} from job {1}'.format(
+                                  task.state.id, job.state.id))
+                    # Timed afresh from the new attempt
+                    task.state.start_time = None
+                    self._submit(job, task)
+                    self._update_job(job)
+                return
+            # Only tasks which have been sent out can run over; a task may
+            # be PENDING again after the message which sent it failed (see
+            # _locked)
+            if not task.state.timeout or not task.state.start_time or \
+                    task.state.status not in ('SUBMITTED', 'RUNNING'):
+                return
+            deadline = task.state.start_time + task.state.timeout
+            if deadline <= time.time():
+                if self._retry(job, task, 'timeout'):
+                    self._update_job(job)
+                    return
+                self.log.info("Setting task {0} from job {1} as FAILED".format(task.state.id,job.state.id))
+                task.state.status = 'FAILED'
+                task.state.end_time = time.time()
+                job.state.status = 'FAILED'
+                job.state.end_time = time.time()
+                self._update_job(job)
+
+    def _retry(self, job, task, reason):
+        '''
+        Set a failed task (or the result of one) to be retried if its
+        retries, backoff and retry_on fields allow, returning True if so.
+        The task is RETRYING until, after a backoff doubling with every
+        attempt plus jitter, it is published again (by _expire_task). The
+        reason is 'timeout' or the name of the exception it failed with.
+        '''
+        policy = job.get_task(task.state.id) or task
+        attempt = task.state.attempt or 1
+        if attempt > (policy.state.retries or 0):
+            return False
+        retry_on = policy.state.retry_on
+        if isinstance(retry_on, basestring):
+            retry_on = [retry_on]
+        if retry_on is not None and reason not in retry_on:
+            return False
+        backoff = policy.state.backoff
+        if backoff is None:
+            backoff = 1
+        delay = min(float(backoff) * 2 ** (attempt - 1), self.max_backoff)
+        # Spread out retries of tasks which failed together
+        delay = random.uniform(delay / 2, delay)
+        self.log.info('Task {0} failed ({1}) on attempt {2}; retrying in '
+                      '{3:.1f}s'.format(task.state.id, reason, attempt, delay))
+        task.state.status = 'RETRYING'
+        task.state.retry_at = time.time() + delay
+        # A result from an end point may not repeat the policy
+        for field in ('retries', 'backoff', 'retry_on'):
+            if getattr(task.state, field) is None:
+                setattr(task.state, field, getattr(policy.state, field))
+        self.scheduler.schedule(task.state.id, task.state.retry_at,
+                                self._expire_task, job.state.id,
+                                task.state.id)
+        return True
+
+    def _get_job(self, job_id):
+        '''
+        Return the live Job with the given id, loading it from the
+        database if it isn't cached, or None
+        '''
+        if self._touched is not None:
+            self._touched.add(job_id)
+        job = self.cache.get(job_id)
+        if job is None:
+            # An evicted job may still have a write on its way
+            self.writer.barrier(job_id)
+            jobrecord = self._retreive_job(job_id)
+            if jobrecord is None:
+                return None
+            job = self.cache.put(Job().load(jobrecord, self.db_codec))
+        return job
+
+    def _peek_job(self, job_id):
+        '''
+        Like _get_job, but jobs of shards held by other instances are read
+        from the database and not cached
+        '''
+        if self._owns(job_id):
+            return self._get_job(job_id)
+        jobrecord = self._retreive_job(job_id)
+        if jobrecord is None:
+            return None
+        return Job().load(jobrecord, self.db_codec)
+
+    def _find_jobid(self, task_id):
+        jobid = self.cache.find_job_id(task_id)
+        if jobid is None:
+            jobid = self._retreive_jobid(task_id)
+        return jobid
 
     def _persist_job(self, job):
-        
-        self.db(self.databaseHost,self.databasePort,self.databaseInstance).putjob(job)
+        if self._touched is not None:
+            self._touched.add(job.state.id)
+        self.cache.put(job)
+        self.writer.put(job)
         
     def _update_job(self, job):
-        self.db(self.databaseHost,self.databasePort,self.databaseInstance).updatejob(job)
+        self.cache.put(job)
+        self.writer.update(job)
         
     def _retreive_job(self, job_id):
-        
-        job = self.db(self.databaseHost,self.databasePort,self.databaseInstance).getjob(job_id)
+        job = self.pool.call('getjob', job_id)
         return job
     
     def _retreive_jobid(self, task_id):
-        jobid = self.db(self.databaseHost,self.databasePort,self.databaseInstance).getjobid(task_id)
+        jobid = self.pool.call('getjobid', task_id)
         return jobid
 
+    def _owns(self, job_id):
+        '''True unless the job belongs to a shard held by another instance.'''
+        return self.shards is None or self.shards.owns(job_id)
+
+    def _queue(self, queue, job_id):
+        '''
+        The queue for a job's messages: its shard's copy of queue
+        '''
+        if self.shards is None:
+            return queue
+        return '{0}.{1}'.format(queue, self.shards.shard_of(job_id))
+
+    def _forward(self, queue, job_id, properties, body):
+        '''
+        Pass a message on to the instance holding the job's shard
+        '''
+        self._publish(self._queue(queue, job_id), properties, body)
+
+    def _publish(self, routing_key, properties, body, exchange=''):
+        '''
+        Publish a message, raising MessagingError if the broker doesn't
+        confirm it
+        '''
+        if self.channel.basic_publish(exchange=exchange,
+                                      routing_key=routing_key,
+                                      properties=properties,
+                                      body=body) is False:
+            raise error.MessagingError(
+                'Broker did not take message for {0}'.format(routing_key))
+
+    def _rebalance(self):
+        '''
+        Renew this instance's shard leases and hand shards over as
+        instances join or leave: shards which now belong with another
+        instance are drained and released, and free shards which belong
+        with this one are taken. Shards whose leases couldn't be renewed
+        are dropped. Runs on the connection thread.
+        '''
+        try:
+            with self.job_lock:
+                for shard in self.shards.renew():
+                    self._drop_shard(shard)
+                wanted = self.shards.wanted()
+                for shard in sorted(self.shards.held - wanted):
+                    self.log.info('Handing over shard {0}'.format(shard))
+                    self._drop_shard(shard)
+                    self.shards.release(shard)
+                for shard in sorted(wanted - self.shards.held):
+                    # Not free until its last holder has let it go
+                    if self.shards.acquire(shard):
+                        self.log.info('Taking shard {0}'.format(shard))
+                        self._take_shard(shard)
+        except Exception, e:
+            self.log.error('Failed to rebalance shards')
+            self.log.exception(e)
+        finally:
+            # Come back in time to drop shards whose leases run out
+            # unrenewed
+            delay = self.shards.lease_ttl / 3
+            expiry = self.shards.next_expiry()
+            if expiry is not None:
+                delay = max(min(delay, expiry - time.time()), 0)
+            self.conn.add_timeout(delay, self._rebalance)
+
+    def _take_shard(self, shard):
+        '''Start handling the jobs of a newly held shard.'''
+        self.consumers[shard] = []
+        for queue, callback in [('hub_results', self.process_results),
+                                ('hub_jobs', self.process_jobs)]:
+            queue = '{0}.{1}'.format(queue, shard)
+            tag = self.channel.basic_consume(self._locked(callback),
+                                             queue=queue, no_ack=False)
+            self.consumers[shard].append((queue, tag))
+        self._caretaker(shard)
+
+    def _drop_shard(self, shard):
+        '''
+        Stop handling the jobs of a shard: stop consuming its queues,
+        write out its jobs and forget them and their deadlines
+        '''
+        for queue, tag in self.consumers.pop(shard, []):
+            # Messages which arrived before the cancel aren't acknowledged,
+            # so go back on the queue for the shard's next holder
+            self.channel.basic_cancel(tag)
+        # Everything handled so far is written out and acknowledged
+        self._ack()
+        shard_of = self.shards.shard_of
+        self.scheduler.cancel_matching(
+            lambda key, args: args and shard_of(args[0]) == shard)
+        for job_id in self.cache.job_ids():
+            if shard_of(job_id) == shard:
+                self.cache.discard(job_id)
+
+    def _locked(self, callback):
+        '''
+        Wrap a consumer callback so it doesn't run alongside the caretaker,
+        and so its message is acknowledged once handled (see _ack).
+        Messages which fail for want of the database or the broker go back
+        on their queue to be handled again, which is harmless: whatever the
+        message did to jobs in memory is undone first (see _rollback).
+        Messages which can't be decoded, or which fail again on redelivery,
+        are set aside on the dead letter queue.
+        '''
+        def wrapper(ch, method, properties, body):
+            with self.job_lock:
+                touched = self._touched = set()
+                try:
+                    callback(ch, method, properties, body)
+                except CONNECTION_ERRORS:
+                    self._rollback(self._touched)
+                    raise
+                except (error.MessagingError, error.DatabaseError), e:
+                    self._rollback(self._touched)
+                    self.log.error('Requeueing message: {0}'.format(e))
+                    if method is not None:
+                        ch.basic_nack(delivery_tag=method.delivery_tag,
+                                      requeue=True)
+                    # Don't spin through the queue while the outage lasts
+                    time.sleep(self.retry_interval)
+                    return
+                except Exception, e:
+                    self._rollback(self._touched)
+                    self.log.exception(e)
+                    if method is None:
+                        return
+                    if not isinstance(e, (error.SerializationError,
+                                          error.IntegrityError)) and \
+                            not method.redelivered:
+                        self.log.error('Requeueing message which could '
+                                       'not be handled: {0}'.format(body))
+                        ch.basic_nack(delivery_tag=method.delivery_tag,
+                                      requeue=True)
+                        return
+                    if not self._dead_letter(method, properties, body, e):
+                        return
+                finally:
+                    self._touched = None
+                if method is None:
+                    return
+                self._unacked.append((method, properties, body, touched))
+                if len(self._unacked) >= max(self.prefetch / 2, 1):
+                    self._ack()
+        return wrapper
+
+    def _rollback(self, job_ids):
+        '''
+        Forget the jobs a message which failed part way through read or
+        changed, so they are read back from the database as they were
+        before it: a message's changes to a job are only queued to be
+        written once it has done with the job. Its redelivery then finds
+        the jobs as the first delivery did, rather than half changed.
+        '''
+        for job_id in job_ids:
+            self.log.info('Reloading job {0} after a failed message'.format(
+                          job_id))
+            self.cache.discard(job_id)
+        self.writer.forget(*job_ids)
+
+    def _dead_letter(self, method, properties, body, e):
+        '''
+        Set a message aside on the dead letter queue, to be acknowledged
+        with the messages handled. Returns False if it had to be put back
+        on its queue instead.
+        '''
+        self.log.error('Moving message which could not be handled to '
+                       '{0}: {1}'.format(DEAD_LETTERS, body))
+        headers = dict(properties.headers or {})
+        headers.update({'error': str(e), 'queue': method.routing_key})
+        _prop = pika.BasicProperties(
+            content_type=properties.content_type,
+            correlation_id=properties.correlation_id,
+            reply_to=properties.reply_to, headers=headers)
+        try:
+            self._publish(DEAD_LETTERS, _prop, body)
+        except error.MessagingError, e:
+            self.log.error('Requeueing message: {0}'.format(e))
+            self.channel.basic_nack(delivery_tag=method.delivery_tag,
+                                    requeue=True)
+            return False
+        return True
+
+    def _decode(self, codec, body):
+        '''Decode a message body, raising SerializationError if it can't be.'''
+        try:
+            return codec.loads(body)
+        except Exception, e:
+            raise error.SerializationError(
+                'Message could not be decoded as {0}: {1}'.format(
+                    codec.content_type, e))
+
+    def _ack(self):
+        '''
+        Acknowledge every message handled so far, once the job changes
+        they made are in the database. Messages which are redelivered
+        because the dispatcher stopped before then are handled again.
+        '''
+        if not self._unacked:
+            return
+        job_ids = set()
+        for method, properties, body, touched in self._unacked:
+            job_ids.update(touched)
+        try:
+            if job_ids:
+                self.writer.barrier(*job_ids)
+        except (error.DatabaseError, error.IntegrityError), e:
+            self.log.error('Not acknowledging every message: {0}'.format(e))
+            self._ack_each()
+            return
+        self.channel.basic_ack(delivery_tag=self._unacked[-1][0].delivery_tag,
+                               multiple=True)
+        self._unacked = []
+
+    def _ack_each(self):
+        '''
+        Acknowledge the messages whose job changes are in the database,
+        one by one. Those which made changes the database refused are set
+        aside on the dead letter queue, and their jobs read back from the
+        database; the rest wait for the writer to get their changes in.
+        '''
+        waiting = []
+        for message in self._unacked:
+            method, properties, body, touched = message
+            refused = self.writer.refused(*touched)
+            if refused:
+                self._rollback(refused)
+                e = error.IntegrityError('Refused to write jobs {0}'.format(
+                                         ', '.join(refused)))
+                if not self._dead_letter(method, properties, body, e):
+                    continue
+            elif not self.writer.written(*touched):
+                waiting.append(message)
+                continue
+            self.channel.basic_ack(delivery_tag=method.delivery_tag)
+        self._unacked = waiting
+
+    def _ack_timer(self):
+        '''Acknowledge handled messages every ack_interval seconds.'''
+        try:
+            with self.job_lock:
+                self._ack()
+        finally:
+            self.conn.add_timeout(self.ack_interval, self._ack_timer)
+
     def start(self, broker):
         self.broker = broker
         try:
             self.conn = pika.BlockingConnection(pika.ConnectionParameters(
                                                 host=self.broker))
             self.channel = self.conn.channel()
+            # Publishing waits for the broker to take each message
+            self.channel.confirm_delivery()
+            self.channel.basic_qos(prefetch_count=self.prefetch)
             self.channel.queue_declare(queue='hub_jobs')
             self.channel.queue_declare(queue='hub_status')
             self.channel.queue_declare(queue='hub_results')
-            self.channel.basic_consume(self.get_job,
-                                       queue='hub_status', no_ack=True)
-            self.channel.basic_consume(self.process_results,
-                                       queue='hub_results', no_ack=True)
-            self.channel.basic_consume(self.process_jobs,
-                                       queue='hub_jobs', no_ack=True)
+            self.channel.queue_declare(queue=DEAD_LETTERS)
+            routing.declare(self.channel, self.task_priorities)
+            if self.results is not None:
+                self.results.load()
+            self.channel.basic_consume(self._locked(self.get_job),
+                                       queue='hub_status', no_ack=False)
+            self.channel.basic_consume(self._locked(self.process_results),
+                                       queue='hub_results', no_ack=False)
+            self.channel.basic_consume(self._locked(self.process_jobs),
+                                       queue='hub_jobs', no_ack=False)
+            self.conn.add_timeout(self.ack_interval, self._ack_timer)
 
+            if self.shards is None:
+                self._caretaker()
+            else:
+                # Messages for a shard wait in its queues while it changes
+                # hands
+                for shard in range(self.shards.shards):
+                    for queue in ('hub_results', 'hub_jobs'):
+                        self.channel.queue_declare(
+                            queue='{0}.{1}'.format(queue, shard))
+                self._rebalance()
+            if self.caretaker_interval:
+                self.scheduler.schedule(
+                    'caretaker', time.time() + self.caretaker_interval,
+                    self._sweep)
+            self.scheduler.start()
             self.log.info(
                 'Starting dispatcher, listening for jobs and results...')
             self.channel.start_consuming()
@@ -127,39 +637,51 @@ class Dispatcher():
             msg = ('Problem connectting to broker {0}'.format(self.broker))
             self.log.error(msg)
             raise error.MessagingError(msg, e)
+        finally:
+            # Don't lose job changes still waiting to be written
+            try:
+                self.writer.barrier()
+            except error.DatabaseError, e:
+                self.log.error('Stopping with job changes unwritten: '
+                               '{0}'.format(e))
+            if self.shards is not None:
+                # Let the other instances take over without waiting for
+                # the leases to run out
+                try:
+                    self.shards.leave()
+                except Exception, e:
+                    self.log.exception(e)
 
 
     def _start_next_task(self, job):
-        tasks_to_run = job.get_next_tasks_to_run()
-        if len(tasks_to_run) == 0:
-            # We're done, calculate overall job status and exit
-            job.set_status()
-            if job.state.status == 'SUCCESS':
-                job.state.end_time = time.time()
-                job.update_output()
-            self.log.info('No more tasks to run for job {0}'.format(
-                job.state.name))
-            self.log.debug('Updating job {0} in DB'.format(
-                job.state.name))
-            self._update_job(job)
-            # DONE Will activate this once DB persistence layer exists
-            self.log.info('Job {0} completed. Status: {1}, Output: {2}'.format(
-                          job.state.id, job.state.status, job.state.output))
+        # Tasks completed from the result cache may let more run at once,
+        # so round again until none were
+        memoized = True
+        while memoized:
+            tasks_to_run = job.get_next_tasks_to_run()
+            if len(tasks_to_run) == 0:
+                # We're done, calculate overall job status and exit
+                job.set_status()
+                if job.state.status == 'SUCCESS':
+                    job.state.end_time = time.time()
+                    job.update_output()
+                self.log.info('No more tasks to run for job {0}'.format(
+                    job.state.name))
+                self.log.info('Job {0} completed. Status: {1}, Output: {2}'.format(
+                              job.state.id, job.state.status, job.state.output))
 
-        for task in tasks_to_run:
-            # Sub tagged inputs with the associated results of completed tasks
-            if task.state.status != 'RUNNING' and task.state.args is not None:
-                task = job.update_task_args(task)
-            task.state.status = 'SUBMITTED'
-            if not task.state.start_time:
-                task.state.start_time = time.time()
-            if task.state.timeout:
-                self.log.debug("Task {0} timeout in {1}".format(task.state.id,str(task.state.timeout)))
-                threading.Timer(task.state.timeout, self._caretaker).start()
-            self.publish_task(task.state.save())
-            #Now we've decided what to do NEXT with the Job lets update the DB
-            self.log.debug("Updating to DB job: ".format(job.state.id))
-            self._update_job(job)
+            memoized = False
+            for task in tasks_to_run:
+                # Sub tagged inputs with the associated results of completed tasks
+                if task.state.status != 'RUNNING' and task.state.args is not None:
+                    task = job.update_task_args(task)
+                if self._memoized(job, task):
+                    memoized = True
+                    continue
+                self._submit(job, task)
+        #Now we've decided what to do NEXT with the Job lets update the DB
+        self.log.debug("Updating to DB job: {0}".format(job.state.id))
+        self._update_job(job)
 
     def get_job(self, ch, method, properties, jobid):
         '''
@@ -167,45 +689,256 @@ class Dispatcher():
         '''
         # Load the jobid from the JSON object
         self.log.info('Received status request for job {0}'.format(jobid))
-        jobid = json.loads(jobid)
-        # Get the job from the store of registered jobs
-        jobs = dict()
-        if jobid == 'all':
-            for id, job in self.registered_jobs.iteritems():
-                jobs[id] = str(job.save())
-            msg = str(jobs)
+        codec = serializer.get_codec(properties.content_type)
+        request = self._decode(codec, jobid)
+        # Either a job id (or 'stats'), or a dict: a job id under 'id' with
+        # options (see _search), or without one a query for a page of jobs
+        query = {}
+        if isinstance(request, dict):
+            query = request
+            jobid = request.get('id')
         else:
-            job = self._retreive_job(jobid)
-            if job is not None:
-                msg = job
+            jobid = request
+        content_type = codec.content_type
+        try:
+            if jobid == 'stats':
+                stats = {'database': self.pool.stats(),
+                         'cache': self.cache.stats(),
+                         'writer': self.writer.stats(),
+                         'scheduler': self.scheduler.stats()}
+                if self.shards is not None:
+                    stats['shards'] = self.shards.stats()
+                if self.results is not None:
+                    stats['results'] = self.results.stats()
+                msg = codec.dumps(stats)
+            elif jobid is None or jobid == 'all':
+                msg = codec.dumps(self._search(query))
             else:
-                msg = 'Job %s not found' % jobid
+                job = self._peek_job(jobid)
+                if job is None:
+                    msg = 'Job %s not found' % jobid
+                    content_type = serializer.TEXT
+                else:
+                    record = project(job.record(), query.get('fields'),
+                                     query.get('task_fields'))
+                    # Job output held in the blob store is sent in place
+                    # of references to it only if asked for
+                    if query.get('resolve') and self.blobs is not None and \
+                            record.get('output'):
+                        record['output'] = self.blobs.resolve(record['output'])
+                    msg = codec.dumps(record)
+        except error.ValidationError, e:
+            msg = 'Invalid status query: {0}'.format(e)
+            content_type = serializer.TEXT
+        except ValueError, e:
+            # e.g. binary task data asked for as json
+            msg = 'Job {0} can not be sent as {1}: {2}'.format(
+                  jobid, codec.content_type, e)
+            content_type = serializer.TEXT
 
         # Return job to client
         self.log.info('Returning msg {0}'.format(msg))
-        _prop = pika.BasicProperties(correlation_id=properties.correlation_id)
+        _prop = pika.BasicProperties(correlation_id=properties.correlation_id,
+                                     content_type=content_type)
         self.channel.basic_publish(exchange='',
                                    routing_key=properties.reply_to,
                                    properties=_prop,
                                    body=msg)
 
+    def _search(self, query):
+        '''
+        Answer a status query with a page of jobs from the database:
+        {'jobs': [job records], 'next': cursor}. The query may filter on
+        'status' (one or a list), 'name' and the start time ('since',
+        'until'), cut records down to 'fields' and 'task_fields', and give
+        the page size ('limit') and the cursor of the page ('after').
+        '''
+        limit = self._query_number(query, 'limit', int) or \
+            self.search_page_size
+        if limit < 1:
+            raise error.ValidationError('limit must be at least 1')
+        limit = min(limit, self.search_page_limit)
+        # Jobs held in memory may not have reached the database yet
+        self.writer.barrier()
+        jobs, cursor = self.pool.call(
+            'searchjobs', status=query.get('status'), name=query.get('name'),
+            since=self._query_number(query, 'since', float),
+            until=self._query_number(query, 'until', float),
+            fields=query.get('fields'), task_fields=query.get('task_fields'),
+            after=self._query_number(query, 'after', int), limit=limit)
+        return {'jobs': jobs, 'next': cursor}
+
+    def _query_number(self, query, key, cast):
+        '''The number given as key in a status query, or None.'''
+        value = query.get(key)
+        if value is None or value == '':
+            return None
+        try:
+            return cast(value)
+        except (TypeError, ValueError):
+            raise error.ValidationError(
+                '{0} must be a number, not {1!r}'.format(key, value))
+
     def process_jobs(self, ch, method, properties, jobrecord):
         '''
         Work out dependancies and order
         '''
-        # Create a Job instance from the job record
-        job = Job().load(jobrecord)
-        # Register the job with the dispatcher
-        #self._register_job(job)
-        self._persist_job(job)
-        self.log.info('Registered job: {0} in DB'.format(job.state.id))
-        # Return registration success message to client
-        _prop = pika.BasicProperties(correlation_id=properties.correlation_id)
-        self.channel.basic_publish(exchange='',
-                                   routing_key=properties.reply_to,
-                                   properties=_prop,
-                                   body=str(job.state.id))
+        codec = serializer.get_codec(properties.content_type)
+        record = self._decode(codec, jobrecord)
+        # A list of job records is a bulk submission, answered with the
+        # list of their ids
+        bulk = isinstance(record, list)
+        if not bulk:
+            record = [record]
+        for i, jobrecord in enumerate(record):
+            if not jobrecord.get('id'):
+                jobrecord['id'] = self._new_job_id(properties, i)
+        job_ids = [jobrecord['id'] for jobrecord in record]
+        # A message handled before, by this or another instance, may have
+        # registered its jobs already
+        redelivered = (method is not None and method.redelivered) or \
+            bool((properties.headers or {}).get('redelivered'))
+        if not redelivered:
+            taken = self._taken(job_ids)
+            if taken:
+                msg = 'Job ids already taken: {0}'.format(', '.join(taken))
+                self.log.error('Rejecting jobs: {0}'.format(msg))
+                if properties.reply_to:
+                    _prop = pika.BasicProperties(
+                        correlation_id=properties.correlation_id,
+                        content_type=serializer.TEXT)
+                    self.channel.basic_publish(
+                        exchange='', routing_key=properties.reply_to,
+                        properties=_prop, body=msg)
+                return
+        forward = []
+        if self.shards is not None:
+            record, forward = self._claim_jobs(record, codec, bulk,
+                                               redelivered)
+        # Create Job instances from the job records
+        jobs = []
+        resumed = []
+        for jobrecord in record:
+            job = self._get_job(jobrecord['id']) if redelivered else None
+            if job is not None:
+                resumed.append(job)
+            else:
+                jobs.append(Job().load(jobrecord, codec))
+        for job in jobs:
+            self._persist_job(job)
+        # Only acknowledge the jobs once they're safely in the database;
+        # the writer puts as many as it can in each transaction. Jobs
+        # picked up again may be the ones which didn't get there last time
+        self.writer.barrier(*[job.state.id for job in jobs + resumed] +
+                            [jobrecord['id'] for jobrecord in forward
+                             if bulk])
+        self.log.info('Registered jobs: {0} in DB'.format(
+                      [job.state.id for job in jobs]))
+        # Return registration success message to client, unless the job
+        # was forwarded from a bulk submission answered elsewhere
+        if bulk:
+            _prop = pika.BasicProperties(
+                correlation_id=properties.correlation_id,
+                content_type=codec.content_type)
+            body = codec.dumps(job_ids)
+        elif record:
+            _prop = pika.BasicProperties(
+                correlation_id=properties.correlation_id)
+            body = str(job_ids[0])
+        if properties.reply_to and (bulk or record):
+            self.channel.basic_publish(exchange='',
+                                       routing_key=properties.reply_to,
+                                       properties=_prop,
+                                       body=body)
+        self._forward_jobs(forward, properties, codec, bulk, redelivered)
+        for job in jobs:
+            self._start_job(job)
+        for job in resumed:
+            self._resume_job(job)
+
+    def _taken(self, job_ids):
+        '''
+        Those of the ids of a submission's jobs which are taken, by jobs
+        registered before or by other jobs of the submission
+        '''
+        taken = set(job_id for job_id in job_ids
+                    if job_id in self.cache or self.writer.pending(job_id))
+        if len(set(job_ids)) < len(job_ids):
+            seen = set()
+            for job_id in job_ids:
+                if job_id in seen:
+                    taken.add(job_id)
+                seen.add(job_id)
+        taken.update(self.pool.call('findjobs', job_ids))
+        return sorted(taken)
 
+    def _new_job_id(self, properties, index):
+        '''
+        The id for the index'th job of a submission which didn't give one
+        '''
+        if properties.correlation_id:
+            return str(uuid.uuid5(JOB_NAMESPACE, '{0}:{1}'.format(
+                       properties.correlation_id, index)))
+        if self.shards is not None:
+            job_id = self.shards.new_id()
+            if job_id is not None:
+                return job_id
+        return str(uuid.uuid1())
+
+    def _claim_jobs(self, records, codec, bulk, redelivered):
+        '''
+        Split a submission's jobs into those to handle here and those in
+        other shards, to forward to their holders (see _forward_jobs).
+        The jobs of a bulk submission are answered for from here, so the
+        ones to forward are queued to be written here too: they can be
+        looked up as soon as the answer goes out.
+        '''
+        claimed = []
+        forward = []
+        for record in records:
+            if self.shards.owns(record['id']):
+                claimed.append(record)
+            else:
+                forward.append(record)
+        if not bulk or not forward:
+            return claimed, forward
+        stored = set()
+        if redelivered:
+            # Maybe written by an earlier delivery
+            stored.update(self.pool.call(
+                'findjobs', [record['id'] for record in forward]))
+        for record in forward:
+            if record['id'] in stored:
+                continue
+            if self._touched is not None:
+                self._touched.add(record['id'])
+            self.writer.put(Job().load(record, codec))
+        return claimed, forward
+
+    def _forward_jobs(self, records, properties, codec, bulk, redelivered):
+        '''
+        Pass jobs in other shards on to their holders. Those of a bulk
+        submission are in the database by now, and marked as redelivered
+        for their holders to pick them up from there.
+        '''
+        for record in records:
+            if bulk:
+                _prop = pika.BasicProperties(content_type=codec.content_type,
+                                             headers={'redelivered': True})
+            else:
+                _prop = pika.BasicProperties(
+                    content_type=properties.content_type,
+                    correlation_id=properties.correlation_id,
+                    reply_to=properties.reply_to)
+                if redelivered:
+                    _prop.headers = {'redelivered': True}
+            self._forward('hub_jobs', record['id'], _prop,
+                          codec.dumps(record))
+
+    def _start_job(self, job):
+        '''
+        Submit the first tasks of a new job
+        '''
         # Work out the first tasks to run
         self.log.debug('Decomposing job; calculating first tasks to run')
         tasks_to_run = job.get_next_tasks_to_run()
@@ -213,28 +946,139 @@ class Dispatcher():
         for task in tasks_to_run:
             if task.state.args is not None:
                 task = job.update_task_args(task)
+        memoized = False
         for task in tasks_to_run:
-            task.state.status = 'SUBMITTED'
-            if not task.state.start_time:
-                task.state.start_time = time.time()
-            if task.state.timeout:
-                self.log.debug("Task {0} timeout in {1}".format(task.state.id,str(task.state.timeout)))
-                threading.Timer(task.state.timeout, self._caretaker).start()
-            self.publish_task(task.state.save())
+            if self._memoized(job, task):
+                memoized = True
+                continue
+            self._submit(job, task)
+        if memoized:
+            # Tasks waiting on those may be ready to run now
+            self._start_next_task(job)
+            return
         #Now we've decided what to do with Job lets update the DB
         self.log.debug("Updating to DB job: {0}".format(job.state.id))
         self._update_job(job)
 
-    def publish_task(self, task):
+    def _memoized(self, job, task):
+        '''
+        Complete a task with its cached result if it has been run with the
+        same arguments before. Returns True if so.
+        '''
+        if self.results is None:
+            return False
+        found = self.results.get(task.state.task_name or task.state.name,
+                                 task.state.args)
+        if found is None:
+            return False
+        self.log.info('Task {0} of job {1} completed from the result '
+                      'cache'.format(task.state.id, job.state.id))
+        done = task.copy()
+        done.state.status = 'SUCCESS'
+        done.state.data = found[0]
+        done.state.end_time = time.time()
+        done.state.cached = True
+        job.update_tasks(done, force=True)
+        self._task_done(done)
+        return True
+
+    def _cache_result(self, task):
+        '''
+        Keep the result of a task declared cacheable, or stop looking up
+        results of one which no longer is
+        '''
+        task_name = task.state.task_name or task.state.name
+        if task.state.cache_ttl is None:
+            self.results.forget(task_name)
+            return
+        self.results.put(task_name, task.state.args, task.state.data,
+                         task.state.cache_ttl, task.state.cache_version)
+
+    def _resume_job(self, job):
+        '''
+        Carry on with a job registered by an earlier delivery of its
+        submission, which may have stopped before its tasks went out:
+        tasks still waiting to be picked up are published again
+        '''
+        for task in job.state.tasks:
+            if task.state.status == 'SUBMITTED':
+                self._submit(job, task)
+        self._start_job(job)
+
+    def _submit(self, job, task):
+        '''
+        Publish a task of a job as its next attempt; results of earlier
+        attempts are ignored from now on (see _stale)
+        '''
+        task.state.status = 'SUBMITTED'
+        task.state.attempt = (task.state.attempt or 0) + 1
+        if not task.state.start_time:
+            task.state.start_time = time.time()
+        self._watch_timeout(job, task)
+        # A task's own priority, otherwise its job's
+        priority = task.state.priority
+        if priority is None:
+            priority = job.state.priority
+        self.publish_task(task.state.save(self.codec),
+                          self._queue('hub_results', job.state.id),
+                          task.state.task_name or task.state.name, priority)
+
+    def publish_task(self, task, reply_to=None, task_name=None,
+                     priority=None):
         '''
-        Publish tasks to the work queue
+        Publish tasks to the work queue for their task type (see
+        hub.lib.routing), asking for the result to be sent to reply_to if
+        given
         '''
         self.log.info('Publishing task {0} to the work queue'.format(task))
-        _prop = pika.BasicProperties(content_type='application/json',)
-        self.channel.basic_publish(exchange='',
-                                   routing_key='hub_tasks',
-                                   properties=_prop,
-                                   body=task)
+        _prop = pika.BasicProperties(content_type=self.codec.content_type,
+                                     reply_to=reply_to)
+        if priority is not None:
+            _prop.priority = int(priority)
+        self._publish(routing.routing_key(task_name), _prop, task,
+                      routing.EXCHANGE)
+
+    def _update_task(self, updated_task, jobid):
+        '''
+        Apply a task update sent by an end point rather than a worker
+        '''
+        job = self._get_job(jobid) if jobid is not None else None
+        if job is not None:
+            self.log.info('Found job: {0}'.format(job.state.id))
+            if self._stale(job, updated_task):
+                return
+            if updated_task.state.status == 'FAILED':
+                self._retry(job, updated_task,
+                            updated_task.state.exception or 'error')
+            if job.get_task(updated_task.state.id) is not None:
+                job.update_tasks(updated_task)
+                self._task_done(updated_task)
+                self._start_next_task(job)
+            else:
+                self.log.warn('Task with id {0} not found in its parent job (possible?)'.format(
+                              updated_task.state.id))
+        else:
+            self.log.warn('No parent job found for Task with id {0}'.format(
+                                  updated_task.state.id))
+
+    def _stale(self, job, result):
+        '''
+        True if a task result is for a task which has already finished, or
+        for an attempt at it other than the latest; e.g. a redelivered
+        message, or a task published again which was already running
+        '''
+        task = job.get_task(result.state.id)
+        if task is None:
+            return False
+        if task.state.status in FINISHED or (
+                result.state.attempt is not None and
+                result.state.attempt != task.state.attempt):
+            self.log.info('Ignoring result of attempt {0} at task {1}, '
+                          'now {2} after attempt {3}'.format(
+                          result.state.attempt, task.state.id,
+                          task.state.status, task.state.attempt))
+            return True
+        return False
 
     def process_results(self, ch, method, properties, taskrecord):
         '''
@@ -243,39 +1087,53 @@ class Dispatcher():
         self.log.info(
             'Received task results for job {0}'.format(
                 properties.correlation_id))
+        codec = serializer.get_codec(properties.content_type)
+        if properties.correlation_id == 'update_task':
+            self.log.info('Task results: {0}'.format(taskrecord))
+            # Updates from end points may come a list at a time
+            records = self._decode(codec, taskrecord)
+            if not isinstance(records, list):
+                records = [records]
+            # Updates for jobs in other instances' shards go on to them,
+            # one message per shard
+            forward = {}
+            for record in records:
+                # Turn the taskrecord into a project Task instance
+                updated_task = Task().load(record)
+                jobid = self._find_jobid(updated_task.state.id)
+                if jobid is not None and not self._owns(jobid):
+                    forward.setdefault(self._queue('hub_results', jobid),
+                                       (jobid, []))[1].append(record)
+                    continue
+                self._update_task(updated_task, jobid)
+            for jobid, records in forward.itervalues():
+                self._forward('hub_results', jobid, properties,
+                              codec.dumps(records))
+            return
+        if not self._owns(properties.correlation_id):
+            self._forward('hub_results', properties.correlation_id,
+                          properties, taskrecord)
+            return
         # Check if task is registered to this dispatcher
-        if self._retreive_job(properties.correlation_id) is not None:
-            # Re-Register the job with the dispatcher
-            jobrecord = self._retreive_job(properties.correlation_id)
-            job = Job().load(jobrecord)
-            self.log.info('Found job in DB: {0}'.format(job.state.id))
+        job = self._get_job(properties.correlation_id)
+        if job is not None:
+            self.log.info('Found job: {0}'.format(job.state.id))
             self.log.info('Task results: {0}'.format(taskrecord))
             # Turn the taskrecord into a project Task instance
-            updated_task = Task().load(taskrecord)            
+            updated_task = Task().load(self._decode(codec, taskrecord))
+            if self._stale(job, updated_task):
+                return
+            if updated_task.state.status == 'FAILED':
+                self._retry(job, updated_task,
+                            updated_task.state.exception or 'error')
+            # Results of tasks declared cacheable are kept for reuse
+            if updated_task.state.status == 'SUCCESS' and \
+                    self.results is not None:
+                self._cache_result(updated_task)
             # Update the job with the new task results
             job.update_tasks(updated_task, force=True)
+            self._task_done(updated_task)
             self._start_next_task(job)
-        elif properties.correlation_id == 'update_task':
-            self.log.info('Task results: {0}'.format(taskrecord))
-            # Turn the taskrecord into a project Task instance
-            updated_task = Task().load(taskrecord)
-            number_of_updated_tasks = 0
-            jobid = self._retreive_jobid(updated_task.state.id)
-            jobrecord = self._retreive_job(jobid)
-            if jobrecord is not None:
-                job = Job().load(jobrecord)
-                self.log.info('Found in DB job: {0}'.format(job.state.id))
-                for task in job.state.tasks:
-                    if updated_task.state.id == task.state.id:
-                        job.update_tasks(updated_task)
-                        number_of_updated_tasks += 1
-                        self._start_next_task(job)
-                if number_of_updated_tasks == 0:
-                    self.log.warn('Task with id {0} not found in its parent job (possible?)'.format(
-                                  updated_task.state.id))
-            else:
-                self.log.warn('No parent job found for Task with id {0}'.format(
-                                      updated_task.state.id))
         else:
             self.log.warn('No job found for job ID: {0}'.format(properties.correlation_id))
 
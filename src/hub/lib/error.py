@@ -49,3 +49,31 @@ class MessagingError(HubError):
     Raised on problems connecting to messaging system
     '''
     pass
+
+
+class DatabaseError(HubError):
+    '''
+    Raised on problems connecting to or querying the database
+    '''
+    pass
+
+
+class IntegrityError(HubError):
+    '''
+    Raised when the database refuses a record, e.g. one whose id is taken
+    '''
+    pass
+
+
+class SerializationError(HubError):
+    '''
+    Raised on unknown or unavailable message encodings
+    '''
+    pass
+
+
+class TimeoutError(HubError):
+    '''
+    Raised when a reply doesn't arrive in time
+    '''
+    pass
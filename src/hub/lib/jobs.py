@@ -5,15 +5,33 @@ Hub job routines
 import uuid
 import logging
 import time
+from collections import Counter
 # Own modules
 import error
 from common import State
 from tasks import Task
+import serializer
 
 # 3rd part modules
 import pika
 import json
 
+# Task statuses after which a task will never be run again
+FINISHED = ('SUCCESS', 'FAILED')
+
+
+def project(record, fields=None, task_fields=None):
+    '''
+    Cut a job record down to the given fields, and its tasks (if 'tasks'
+    is one of them) down to task_fields. None keeps every field.
+    '''
+    if fields is not None:
+        record = dict((k, record[k]) for k in fields if k in record)
+    if task_fields is not None and record.get('tasks'):
+        record['tasks'] = [dict((k, task[k]) for k in task_fields if k in task)
+                           for task in record['tasks']]
+    return record
+
 
 class Job(Task):
     '''
@@ -21,6 +39,9 @@ class Job(Task):
     '''
     def __init__(self):
         super(Job, self).__init__()
+        self._unmet = None
+        # Ids of tasks changed since the job was last loaded or persisted
+        self._dirty_tasks = set()
 
     def _validate(self):
         '''
@@ -29,49 +50,162 @@ class Job(Task):
         if not self.state.tasks:
             raise error.ValidationError('Invalid job envelope')
 
-    def load(self, jobrecord):
+    def load(self, jobrecord, codec=None):
         '''
         Populate a job's state from a job record
         '''
-        self.state.load(jobrecord)
+        self.state.load(jobrecord, codec)
         if self.state.tasks:
             task_objects = []
             for task in self.state.tasks:
-                task_obj = Task(parent_id=self.state.id)
-                # Add values from new task object to those from the jobrecord
-                task_obj.state._state = dict(task_obj.state._state.items() +
-                                             task.items())
+                # Task fills in whatever the jobrecord leaves out
+                state = State()
+                state._update(task)
+                if state.parent_id is None:
+                    state.parent_id = self.state.id
+                task_obj = Task(state=state)
+                state.mark_clean()
                 task_objects.append(task_obj)
             self.state.tasks = task_objects
+        self.state.mark_clean()
+        self._index_tasks()
         return self
 
-    def save(self):
+    def _index_tasks(self):
         '''
-        Save a job's state as a job record
+        Build the task indexes and the reverse dependency graph.
+        Tasks are identified by their position in the task list; each
+        keeps a count of dependencies which have yet to succeed and the
+        ready set holds those with none left. Tasks are also counted by
+        status, as of when they were last counted (see _recount).
         '''
-        task_list = []
-        #let's preserve the tasks as we don't want to actually change them
-        original_tasks = self.state.tasks
+        tasks = self.state.tasks or []
+        self._tasks_by_name = {}
+        self._positions = {}
+        self._dependents = {}
+        self._unmet = {}
+        self._ready = set()
+        self._task_ids = tuple(task.state.id for task in tasks)
+        self._counted = [task.state.status for task in tasks]
+        self._statuses = Counter(self._counted)
+        for i, task in enumerate(tasks):
+            # First task with a given name wins, as get_tasks always did
+            self._tasks_by_name.setdefault(task.state.name, task)
+            self._positions[task.state.id] = i
+            task.state._tracker = self._dirty_tasks
+        for i, task in enumerate(tasks):
+            unmet = 0
+            for task_name in task.state.depends or []:
+                self._dependents.setdefault(task_name, []).append(i)
+                deptask = self._tasks_by_name.get(task_name)
+                if deptask is None or deptask.state.status != 'SUCCESS':
+                    unmet += 1
+            self._unmet[i] = unmet
+            self._stamp_end_time(task)
+            if unmet == 0 and task.state.status not in FINISHED:
+                self._ready.add(i)
+
+    def _stamp_end_time(self, task):
+        if task.state.status in FINISHED and task.state.end_time is None:
+            task.state.end_time = time.time()
+
+    def _status_changed(self, task, old_status):
+        '''
+        Propagate a task status transition to the tasks depending on it
+        '''
+        new_status = task.state.status
+        self._stamp_end_time(task)
+        if self._tasks_by_name.get(task.state.name) is not task:
+            return
+        if new_status == 'SUCCESS' and old_status != 'SUCCESS':
+            delta = -1
+        elif old_status == 'SUCCESS' and new_status != 'SUCCESS':
+            delta = 1
+        else:
+            return
+        for i in self._dependents.get(task.state.name, []):
+            self._unmet[i] += delta
+            if self._unmet[i] == 0:
+                self._ready.add(i)
+            else:
+                self._ready.discard(i)
+
+    def record(self):
+        '''
+        Job record of a job's state, not yet encoded
+        '''
+        record = self.state._state
         if self.state.tasks:
-            for task in self.state.tasks:
-                task_list.append(task.state._state)
-        self.state.tasks = task_list
-        #set the return and then put the tasks back how we found them
-        ret = self.state.save()
-        self.state.tasks = original_tasks
-        return ret
+            record['tasks'] = [task.state._state for task in self.state.tasks]
+        return record
+
+    def save(self, codec=None):
+        '''
+        Save a job's state as a job record
+        '''
+        if codec is None:
+            codec = serializer.get_codec()
+        return codec.dumps(self.record())
+
+    def task_ids(self):
+        '''Ids of the job's tasks, in order'''
+        if self._unmet is None:
+            self._index_tasks()
+        return self._task_ids
+
+    def dirty_tasks(self):
+        '''
+        Tasks changed since the job was last loaded or persisted
+        '''
+        if self._unmet is None:
+            return self.state.tasks or []
+        tasks = []
+        for task_id in self._dirty_tasks:
+            i = self._positions.get(task_id)
+            if i is not None and self.state.tasks[i].state.get_dirty():
+                tasks.append(self.state.tasks[i])
+        return tasks
+
+    def _recount(self):
+        '''
+        Bring the status counts up to date with the tasks changed since
+        the job was last persisted, the only ones which can have moved
+        '''
+        for task_id in self._dirty_tasks:
+            i = self._positions.get(task_id)
+            if i is None:
+                continue
+            status = self.state.tasks[i].state.status
+            if status != self._counted[i]:
+                self._statuses[self._counted[i]] -= 1
+                self._statuses[status] += 1
+                self._counted[i] = status
+
+    def mark_clean(self):
+        '''
+        Forget changes to the job and its tasks once they're persisted
+        '''
+        if self._unmet is not None:
+            self._recount()
+        for task in self.dirty_tasks():
+            task.state.mark_clean()
+        self._dirty_tasks.clear()
+        self.state.mark_clean()
+        return self
 
     def check_status(self):
-        statuses = []
-        for task in self.state.tasks:
-            statuses.append(task.state.status)
-        if any(status == 'FAILED' for status in statuses):
+        if self._unmet is None:
+            self._index_tasks()
+        self._recount()
+        statuses = self._statuses
+        total = len(self.state.tasks or [])
+        if statuses['FAILED']:
             return 'FAILED'
-        if any(status == 'RUNNING' for status in statuses):
+        if statuses['RUNNING'] or statuses['RETRYING']:
             return 'RUNNING'
-        if all(status == 'PENDING' for status in statuses):
+        if statuses['PENDING'] == total:
             return 'PENDING'
-        if all(status == 'SUCCESS' for status in statuses):
+        if statuses['SUCCESS'] == total:
             return 'SUCCESS'
         return 'UNKNOWN'
 
@@ -79,60 +213,90 @@ class Job(Task):
         self.state.status = self.check_status()
         return self
 
+    def get_task(self, task_id):
+        '''
+        Get the task object with the given id, or None
+        '''
+        if self._unmet is None:
+            self._index_tasks()
+        i = self._positions.get(task_id)
+        if i is None:
+            return None
+        return self.state.tasks[i]
+
     def get_tasks(self, task_name=None):
         '''
         Get task objects
         '''
         if not task_name:
             return self.state.tasks
-        for task in self.state.tasks:
-            if task.state.name == task_name:
-                return task
-        return None
+        if self._unmet is None:
+            self._index_tasks()
+        return self._tasks_by_name.get(task_name)
 
     def get_next_tasks_to_run(self):
         '''
         Examines task statues; returns list of next tasks to run
         '''
+        if self._unmet is None:
+            self._index_tasks()
         tasks_to_run = []
-        for task in self.state.tasks:
-            if task.state.status in ['SUCCESS', 'FAILED'] and task.state.end_time is None:
-                task.state.end_time = time.time()
-            if task.state.status in ['SUCCESS', 'FAILED',
-                                     'RUNNING', 'SUBMITTED']:
+        keep = []
+        ready = sorted(self._ready)
+        for i in ready:
+            task = self.state.tasks[i]
+            if task.state.status in FINISHED:
+                self._stamp_end_time(task)
+            elif task.state.status in ['RUNNING', 'SUBMITTED', 'RETRYING']:
+                # In flight; update_tasks puts it back if it comes back
+                # without having finished
                 pass
-            elif not task.state.depends and task.state.status == 'PENDING':
-                self.log.debug('Pending task {0} has no dependents; publishing\
-                    '.format(task.state.name))
-                tasks_to_run.append(task)
             else:
-                waiting_on_deptask = []
-                for task_name in task.state.depends:
-                    deptask = self.get_tasks(task_name)
-                    if deptask.state.status != 'SUCCESS':
-                        waiting_on_deptask.append(deptask.state.name)
-                if not waiting_on_deptask:
-                    tasks_to_run.append(task)
-                else:
-                    self.log.debug('Task {0} waiting on results of {1}'.format(
-                                   task.state.name, waiting_on_deptask))
+                self.log.debug('Task {0} has no outstanding dependencies; '
+                               'publishing'.format(task.state.name))
+                tasks_to_run.append(task)
+                keep.append(i)
+        if len(keep) < len(ready):
+            # A new set rather than discards: sets don't shrink, and
+            # iterating one costs as much as the most it ever held
+            self._ready = set(keep)
         return tasks_to_run
 
     def update_tasks(self, task, force=False):
         '''
         Update job with new task object
         '''
-        for i, t in enumerate(self.state.tasks):
-            if t.state.id == task.state.id:
-                self.log.debug('Updating task {0} with new results'.format(
-                    t.state.name))
-                if not force:
-                    #prevent updating parent_id, name and args
-                    task.state.name = t.state.name
-                    task.state.parent_id = t.state.parent_id
-                    task.state.args = t.state.args
-                    task.state.start_time = t.state.start_time
-                self.state.tasks[i] = task
+        if self._unmet is None:
+            self._index_tasks()
+        i = self._positions.get(task.state.id)
+        if i is None:
+            return self
+        t = self.state.tasks[i]
+        self.log.debug('Updating task {0} with new results'.format(
+            t.state.name))
+        if not force:
+            #prevent updating parent_id, name and args
+            task.state.name = t.state.name
+            task.state.parent_id = t.state.parent_id
+            task.state.args = t.state.args
+            task.state.start_time = t.state.start_time
+        # Carry over unsaved changes and flag whatever the update changed
+        task.state.mark_clean()
+        task.state._tracker = self._dirty_tasks
+        task.state.mark_dirty(*t.state.get_dirty())
+        # _state builds a dict each time it's read
+        old = t.state._state
+        task.state.mark_dirty(*[k for k, v in task.state._state.iteritems()
+                                if old.get(k) != v])
+        self.state.tasks[i] = task
+        if self._tasks_by_name.get(t.state.name) is t:
+            del self._tasks_by_name[t.state.name]
+            self._tasks_by_name[task.state.name] = task
+        self._status_changed(task, t.state.status)
+        if task.state.status in FINISHED:
+            self._ready.discard(i)
+        elif self._unmet[i] == 0:
+            self._ready.add(i)
         return self
 
     def update_task_args(self, task):
@@ -145,7 +309,7 @@ class Job(Task):
                                arg, task.state.name))
                 task_name, task_key = arg.lstrip('_').split('.')
                 source_task = self.get_tasks(task_name)
-                value = source_task.state.__getattr__(task_key)
+                value = getattr(source_task.state, task_key)
                 task.state.args[i] = value
         return task
 
@@ -160,6 +324,53 @@ class Job(Task):
                 task_name, task_key = var.lstrip('_').split('.')
                 source_task = self.get_tasks(task_name)
                 #Would be good to check this exists, catch error MMB
-                value = source_task.state.__getattr__(task_key)
+                value = getattr(source_task.state, task_key)
                 self.state.output[i] = value
         return self
+
+
+class JobSnapshot(object):
+    '''
+    What is written of a job, copied so the job can carry on changing
+    while it's written in the background: the job's own fields, and its
+    tasks changed since it was last persisted (all of them if full).
+    Backends write it as they would the job.
+    '''
+    def __init__(self, job, full=False):
+        self.full = full
+        self.state = job.state.copy()
+        tasks = (job.state.tasks or []) if full else job.dirty_tasks()
+        self._tasks = [task.copy() for task in tasks]
+        self._task_ids = job.task_ids()
+        self.state._update({'tasks': self._tasks if full else None})
+
+    def task_ids(self):
+        '''Ids of the job's tasks, in order'''
+        return self._task_ids
+
+    def dirty_tasks(self):
+        '''Tasks to be written'''
+        if self.full:
+            return self._tasks
+        return [task for task in self._tasks if task.state.get_dirty()]
+
+    def merge(self, older):
+        '''
+        Fold in the changes of an older snapshot of the job which never
+        got written
+        '''
+        self.state.mark_dirty(*older.state.get_dirty())
+        tasks = dict((task.state.id, task) for task in self._tasks)
+        for task in older._tasks:
+            newer = tasks.get(task.state.id)
+            if newer is not None:
+                newer.state.mark_dirty(*task.state.get_dirty())
+        if older.full and not self.full:
+            self._tasks = [tasks.get(task.state.id, task)
+                           for task in older._tasks]
+            self.full = True
+            self.state._update({'tasks': self._tasks})
+        elif not self.full:
+            self._tasks.extend(task for task in older._tasks
+                               if task.state.id not in tasks)
+        return self
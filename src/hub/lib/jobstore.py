@@ -0,0 +1,326 @@
+'''
+Live job state held by the dispatcher
+
+Classes:
+JobCache - LRU cache of live Job objects.
+JobWriter - background (write-behind) job persistence.
+'''
+# core modules
+import time
+import logging
+import threading
+from itertools import islice
+from collections import OrderedDict
+
+# own modules
+import hub.lib.error as error
+from hub.lib.jobs import FINISHED, JobSnapshot
+
+
+class JobCache(object):
+    '''
+    LRU cache of Job objects keyed by job id, holding up to size jobs.
+    Only finished jobs are evicted, so the cache grows past its size for
+    as long as more jobs than that are still running.
+    '''
+    def __init__(self, size=1000):
+        self.size = int(size)
+        self.log = logging.getLogger(__name__)
+        self._lock = threading.RLock()
+        self._active = {}
+        # Finished jobs, least recently used first
+        self._finished = OrderedDict()
+        # Task id -> job id for every cached job
+        self._task_jobs = {}
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._active) + len(self._finished)
+
+    def __contains__(self, job_id):
+        return job_id in self._active or job_id in self._finished
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._active.get(job_id)
+            if job is None:
+                job = self._finished.pop(job_id, None)
+                if job is not None:
+                    self._finished[job_id] = job
+            if job is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return job
+
+    def put(self, job):
+        '''
+        Add a job, or re-file it after its status may have changed
+        '''
+        job_id = job.state.id
+        with self._lock:
+            known = self._active.pop(job_id, None) or \
+                self._finished.pop(job_id, None)
+            if known is not job:
+                if known is not None:
+                    self._forget_tasks(known)
+                for task in job.state.tasks or []:
+                    self._task_jobs[task.state.id] = job_id
+            if job.state.status in FINISHED:
+                self._finished[job_id] = job
+            else:
+                self._active[job_id] = job
+            while len(self) > self.size and self._finished:
+                job_id, evicted = self._finished.popitem(last=False)
+                self._forget_tasks(evicted)
+                self.evictions += 1
+        return job
+
+    def _forget_tasks(self, job):
+        for task in job.state.tasks or []:
+            self._task_jobs.pop(task.state.id, None)
+
+    def discard(self, job_id):
+        with self._lock:
+            job = self._active.pop(job_id, None) or \
+                self._finished.pop(job_id, None)
+            if job is not None:
+                self._forget_tasks(job)
+
+    def job_ids(self):
+        with self._lock:
+            return self._active.keys() + self._finished.keys()
+
+    def find_job_id(self, task_id):
+        '''
+        Id of the cached job a task belongs to, or None
+        '''
+        return self._task_jobs.get(task_id)
+
+    def stats(self):
+        with self._lock:
+            return {'size': self.size, 'active': len(self._active),
+                    'finished': len(self._finished), 'hits': self.hits,
+                    'misses': self.misses, 'evictions': self.evictions}
+
+
+class JobWriter(object):
+    '''
+    Persists jobs on a background thread through a database pool.
+    Jobs are snapshotted when queued (see JobSnapshot); repeated writes of a job which hasn't
+    been written yet are coalesced, and everything waiting is written in
+    one transaction. barrier() blocks until given jobs are durable.
+    Writes which fail for want of the database are retried until they
+    succeed; once a job has failed max_attempts times, barrier() raises
+    DatabaseError for it instead of waiting. Writes the database refuses,
+    e.g. of a job whose id is taken, are dropped: barrier() raises
+    IntegrityError for the job until forget() is called for it.
+    '''
+    # Seconds to back off after a failed write
+    retry_interval = 1
+    max_attempts = 5
+
+    def __init__(self, pool, linger=0, batch_size=500):
+        self.pool = pool
+        # Seconds to wait for more work before writing a batch
+        self.linger = float(linger)
+        self.batch_size = int(batch_size)
+        self.log = logging.getLogger(__name__)
+        self._cond = threading.Condition()
+        # Job id -> [method, snapshot, attempts], oldest first
+        self._pending = OrderedDict()
+        self._writing = set()
+        # Job id -> error for jobs which failed max_attempts writes
+        self._failed = {}
+        # Job id -> error for jobs whose last write was refused
+        self._refused = {}
+        # Write attempts made, so barrier() can wait for the next one
+        self._rounds = 0
+        self._waiting = 0
+        self.writes = 0
+        self.batches = 0
+        self.errors = 0
+        self._thread = threading.Thread(target=self._run, name='JobWriter')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def put(self, job):
+        '''Queue a new job to be written in full.'''
+        self._queue('putjob', job)
+
+    def update(self, job):
+        '''Queue the changes to a job to be written.'''
+        self._queue('updatejob', job)
+
+    def _queue(self, method, job):
+        snapshot = JobSnapshot(job, full=method == 'putjob')
+        job.mark_clean()
+        with self._cond:
+            older = self._pending.pop(job.state.id, None)
+            if older is not None:
+                if older[0] == 'putjob':
+                    method = 'putjob'
+                snapshot.merge(older[1])
+            self._pending[job.state.id] = [method, snapshot, 0]
+            self._cond.notify_all()
+
+    def pending(self, job_id):
+        with self._cond:
+            return job_id in self._pending or job_id in self._writing
+
+    def written(self, *job_ids):
+        '''True if every write of the given jobs has been made.'''
+        with self._cond:
+            for job_id in job_ids:
+                if job_id in self._pending or job_id in self._writing or \
+                        job_id in self._failed or job_id in self._refused:
+                    return False
+            return True
+
+    def refused(self, *job_ids):
+        '''Those of the given jobs whose last write was refused.'''
+        with self._cond:
+            return [job_id for job_id in job_ids if job_id in self._refused]
+
+    def forget(self, *job_ids):
+        '''Stop reporting refused writes of the given jobs.'''
+        with self._cond:
+            for job_id in job_ids:
+                self._refused.pop(job_id, None)
+
+    def barrier(self, *job_ids):
+        '''
+        Wait until the given jobs (or every job if none are given) have
+        been written. Raises DatabaseError if any of them can't be for
+        now, and IntegrityError if a write of one of the given jobs was
+        refused.
+        '''
+        def busy():
+            if not job_ids:
+                return self._pending or self._writing
+            for job_id in job_ids:
+                if job_id in self._pending or job_id in self._writing:
+                    return True
+            return False
+
+        def failed():
+            if not job_ids:
+                return self._failed.keys()
+            return [job_id for job_id in job_ids if job_id in self._failed]
+        with self._cond:
+            self._waiting += 1
+            self._cond.notify_all()
+            # Jobs which failed before are given one more try
+            rounds = self._rounds
+            try:
+                while busy():
+                    if self._rounds > rounds and failed():
+                        break
+                    self._cond.wait()
+                refused = [job_id for job_id in job_ids
+                           if job_id in self._refused]
+                if refused:
+                    raise error.IntegrityError(
+                        'Refused to write jobs {0}: {1}'.format(
+                            ', '.join(refused), self._refused[refused[0]]))
+                unwritten = failed()
+                if unwritten:
+                    raise error.DatabaseError(
+                        'Failed to write jobs {0}: {1}'.format(
+                            ', '.join(unwritten),
+                            self._failed[unwritten[0]]))
+            finally:
+                self._waiting -= 1
+
+    def _take(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            if self.linger and not self._waiting:
+                deadline = time.time() + self.linger
+                while len(self._pending) < self.batch_size and \
+                        not self._waiting:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self._cond.wait(remaining)
+            batch = []
+            # Jobs which failed to be written are retried on their own, so
+            # one which can't be written doesn't hold up the others
+            job_id, item = next(self._pending.iteritems())
+            if item[2]:
+                self._pending.popitem(last=False)
+                self._writing.add(job_id)
+                return [(job_id, item)]
+            for job_id, item in islice(self._pending.iteritems(),
+                                       self.batch_size):
+                if item[2]:
+                    break
+                batch.append((job_id, item))
+            for job_id, item in batch:
+                del self._pending[job_id]
+                self._writing.add(job_id)
+            return batch
+
+    def _run(self):
+        while True:
+            batch = self._take()
+            try:
+                with self.pool.transaction():
+                    for job_id, (method, job, attempts) in batch:
+                        self.pool.call(method, job)
+                self.writes += len(batch)
+                self.batches += 1
+                failed = []
+            except Exception, e:
+                self.errors += 1
+                self.log.error('Failed to write {0} jobs: {1}'.format(
+                               len(batch), e))
+                self.log.exception(e)
+                failed = batch
+            # Anything but a DatabaseError is the database refusing one of
+            # the jobs, which won't be any different next time: once it's
+            # been tried on its own, the job is dropped
+            refused = failed and not isinstance(e, error.DatabaseError)
+            with self._cond:
+                if not failed:
+                    for job_id, item in batch:
+                        self._failed.pop(job_id, None)
+                        self._refused.pop(job_id, None)
+                elif refused and len(batch) == 1:
+                    job_id, item = batch[0]
+                    self.log.error('Dropping job {0}: {1}'.format(job_id, e))
+                    self._pending.pop(job_id, None)
+                    self._failed.pop(job_id, None)
+                    self._refused[job_id] = e
+                    failed = []
+                for job_id, item in failed:
+                    item[2] += 1
+                    if item[2] >= self.max_attempts and not refused and \
+                            job_id not in self._failed:
+                        self.log.error('Failed to write job {0} {1} times, '
+                                       'still retrying'.format(job_id,
+                                                               item[2]))
+                        self._failed[job_id] = e
+                    newer = self._pending.pop(job_id, None)
+                    if newer is not None:
+                        newer[1].merge(item[1])
+                        if item[0] == 'putjob':
+                            newer[0] = 'putjob'
+                        newer[2] = item[2]
+                        item = newer
+                    self._pending[job_id] = item
+                self._writing.clear()
+                self._rounds += 1
+                self._cond.notify_all()
+            if failed and not refused:
+                time.sleep(self.retry_interval)
+
+    def stats(self):
+        with self._cond:
+            return {'pending': len(self._pending), 'writes': self.writes,
+                    'batches': self.batches, 'errors': self.errors,
+                    'failed': len(self._failed),
+                    'refused': len(self._refused)}
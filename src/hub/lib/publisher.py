@@ -0,0 +1,111 @@
+'''
+Long lived message publishing
+
+Classes:
+Publisher - reconnecting, optionally batching, publisher.
+'''
+# core modules
+import time
+import logging
+from collections import deque
+
+# own modules
+import hub.lib.error as error
+
+# 3rd party modules
+import pika
+
+# Failures after which the connection is re-established
+CONNECTION_ERRORS = (pika.exceptions.AMQPConnectionError,
+                     pika.exceptions.ConnectionClosed,
+                     pika.exceptions.ChannelClosed)
+
+
+class Publisher(object):
+    '''
+    Publishes messages over one persistent connection to the broker,
+    reconnecting if it drops. Messages may be batched, in which case they
+    are sent once batch_size are waiting or the oldest has waited
+    batch_interval seconds, whichever comes first. With confirm set, each
+    message is sent only once the broker has said it has taken it.
+    '''
+    def __init__(self, broker, batch_size=1, batch_interval=0, confirm=False):
+        self.broker = broker
+        self.batch_size = max(int(batch_size), 1)
+        self.batch_interval = float(batch_interval)
+        self.confirm = confirm
+        self.log = logging.getLogger(__name__)
+        self.conn = None
+        self.channel = None
+        self._batch = deque()
+        self._oldest = None
+
+    def _connect(self):
+        try:
+            self.conn = pika.BlockingConnection(pika.ConnectionParameters(
+                                                host=self.broker))
+            self.channel = self.conn.channel()
+            if self.confirm:
+                self.channel.confirm_delivery()
+        except pika.exceptions.AMQPConnectionError, e:
+            self.conn = self.channel = None
+            msg = ('Problem connectting to broker {0}'.format(self.broker))
+            self.log.error(msg)
+            raise error.MessagingError(msg, e)
+
+    def _send(self, exchange, routing_key, body, properties):
+        if self.channel is None:
+            self._connect()
+        try:
+            sent = self.channel.basic_publish(exchange=exchange,
+                                              routing_key=routing_key,
+                                              properties=properties, body=body)
+        except CONNECTION_ERRORS, e:
+            self.log.warn('Lost connection to broker {0} ({1}); '
+                          'reconnecting'.format(self.broker, e))
+            self._connect()
+            sent = self.channel.basic_publish(exchange=exchange,
+                                              routing_key=routing_key,
+                                              properties=properties, body=body)
+        # False only if confirming and the broker refused it
+        if sent is False:
+            raise error.MessagingError(
+                'Broker did not take message for {0}'.format(routing_key))
+
+    def publish(self, routing_key, body, properties=None, exchange=''):
+        '''
+        Queue a message for publishing, sending the batch if it's full.
+        Returns True if the message has been sent.
+        '''
+        if not self._batch:
+            self._oldest = time.time()
+        self._batch.append((exchange, routing_key, body, properties))
+        if len(self._batch) >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def pending(self):
+        '''Number of messages waiting to be sent.'''
+        return len(self._batch)
+
+    def due(self):
+        '''True if the waiting batch has reached its time limit.'''
+        return bool(self._batch) and \
+            time.time() - self._oldest >= self.batch_interval
+
+    def flush(self):
+        '''Send every waiting message.'''
+        while self._batch:
+            self._send(*self._batch[0])
+            self._batch.popleft()
+
+    def discard(self):
+        '''Drop every waiting message.'''
+        self._batch.clear()
+
+    def close(self):
+        self.flush()
+        if self.conn is not None:
+            self.conn.close()
+        self.conn = self.channel = None
@@ -0,0 +1,124 @@
+'''
+Memoized task results
+
+Tasks declared cacheable (e.g. @task(cache=True, ttl=3600)) have their
+results kept in the database, keyed by a digest of their task name, their
+arguments and the version of the task's code, so the dispatcher can
+complete the same task run again, in any job, without sending it to a
+worker.
+
+Functions:
+result_key - the key of a task's result.
+
+Classes:
+ResultCache - cached results as seen by the dispatcher.
+'''
+# core modules
+import json
+import time
+import hashlib
+import logging
+
+
+def result_key(task_name, args, version=''):
+    '''
+    Stable digest of a task name, its arguments (after substitution) and
+    its version, or None if the arguments can't be hashed (e.g. binary
+    data)
+    '''
+    try:
+        text = json.dumps([task_name, args, version or ''], sort_keys=True,
+                          separators=(',', ':'))
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(text).hexdigest()
+
+
+class ResultCache(object):
+    '''
+    Results are cached for ttl seconds unless their task says otherwise,
+    and no more than max_entries are kept, the least recently used going
+    first. Only tasks of types results have been cached for are looked up,
+    and only results made by the latest version of a task seen: a result
+    from a new version of the task, or one which no longer asks to be
+    cached, makes those cached before unreachable.
+    '''
+    def __init__(self, pool, ttl=86400, max_entries=10000):
+        self.pool = pool
+        self.ttl = float(ttl)
+        self.max_entries = int(max_entries)
+        self.log = logging.getLogger(__name__)
+        # Task name -> version of the latest result cached for it
+        self.versions = {}
+        self.hits = 0
+        self.misses = 0
+        self.stores = 0
+        self._since_trim = 0
+        # Key -> time of results used since the database was last told
+        self._used = {}
+
+    def load(self):
+        '''Learn which task types have results cached, e.g. on starting.'''
+        self.versions.update(self.pool.call('getresulttypes'))
+
+    def get(self, task_name, args):
+        '''
+        Return [result] if one is cached for the task run with args,
+        otherwise None
+        '''
+        if task_name not in self.versions:
+            return None
+        key = result_key(task_name, args, self.versions[task_name])
+        if key is None:
+            return None
+        found = self.pool.call('getresult', key)
+        if found is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+            # Only needed for trimming, so written a batch at a time
+            self._used[key] = time.time()
+            if len(self._used) >= self._trim_every():
+                self._touch()
+        return found
+
+    def _trim_every(self):
+        return max(self.max_entries / 10, 1)
+
+    def _touch(self):
+        '''Tell the database which results have been used lately.'''
+        if self._used:
+            used, self._used = self._used, {}
+            self.pool.call('touchresults', used)
+
+    def put(self, task_name, args, value, ttl=None, version=None):
+        '''Cache the result of a task run with args.'''
+        version = version or ''
+        key = result_key(task_name, args, version)
+        if key is None:
+            return
+        if self.versions.get(task_name) != version:
+            self.log.info('Caching results of task {0} version {1}'.format(
+                          task_name, version))
+        self.versions[task_name] = version
+        self.pool.call('putresult', key, task_name, value,
+                       float(ttl or self.ttl), version)
+        self.stores += 1
+        # Evicting scans the cache, so is done every so often
+        self._since_trim += 1
+        if self._since_trim >= self._trim_every():
+            self._since_trim = 0
+            self._touch()
+            self.pool.call('trimresults', self.max_entries)
+
+    def forget(self, task_name):
+        '''Stop caching the results of a task which no longer asks for it.'''
+        if self.versions.pop(task_name, None) is None:
+            return
+        self.log.info('No longer caching results of task {0}'.format(
+                      task_name))
+        self.pool.call('dropresulttype', task_name)
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'stores': self.stores, 'task_types': len(self.versions)}
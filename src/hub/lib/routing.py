@@ -0,0 +1,56 @@
+'''
+Routing of tasks to workers
+
+Tasks are published to the 'hub_tasks' topic exchange with the routing key
+'task.<task_name>'. Workers which host particular task types consume a
+queue per type, 'hub_tasks.<task_name>', bound to the exchange by that
+key. Tasks of types no queue is bound for go on, through the exchange's
+alternate exchange, to the catch-all 'hub_tasks' queue, which workers
+able to run any task consume.
+
+With priorities set, task queues take AMQP message priorities from 0 up
+to that many; everyone declaring them must agree on the number.
+
+Functions:
+routing_key - the routing key for tasks of a type.
+declare - declare the exchanges and the catch-all queue.
+declare_task_queue - declare the queue of one task type.
+'''
+# Topic exchange tasks are published to
+EXCHANGE = 'hub_tasks'
+# Fanout exchange taking tasks nothing else is bound for
+UNROUTED = 'hub_tasks.unrouted'
+# Queue of tasks of any type
+CATCH_ALL = 'hub_tasks'
+
+
+def routing_key(task_name):
+    return 'task.{0}'.format(task_name or '')
+
+
+def _queue_arguments(priorities):
+    if not int(priorities):
+        return None
+    return {'x-max-priority': int(priorities)}
+
+
+def declare(channel, priorities=0):
+    '''Declare the task exchanges and the catch-all queue.'''
+    channel.exchange_declare(exchange=UNROUTED, exchange_type='fanout')
+    channel.exchange_declare(exchange=EXCHANGE, exchange_type='topic',
+                             arguments={'alternate-exchange': UNROUTED})
+    channel.queue_declare(queue=CATCH_ALL,
+                          arguments=_queue_arguments(priorities))
+    channel.queue_bind(queue=CATCH_ALL, exchange=UNROUTED)
+
+
+def declare_task_queue(channel, task_name, priorities=0):
+    '''
+    Declare the queue of tasks of one type, from then on routed there
+    rather than to the catch-all queue. Returns its name.
+    '''
+    queue = '{0}.{1}'.format(CATCH_ALL, task_name)
+    channel.queue_declare(queue=queue, arguments=_queue_arguments(priorities))
+    channel.queue_bind(queue=queue, exchange=EXCHANGE,
+                       routing_key=routing_key(task_name))
+    return queue
@@ -0,0 +1,121 @@
+'''
+Deadline scheduling for the dispatcher
+
+Classes:
+Scheduler - runs callbacks at given times, timed by a single thread.
+'''
+# core modules
+import time
+import heapq
+import logging
+import itertools
+import threading
+
+
+class Scheduler(object):
+    '''
+    Runs callbacks at given times from one thread, using a heap of
+    deadlines. Each callback is scheduled under a key (e.g. a task id) by
+    which it can be cancelled or rescheduled. If handoff is given, due
+    callbacks are passed to handoff(callback, args) to be run elsewhere
+    (e.g. on a thread which owns a connection) rather than run here.
+    '''
+    def __init__(self, handoff=None):
+        self.log = logging.getLogger(__name__)
+        self.handoff = handoff
+        self._cond = threading.Condition()
+        self._heap = []
+        # Key -> heap entry [when, seq, key, callback, args]
+        self._entries = {}
+        # Cancelled entries still in the heap
+        self._cancelled = 0
+        self._seq = itertools.count()
+        self._thread = None
+        self.fired = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='Scheduler')
+                self._thread.daemon = True
+                self._thread.start()
+        return self
+
+    def schedule(self, key, when, callback, *args):
+        '''
+        Call callback(*args) at time when, replacing anything already
+        scheduled under key
+        '''
+        with self._cond:
+            self._cancel(key)
+            entry = [when, next(self._seq), key, callback, args]
+            self._entries[key] = entry
+            heapq.heappush(self._heap, entry)
+            if self._heap[0] is entry:
+                self._cond.notify()
+
+    def cancel(self, key):
+        '''Forget whatever is scheduled under key, if anything.'''
+        with self._cond:
+            self._cancel(key)
+
+    def cancel_matching(self, predicate):
+        '''
+        Forget everything scheduled for which predicate(key, args) is true
+        '''
+        with self._cond:
+            for key, entry in self._entries.items():
+                if predicate(key, entry[4]):
+                    self._cancel(key)
+
+    def _cancel(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        # Left in the heap and skipped when it comes up, unless enough
+        # have built up to be worth rebuilding the heap without them
+        entry[3] = None
+        self._cancelled += 1
+        if self._cancelled > 64 and self._cancelled > len(self._heap) / 2:
+            self._heap = [e for e in self._heap if e[3] is not None]
+            heapq.heapify(self._heap)
+            self._cancelled = 0
+
+    def _next(self):
+        '''Wait for the next entry to come due and take it off the heap.'''
+        with self._cond:
+            while True:
+                while self._heap and self._heap[0][3] is None:
+                    heapq.heappop(self._heap)
+                    self._cancelled -= 1
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+                delay = self._heap[0][0] - time.time()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                entry = heapq.heappop(self._heap)
+                del self._entries[entry[2]]
+                return entry
+
+    def _run(self):
+        while True:
+            when, seq, key, callback, args = self._next()
+            self.fired += 1
+            try:
+                if self.handoff is not None:
+                    self.handoff(callback, args)
+                else:
+                    callback(*args)
+            except Exception, e:
+                self.log.error('Scheduled call for {0} failed'.format(key))
+                self.log.exception(e)
+
+    def stats(self):
+        with self._cond:
+            return {'scheduled': len(self._entries), 'fired': self.fired}
@@ -0,0 +1,76 @@
+'''
+Encodings for messages and stored records
+
+Codecs are identified by the MIME type carried in a message's AMQP
+content_type, so whoever receives a message can decode it and answer in
+kind. JSON is the default; msgpack is available if installed.
+
+Classes:
+JsonCodec - JSON, the default.
+MsgpackCodec - msgpack, binary and faster for large payloads.
+'''
+# own modules
+import hub.lib.error as error
+
+# 3rd party modules
+import json
+
+JSON = 'application/json'
+MSGPACK = 'application/x-msgpack'
+# Replies saying why a request couldn't be answered are plain text, in
+# whatever encoding the request came
+TEXT = 'text/plain'
+
+
+class JsonCodec(object):
+    content_type = JSON
+
+    def dumps(self, obj):
+        return json.dumps(obj)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+class MsgpackCodec(object):
+    '''
+    Strings stay strings and byte strings stay bytes, so binary task data
+    goes over the wire as is
+    '''
+    content_type = MSGPACK
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise error.SerializationError(
+                'The msgpack serializer needs the msgpack module installed')
+        self.msgpack = msgpack
+
+    def dumps(self, obj):
+        return self.msgpack.packb(obj, use_bin_type=True)
+
+    def loads(self, data):
+        return self.msgpack.unpackb(data, raw=False)
+
+
+# Codec classes by content type, and short names accepted in config files
+CODECS = {JSON: JsonCodec, MSGPACK: MsgpackCodec}
+NAMES = {'json': JSON, 'msgpack': MSGPACK}
+
+# Codec instances, created on first use
+_codecs = {}
+
+
+def get_codec(content_type=None):
+    '''
+    Return the codec for a content type or short name, JSON if None
+    '''
+    content_type = NAMES.get(content_type, content_type) or JSON
+    codec = _codecs.get(content_type)
+    if codec is None:
+        if content_type not in CODECS:
+            raise error.SerializationError(
+                'Unknown serializer {0}'.format(content_type))
+        codec = _codecs[content_type] = CODECS[content_type]()
+    return codec
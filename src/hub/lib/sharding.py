@@ -0,0 +1,157 @@
+'''
+Partitioning of jobs between dispatcher instances
+
+Jobs are split into a fixed number of shards by a hash of their id. Each
+shard is handled by one dispatcher instance at a time, which holds a
+lease on it in the database. Shards are spread over the live instances
+by rendezvous hashing, so an instance joining or leaving only moves the
+shards it gains or gives up.
+
+Functions:
+shard_of - the shard a job id belongs to.
+owner - the instance a shard belongs with.
+
+Classes:
+ShardMap - the shards held by one dispatcher instance.
+'''
+# core modules
+import os
+import time
+import zlib
+import uuid
+import socket
+import hashlib
+import logging
+
+
+def shard_of(job_id, shards):
+    '''Shard a job id belongs to, out of shards.'''
+    return (zlib.crc32(str(job_id)) & 0xffffffff) % shards
+
+
+def owner(shard, instances):
+    '''
+    The instance, out of the given instance ids, a shard belongs with
+    '''
+    return max(instances, key=lambda instance: hashlib.md5(
+        '{0}/{1}'.format(instance, shard)).digest())
+
+
+class ShardMap(object):
+    '''
+    The shards one dispatcher instance holds leases on. Leases last
+    lease_ttl seconds and must be renewed well within that; an instance
+    which stops renewing (e.g. dies) loses its shards to the others.
+    A lease which isn't renewed in time stops being held here too, a
+    little before another instance can take it.
+    '''
+    # Part of a lease counted on locally, leaving room for clock skew
+    safety = 0.9
+
+    def __init__(self, pool, shards, instance_id=None, lease_ttl=30):
+        self.pool = pool
+        self.shards = int(shards)
+        if not instance_id:
+            instance_id = '{0}:{1}'.format(socket.gethostname(), os.getpid())
+        self.instance_id = instance_id
+        self.lease_ttl = float(lease_ttl)
+        self.log = logging.getLogger(__name__)
+        self.held = set()
+        # Shard -> time its lease runs out, as far as this instance knows
+        self.expires = {}
+
+    def shard_of(self, job_id):
+        return shard_of(job_id, self.shards)
+
+    def owns(self, job_id):
+        shard = self.shard_of(job_id)
+        return shard in self.held and self.expires[shard] > time.time()
+
+    def next_expiry(self):
+        '''Time the first held lease runs out, or None if none are held.'''
+        if not self.held:
+            return None
+        return min(self.expires[shard] for shard in self.held)
+
+    def _leased(self, shard, since):
+        '''Hold a shard whose lease was taken or renewed at since.'''
+        self.held.add(shard)
+        self.expires[shard] = since + self.lease_ttl * self.safety
+
+    def new_id(self):
+        '''
+        A new job id in one of the held shards, or None if none are held
+        '''
+        now = time.time()
+        if not [shard for shard in self.held if self.expires[shard] > now]:
+            return None
+        while True:
+            job_id = str(uuid.uuid1())
+            if self.owns(job_id):
+                return job_id
+
+    def wanted(self):
+        '''
+        Announce this instance as live and return the shards which belong
+        with it among all the live instances
+        '''
+        instances = list(self.pool.call('heartbeat', self.instance_id,
+                                        self.lease_ttl))
+        if self.instance_id not in instances:
+            instances.append(self.instance_id)
+        return set(shard for shard in range(self.shards)
+                   if owner(shard, instances) == self.instance_id)
+
+    def renew(self):
+        '''
+        Renew the leases on held shards; returns any which couldn't be
+        (they have been taken over, or ran out while the database couldn't
+        be reached) and are no longer held
+        '''
+        lost = set()
+        for shard in list(self.held):
+            since = time.time()
+            try:
+                if self.pool.call('acquirelease', shard, self.instance_id,
+                                  self.lease_ttl):
+                    self._leased(shard, since)
+                    continue
+                lost.add(shard)
+            except Exception, e:
+                self.log.error('Failed to renew the lease on shard {0}: '
+                               '{1}'.format(shard, e))
+                if self.expires[shard] <= time.time():
+                    lost.add(shard)
+        if lost:
+            self.log.warn('Lost the leases on shards {0}'.format(
+                          sorted(lost)))
+        for shard in lost:
+            self.held.discard(shard)
+            self.expires.pop(shard, None)
+        return lost
+
+    def acquire(self, shard):
+        '''
+        Take the lease on a shard if it's free. Returns True if taken.
+        '''
+        since = time.time()
+        if self.pool.call('acquirelease', shard, self.instance_id,
+                          self.lease_ttl):
+            self._leased(shard, since)
+            return True
+        return False
+
+    def release(self, shard):
+        self.held.discard(shard)
+        self.expires.pop(shard, None)
+        self.pool.call('releaselease', shard, self.instance_id)
+
+    def leave(self):
+        '''Give up every shard and stop announcing this instance.'''
+        for shard in list(self.held):
+            self.release(shard)
+        self.pool.call('retire', self.instance_id)
+
+    def stats(self):
+        return {'instance': self.instance_id, 'shards': self.shards,
+                'held': sorted(self.held)}
@@ -5,6 +5,7 @@ Hub task routines
 import os
 import uuid
 import logging
+import threading
 import subprocess
 from tempfile import NamedTemporaryFile
 
@@ -23,7 +24,8 @@ class Task(object):
     '''
     Superclass for all Task objects. Tasks are defined units of work
     '''
-    def __init__(self, state=None, parent_id=None, async=False):
+    def __init__(self, state=None, parent_id=None, async=False, cache=False,
+                 ttl=None):
         self.log = logging.getLogger(__name__)
         if not state:
             state = State()
@@ -34,6 +36,10 @@ class Task(object):
             if self.__class__.__name__ == 'Job':
                 self.state.start_time = time.time()
         self.async = async
+        # Pure tasks may have their results cached for ttl seconds (the
+        # dispatcher's default if None) and reused for the same arguments
+        self.cache = cache
+        self.ttl = ttl
         if not self.state.id:
             self.state.id = uuid.uuid1().__str__()
         if not self.state.task_name:
@@ -52,12 +58,24 @@ class Task(object):
         if not self.name:
             raise error.ValidationError('Invalid task format')
 
-    def load(self, taskrecord):
-        self.state.load(taskrecord)
+    def load(self, taskrecord, codec=None):
+        self.state.load(taskrecord, codec)
         return self
 
-    def save(self):
-        return self.state.save()
+    def save(self, codec=None):
+        return self.state.save(codec)
+
+    def copy(self, state=None):
+        '''
+        Copy of the task with its own shallow copy of the state, or with
+        the given state
+        '''
+        task = self.__class__.__new__(self.__class__)
+        task.__dict__.update(self.__dict__)
+        if state is None:
+            state = self.state.copy()
+        task.state = state
+        return task
 
     def set_status(self, status):
         self.state.status = status
@@ -95,6 +113,9 @@ class WrappedCallableTask(Task):
     Generally used via @task decorator and not directly.
     '''
     def __init__(self, callable, *args, **kwargs):
+        # The wrapped task lives at module level in its plugin, so every
+        # thread running it gets its own state
+        self._local = threading.local()
         super(WrappedCallableTask, self).__init__(*args, **kwargs)
         self.wrapped = callable
         if hasattr(callable, '__name__'):
@@ -108,6 +129,17 @@ class WrappedCallableTask(Task):
     def run(self, *args, **kwargs):
         return self.wrapped(*args, **kwargs)
 
+    def _get_state(self):
+        state = getattr(self._local, 'state', None)
+        if state is None:
+            state = self._local.state = State()
+        return state
+
+    def _set_state(self, state):
+        self._local.state = state
+
+    state = property(_get_state, _set_state)
+
     # This allows us to add/retrive arbitrary attributes from the task
     # Won't work until we move task data into it's own context object
     # and revert to normal get/set attr methods in the Task class
@@ -5,17 +5,231 @@ This is the Hub worker which processes tasks on behalf of the dispatcher.
 # core modules
 import os
 import sys
+import time
+import Queue
 import logging
+import threading
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 
 # own modules
+import hub.lib.api as api
 import hub.lib.error as error
 import hub.lib.config as config
-from hub.lib.common import Daemon
+from hub.lib.common import Daemon, State
+from hub.lib.tasks import Task
+from hub.lib.publisher import Publisher
+import hub.lib.serializer as serializer
+import hub.lib.blobstore as blobstore
+import hub.lib.routing as routing
 
 # 3rd party modules
 import pika
 import json
 
+log = logging.getLogger(__name__)
+
+# The worker's TaskLoader, inherited by pool processes
+loader = None
+# The worker's BlobStore if one is configured, likewise
+blobs = None
+
+
+class TaskLoader(object):
+    '''
+    Imports task plugins from a directory the first time one of their
+    tasks is asked for, and reloads plugins whose files change
+    '''
+    def __init__(self, tasks_dir, reload_interval=0):
+        self.tasks_dir = tasks_dir
+        self.reload_interval = float(reload_interval)
+        self.log = logging.getLogger(__name__)
+        self.lock = threading.RLock()
+        sys.path.append(self.tasks_dir)
+        # Plugin name -> mtime of its file as last indexed
+        self.index = {}
+        # Plugin name -> mtime of its file when imported (or failed to)
+        self.loaded = {}
+        self.modules = {}
+        # Plugin name -> names of the tasks it registered
+        self.provides = {}
+        self.last_scan = 0
+        self.refresh()
+
+    def _scan(self):
+        index = {}
+        for found_plugin in os.listdir(self.tasks_dir):
+            if found_plugin.endswith('.py'):
+                plugin_name = found_plugin.rpartition('.py')[0]
+                path = os.path.join(self.tasks_dir, found_plugin)
+                try:
+                    index[plugin_name] = os.path.getmtime(path)
+                except OSError:
+                    pass
+        return index
+
+    def _import(self, plugin_name):
+        before = dict(api.registry)
+        self.loaded[plugin_name] = self.index[plugin_name]
+        try:
+            if plugin_name in self.modules:
+                self.log.info('Reloading task {0}'.format(plugin_name))
+                # Don't let a same-second .pyc mask the change
+                try:
+                    os.remove(os.path.join(self.tasks_dir,
+                                           plugin_name + '.pyc'))
+                except OSError:
+                    pass
+                module = reload(self.modules[plugin_name])
+            else:
+                self.log.debug('Importing task {0}'.format(plugin_name))
+                module = __import__(plugin_name)
+        except Exception, e:
+            self.log.warn('Failed to import task {0}'.format(plugin_name))
+            self.log.exception(e)
+            return None
+        self.modules[plugin_name] = module
+        provides = [name for name, task in api.registry.iteritems()
+                    if before.get(name) is not task]
+        # Tasks not declared with @task still dispatch on the name of
+        # their module
+        task = getattr(module, plugin_name, None)
+        if isinstance(task, Task) and plugin_name not in api.registry:
+            api.register(task, plugin_name)
+            provides.append(plugin_name)
+        self._unregister(plugin_name, keep=provides)
+        self.provides[plugin_name] = provides
+        self.log.debug('Task {0} provides {1}'.format(plugin_name, provides))
+        return module
+
+    def _unregister(self, plugin_name, keep=()):
+        for name in self.provides.pop(plugin_name, []):
+            if name not in keep:
+                api.registry.pop(name, None)
+
+    def refresh(self):
+        '''
+        Re-index the plugin directory, reloading changed plugins which are
+        already imported and forgetting deleted ones. Tasks already running
+        keep the task object they started with.
+        '''
+        with self.lock:
+            self.last_scan = time.time()
+            self.index = self._scan()
+            for plugin_name in self.loaded.keys():
+                if plugin_name not in self.index:
+                    self.log.info('Task {0} removed'.format(plugin_name))
+                    self._unregister(plugin_name)
+                    self.loaded.pop(plugin_name)
+                    self.modules.pop(plugin_name, None)
+                elif self.index[plugin_name] != self.loaded[plugin_name]:
+                    self._import(plugin_name)
+
+    def version(self, task_name):
+        '''
+        Version of a registered task, changing whenever its plugin is
+        reloaded: the plugin's name and the modification time of its
+        file. None for tasks not imported from a plugin.
+        '''
+        with self.lock:
+            for plugin_name, provides in self.provides.iteritems():
+                if task_name in provides:
+                    return '{0}:{1}'.format(plugin_name,
+                                            self.loaded[plugin_name])
+        return None
+
+    def find(self, *names):
+        '''
+        Return the first of the given task names which is registered,
+        importing plugins as needed, or None
+        '''
+        with self.lock:
+            if self.reload_interval and \
+                    time.time() - self.last_scan >= self.reload_interval:
+                self.refresh()
+            for name in names:
+                if name in api.registry:
+                    return name
+            # Plugins are usually named after their task
+            for name in names:
+                if name in self.index and name not in self.loaded:
+                    self._import(name)
+                    if name in api.registry:
+                        return name
+            # Otherwise the task may be exported by any plugin not yet seen
+            for plugin_name in self.index.keys():
+                if plugin_name not in self.loaded:
+                    self._import(plugin_name)
+            for name in names:
+                if name in api.registry:
+                    return name
+        return None
+
+
+def run_task(task_name, taskrecord, content_type=None):
+    '''
+    Run the registered task with the arguments in its task record and
+    return the saved task state, encoded like the record. Module level so
+    it can be handed to a thread or process pool. Never raises: whatever
+    goes wrong, a FAILED task record is returned, so the task message is
+    always answered and acknowledged.
+    '''
+    codec = serializer.get_codec(content_type)
+    try:
+        return _run_task(task_name, taskrecord, codec)
+    except Exception, e:
+        log.error('task {0} failed'.format(task_name))
+        log.exception(e)
+        return _failed(taskrecord, codec, e)
+
+
+def _failed(taskrecord, codec, e):
+    '''The task record marked as FAILED with the given exception.'''
+    state = State()
+    state.load(taskrecord, codec)
+    state.status = 'FAILED'
+    state.msg = str(e)
+    # For matching against the task's retry_on
+    state.exception = e.__class__.__name__
+    return state.save(codec)
+
+
+def _run_task(task_name, taskrecord, codec):
+    # Pool processes were forked before the plugin may have been imported
+    if loader is not None:
+        loader.find(task_name)
+    # The plugin may have been reloaded without the task since the worker
+    # looked for it
+    task = api.registry.get(task_name)
+    if task is None:
+        raise error.HubError('No task module found for task {0}'.format(
+                             task_name))
+    # The registered task is shared by every run, in every thread of the
+    # pool; each run has its own copy, starting from a clean state
+    task = task.copy(State())
+    task.load(taskrecord, codec)
+    args = task.state.args or []
+    kwargs = {}
+    log.info('Running task: {0}'.format(task.state.name))
+    # Arguments held in the blob store are fetched only now, leaving the
+    # references in the task record
+    if blobs is not None:
+        args = blobs.resolve(args)
+    task.state.data = task(*args, **kwargs)
+    if blobs is not None:
+        task.state.data = blobs.offload(task.state.data, codec)
+    if task.async:
+        task.state.status = 'RUNNING'
+    else:
+        task.state.status = 'SUCCESS'
+        if task.cache:
+            # Tells the dispatcher to cache the result, for as long as the
+            # task's code doesn't change
+            task.state.cache_ttl = task.ttl or 0
+            if loader is not None:
+                task.state.cache_version = loader.version(task_name)
+    return task.save(codec)
+
 
 class WorkerDaemon(Daemon):
     '''
@@ -34,64 +248,93 @@ class Worker():
     '''
     Class representing workers that processes tasks.
     '''
-    def __init__(self, tasks_dir):
+    # Seconds between checks for results from the task pool
+    poll_interval = 0.05
+
+    def __init__(self, tasks_dir, concurrency=None, pool=None):
         '''Load all worker task plugins, connect to messaging system.'''
         self.log = logging.getLogger(__name__)
-        self.modules = self._load_task_modules(tasks_dir)
-
-    def _load_task_modules(self, tasks_dir):
-        self.tasks_dir = tasks_dir
-        os.sys.path.append(self.tasks_dir)
-        plugins = []
-        modules = []
-        # Scan the plugins directory for files ending in .py and import them
-        for found_plugin in os.listdir(self.tasks_dir):
-            if found_plugin.endswith('.py'):
-                plugin_name = found_plugin.rpartition('.py')[0]
-                try:
-                    self.log.debug('Importing task {0}'.format(
-                        plugin_name))
-                    modules.append(__import__(plugin_name))
-                except Exception, e:
-                    self.log.warn('Failed to import task {0}'.format(
-                        plugin_name))
-                    self.log.exception(e)
-        self.log.debug('Active modules {0}'.format(modules))
-        # TODO load plugins only as they are called?
-        return modules
-
-    def _run_task(self, module, record, taskrecord):
-        args = []
-        kwargs = {}
-        if 'args' in record:
-            args = record['args']
-        task = getattr(module, module.__name__).load(taskrecord)
-        self.log.info('Running task: {0}'.format(task.state.name))
         try:
-            task.state.data = task(*args, **kwargs)
-            if task.async:
-                task.state.status = 'RUNNING'
-            else:
-                task.state.status = 'SUCCESS'
-        except Exception, e:
-            self.log.error('task {0} failed'.format(task.state.name))
-            self.log.execption(e)
-            task.state.status = 'FAILED'
-            task.state.msg = str(e)
-        finally:
-            self.post_result(task)
+            self.conf = config.setup()
+        except error.ConfigError:
+            self.conf = None
+        if concurrency is None:
+            concurrency = self._option('concurrency', 1)
+        self.concurrency = int(concurrency)
+        if pool is None:
+            pool = self._option('pool', 'thread')
+        if pool not in ['thread', 'process']:
+            raise error.ConfigError('Unknown worker pool type {0}'.format(pool))
+        self.pool_type = pool
+        self.pool = None
+        # Finished tasks waiting to be posted and acknowledged
+        self.completed = Queue.Queue()
+        # Tasks whose results are waiting in the publisher's batch
+        self.unacked = []
+        self.batch_size = int(self._option('result_batch_size', 1))
+        self.batch_interval = float(self._option('result_batch_interval', 0))
+        # Wait for the broker to confirm it has each result
+        self.confirm = bool(int(self._option('publisher_confirms', 1)))
+        # Task types to take from queues of their own, '*' being any type
+        # nobody has a queue for (see hub.lib.routing)
+        self.task_types = [t.strip() for t in
+                           str(self._option('task_types', '*')).split(',')
+                           if t.strip()]
+        self.task_priorities = int(self._option('task_priorities', 0))
+        global loader, blobs
+        self.tasks_dir = tasks_dir
+        self.loader = loader = TaskLoader(
+            tasks_dir, self._option('reload_interval', 0))
+        self.blobs = blobs = blobstore.setup(self.conf)
+
+    def _option(self, key, default):
+        '''Read a [HUB] option from the config file, if there is one.'''
+        if self.conf is None:
+            return default
+        return self.conf.get('HUB', key, default)
+
+    def _start_pool(self):
+        '''
+        Start the pool tasks are run on when running more than one at once.
+        '''
+        if self.concurrency < 2:
+            return
+        self.log.info('Running up to {0} tasks at once in a {1} pool'.format(
+                      self.concurrency, self.pool_type))
+        if self.pool_type == 'process':
+            self.pool = multiprocessing.Pool(self.concurrency)
+        else:
+            self.pool = ThreadPool(self.concurrency)
 
     def start(self, broker):
         self.broker = broker
+        self.publisher = Publisher(self.broker, self.batch_size,
+                                   self.batch_interval, self.confirm)
         # Setup connection to broker and declare the work queue
         try:
             self.log.info('Starting worker, waiting for tasks...')
             self.conn = pika.BlockingConnection(pika.ConnectionParameters(
                                                 host=self.broker))
             self.channel = self.conn.channel()
-            self.channel.queue_declare(queue='hub_tasks')
-            self.channel.basic_consume(self.run,
-                                       queue='hub_tasks', no_ack=True)
+            routing.declare(self.channel, self.task_priorities)
+            # Hold no more tasks than we can run at once, plus those whose
+            # results are waiting to go out in a batch, between all the
+            # queues consumed
+            self.channel.basic_qos(
+                prefetch_count=self.concurrency + self.batch_size - 1,
+                all_channels=True)
+            for task_type in self.task_types:
+                if task_type == '*':
+                    queue = routing.CATCH_ALL
+                else:
+                    queue = routing.declare_task_queue(
+                        self.channel, task_type, self.task_priorities)
+                self.log.info('Taking tasks from {0}'.format(queue))
+                self.channel.basic_consume(self.run, queue=queue,
+                                           no_ack=False)
+            self._start_pool()
+            if self.pool is not None or self.batch_size > 1:
+                self.conn.add_timeout(self.poll_interval, self._poll)
             self.channel.start_consuming()
         except pika.exceptions.AMQPConnectionError, e:
             self.log.exception(e)
@@ -105,32 +348,105 @@ class Worker():
         instanciates and calls run method with task args
         '''
         self.log.info('Received task: {0}'.format(taskrecord))
-        record = json.loads(taskrecord)
-        for module in self.modules:
-            if module.__name__ == record['name']:
-                self._run_task(module, record, taskrecord)
-        for module in self.modules:
-            if module.__name__ == record['task_name'] and \
-                    module.__name__ != record['name']:
-                self._run_task(module, record, taskrecord)
-
-    def post_result(self, task):
-        '''Post task results into the results queue.'''
-        conn = pika.BlockingConnection(pika.ConnectionParameters(
-                                       host=self.broker))
-        channel = conn.channel()
+        content_type = properties.content_type
+        try:
+            record = serializer.get_codec(content_type).loads(taskrecord)
+        except Exception, e:
+            self.log.error('Dropping task which could not be decoded')
+            self.log.exception(e)
+            ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        # The task's own name if registered, otherwise its task_name
+        task_name = self.loader.find(record['name'], record['task_name'])
+        if task_name is None:
+            self.log.warn('No task module found for task {0}'.format(
+                          record['name']))
+            ch.basic_reject(delivery_tag=method.delivery_tag, requeue=False)
+            return
+        # Results go back in the encoding the task came in, to the queue
+        # the dispatcher asked for if it did
+        done = (method.delivery_tag, record.get('parent_id'), content_type,
+                properties.reply_to)
+        if self.pool is None:
+            result = run_task(task_name, taskrecord, content_type)
+            self._complete(result, *done)
+        else:
+            self.pool.apply_async(
+                run_task, (task_name, taskrecord, content_type),
+                callback=lambda result: self.completed.put((result,) + done))
+
+    def _poll(self):
+        '''
+        Post results of tasks finished by the pool and send batches of
+        results which have waited long enough. Runs on the connection
+        thread as pika connections can't be shared between threads.
+        '''
+        while True:
+            try:
+                completed = self.completed.get_nowait()
+            except Queue.Empty:
+                break
+            self._complete(*completed)
+        if self.publisher.due():
+            try:
+                self.publisher.flush()
+            except error.MessagingError, e:
+                self._requeue_unposted(e)
+            else:
+                self._ack_posted()
+        self.conn.add_timeout(self.poll_interval, self._poll)
+
+    def _complete(self, result, delivery_tag, parent_id, content_type,
+                  reply_to=None):
+        '''
+        Post a task's result, then acknowledge the task message once the
+        result has actually been sent
+        '''
+        self.unacked.append(delivery_tag)
+        try:
+            posted = self.post_result(result, parent_id, content_type,
+                                      reply_to)
+        except error.MessagingError, e:
+            self._requeue_unposted(e)
+            return
+        if posted:
+            self._ack_posted()
+
+    def _ack_posted(self):
+        for delivery_tag in self.unacked:
+            self.channel.basic_ack(delivery_tag=delivery_tag)
+        self.unacked = []
+
+    def _requeue_unposted(self, e):
+        '''
+        The broker didn't take the waiting results: drop them and put their
+        tasks back on the queue to be run again
+        '''
+        self.log.warn('Results not confirmed by the broker ({0}); '
+                      'requeueing {1} tasks'.format(e, len(self.unacked)))
+        self.publisher.discard()
+        for delivery_tag in self.unacked:
+            self.channel.basic_nack(delivery_tag=delivery_tag, requeue=True)
+        self.unacked = []
+
+    def post_result(self, result, parent_id, content_type=None,
+                    reply_to=None):
+        '''
+        Post a saved task into the results queue (reply_to if given).
+        Returns True once sent, False while held back in a batch.
+        '''
         self.log.debug('Sending task results for job {0} to dispatcher'.format(
-                       task.state.parent_id))
-        channel.basic_publish(exchange='',
-                              routing_key='hub_results',
-                              properties=pika.BasicProperties(
-                              correlation_id=str(task.state.parent_id),
-                              content_type='application/json',),
-                              body=task.save())
+                       parent_id))
+        if content_type is None:
+            content_type = serializer.JSON
+        return self.publisher.publish(reply_to or 'hub_results', result,
+                                      pika.BasicProperties(
+                                      correlation_id=str(parent_id),
+                                      content_type=content_type,))
 
 if __name__ == '__main__':
     '''
     Run worker directly by executing this module, passing the broker
     hostname/IP and the lib dir for the plugins as arguments.
     '''
-    Worker(sys.argv[1], sys.argv[2])
+    Worker(sys.argv[2]).start(sys.argv[1])
@@ -0,0 +1,323 @@
+#!/usr/bin/env python
+'''
+Message handling by the Dispatcher against an SQLite database and a
+stand-in channel, without a broker.
+
+Run from the repository root: python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import time
+import Queue
+import shutil
+import logging
+import tempfile
+import unittest
+
+import pika
+from pika.spec import Basic
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.dispatcher import Dispatcher, DEAD_LETTERS
+from hub.lib.resultstore import ResultCache
+from hub.lib.sharding import ShardMap
+import hub.lib.serializer as serializer
+
+logging.basicConfig(level=logging.CRITICAL)
+
+CONFIG = '''
+[HUB]
+caretaker_interval=0
+result_cache_size=0
+
+[DATABASE]
+type=HubSqlite
+host={0}
+port=0
+instance=0
+'''
+
+
+class Channel(object):
+    '''
+    Stands in for a BlockingChannel: keeps what is published, acked and
+    nacked. Publishing fails, as if the broker refused the message, while
+    refuse() says so.
+    '''
+    def __init__(self):
+        self.published = []
+        self.acked = []
+        self.nacked = []
+        self.refuse = lambda routing_key, body: False
+
+    def basic_publish(self, exchange, routing_key, properties, body):
+        if self.refuse(routing_key, body):
+            return False
+        self.published.append((routing_key, properties, body))
+        return True
+
+    def basic_ack(self, delivery_tag, multiple=False):
+        self.acked.append(delivery_tag)
+
+    def basic_nack(self, delivery_tag, requeue=True):
+        self.nacked.append((delivery_tag, requeue))
+
+    def tasks(self):
+        '''Records of the tasks published to workers so far.'''
+        return [json.loads(body) for routing_key, properties, body
+                in self.published if routing_key.startswith('task.')]
+
+    def sent(self, routing_key):
+        '''Bodies of the messages published to a queue so far.'''
+        return [body for key, properties, body in self.published
+                if key == routing_key]
+
+
+class Connection(object):
+    '''
+    Stands in for a BlockingConnection: keeps the calls other threads ask
+    it to run, for the test to run in their place.
+    '''
+    def __init__(self):
+        self.callbacks = Queue.Queue()
+
+    def add_callback_threadsafe(self, callback):
+        self.callbacks.put(callback)
+
+
+class Refusing(object):
+    '''
+    Stands in for a database pool, refusing to write the job with the
+    given id as a database with a constraint on it would.
+    '''
+    def __init__(self, pool, job_id):
+        self.pool = pool
+        self.job_id = job_id
+
+    def __getattr__(self, name):
+        return getattr(self.pool, name)
+
+    def call(self, method, *args, **kwargs):
+        if method in ('putjob', 'updatejob') and \
+                args[0].state.id == self.job_id:
+            raise ValueError('Job {0} refused'.format(self.job_id))
+        return self.pool.call(method, *args, **kwargs)
+
+
+class DispatcherTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        config_file = os.path.join(self.dir, 'dispatcher.conf')
+        with open(config_file, 'w') as f:
+            f.write(CONFIG.format(os.path.join(self.dir, 'hub.db')))
+        self.dispatcher = Dispatcher(config_file)
+        self.dispatcher.retry_interval = 0
+        self.channel = self.dispatcher.channel = Channel()
+        self.tag = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def deliver(self, callback, properties, body, redelivered=False):
+        self.tag += 1
+        method = Basic.Deliver(delivery_tag=self.tag, redelivered=redelivered)
+        self.dispatcher._locked(callback)(self.channel, method, properties,
+                                          body)
+        return self.tag
+
+    def submit(self, job, correlation_id='client'):
+        properties = pika.BasicProperties(correlation_id=correlation_id,
+                                          reply_to='replies')
+        return self.deliver(self.dispatcher.process_jobs, properties,
+                            json.dumps(job))
+
+    def result(self, task, status='SUCCESS', redelivered=False):
+        task = dict(task, status=status, data=task['name'])
+        properties = pika.BasicProperties(correlation_id=task['parent_id'])
+        return self.deliver(self.dispatcher.process_results, properties,
+                            json.dumps(task), redelivered)
+
+    def job(self, job_id):
+        self.dispatcher.writer.barrier()
+        return json.loads(self.dispatcher.pool.call('getjob', job_id))
+
+
+# A job of a single task
+JOB = {'id': 'j', 'name': 'j', 'output': ['_a.data'],
+       'tasks': [{'id': 'a', 'name': 'a', 'task_name': 'x'}]}
+
+
+class RedeliveryTest(DispatcherTest):
+
+    def test_result_redelivered_after_failed_submit(self):
+        self.submit(dict(JOB, tasks=JOB['tasks'] + [
+            {'id': 'b', 'name': 'b', 'task_name': 'x', 'depends': ['a']},
+            {'id': 'c', 'name': 'c', 'task_name': 'x', 'depends': ['a']}]))
+        [a] = self.channel.tasks()
+        # The broker takes b but not c
+        self.channel.refuse = lambda key, body: json.loads(body)['id'] == 'c'
+        tag = self.result(a)
+        self.assertEqual(self.channel.nacked, [(tag, True)])
+        self.channel.refuse = lambda key, body: False
+        self.result(a, redelivered=True)
+        sent = dict((t['id'], t) for t in self.channel.tasks())
+        self.assertEqual(sorted(sent), ['a', 'b', 'c'])
+        self.assertEqual(sent['c']['attempt'], 1)
+        for task_id in ('b', 'c'):
+            self.result(sent[task_id])
+        job = self.job('j')
+        self.assertEqual(job['status'], 'SUCCESS')
+        self.assertEqual([t['status'] for t in job['tasks']],
+                         ['SUCCESS'] * 3)
+
+    def test_submission_redelivered_after_failed_submit(self):
+        self.channel.refuse = lambda key, body: key.startswith('task.')
+        self.submit(JOB)
+        self.assertEqual(len(self.channel.nacked), 1)
+        self.channel.refuse = lambda key, body: False
+        properties = pika.BasicProperties(correlation_id='client',
+                                          reply_to='replies')
+        self.deliver(self.dispatcher.process_jobs, properties,
+                     json.dumps(JOB),
+                     redelivered=True)
+        [a] = self.channel.tasks()
+        self.assertEqual(a['attempt'], 1)
+        self.result(a)
+        self.assertEqual(self.job('j')['status'], 'SUCCESS')
+
+
+class WriteTest(DispatcherTest):
+
+    def test_taken_ids_are_rejected(self):
+        self.submit(JOB)
+        self.submit(dict(JOB, name='again'), 'other')
+        self.submit([dict(JOB, id='k'), dict(JOB, id='k')], 'bulk')
+        self.assertEqual(self.channel.sent('replies'), [
+            'j', 'Job ids already taken: j', 'Job ids already taken: k'])
+        self.assertEqual([properties.content_type for key, properties, body
+                          in self.channel.published if key == 'replies'],
+                         [None, serializer.TEXT, serializer.TEXT])
+        self.assertEqual(len(self.channel.tasks()), 1)
+        self.assertEqual(self.job('j')['name'], 'j')
+        self.dispatcher._ack()
+        self.assertEqual(self.channel.acked, [3])
+
+    def test_refused_write_is_set_aside(self):
+        self.submit(JOB)
+        # A task id is unique across jobs
+        self.submit(dict(JOB, id='k'), 'other')
+        self.assertEqual(len(self.channel.sent(DEAD_LETTERS)), 1)
+        self.assertEqual(self.channel.sent('replies'), ['j'])
+        [a] = self.channel.tasks()
+        self.result(a)
+        self.dispatcher._ack()
+        self.assertEqual(self.job('j')['status'], 'SUCCESS')
+        self.assertEqual(self.channel.acked, [3])
+        self.assertEqual(self.dispatcher.writer.stats()['refused'], 0)
+
+    def test_refused_update_is_set_aside(self):
+        self.submit(JOB)
+        self.submit(dict(JOB, id='k', tasks=[
+            {'id': 'b', 'name': 'a', 'task_name': 'x'}]), 'other')
+        self.dispatcher._ack()
+        writer = self.dispatcher.writer
+        writer.pool = Refusing(writer.pool, 'k')
+        a, b = self.channel.tasks()
+        self.result(a)
+        tag = self.result(b)
+        self.dispatcher._ack()
+        # The result for j is acknowledged, the one for k set aside
+        self.assertEqual(self.channel.acked, [2, 3, tag])
+        self.assertEqual(json.loads(self.channel.sent(DEAD_LETTERS)[0]),
+                         dict(b, status='SUCCESS', data='a'))
+        self.assertEqual(self.job('j')['status'], 'SUCCESS')
+        self.assertEqual(self.job('k')['tasks'][0]['status'], 'SUBMITTED')
+        self.assertEqual(self.dispatcher._unacked, [])
+
+
+class StatusTest(DispatcherTest):
+
+    def get(self, request):
+        properties = pika.BasicProperties(correlation_id='status',
+                                          reply_to='replies')
+        self.deliver(self.dispatcher.get_job, properties, json.dumps(request))
+        key, properties, body = self.channel.published[-1]
+        return properties.content_type, body
+
+    def test_errors_are_plain_text(self):
+        self.submit(JOB)
+        content_type, body = self.get('j')
+        self.assertEqual(content_type, serializer.JSON)
+        self.assertEqual(json.loads(body)['id'], 'j')
+        self.assertEqual(self.get('k'), (serializer.TEXT, 'Job k not found'))
+        content_type, body = self.get({'limit': 'x'})
+        self.assertEqual(content_type, serializer.TEXT)
+
+
+class TimeoutTest(DispatcherTest):
+
+    def test_timeouts_are_handled_on_the_connection_thread(self):
+        conn = self.dispatcher.conn = Connection()
+        self.dispatcher.scheduler.start()
+        self.submit(dict(JOB, tasks=[dict(JOB['tasks'][0], timeout=0.01,
+                                          retries=1, backoff=0)]))
+        # The timeout, then the retry, are only run when the connection
+        # thread gets round to them
+        conn.callbacks.get(timeout=5)()
+        self.assertEqual(len(self.channel.tasks()), 1)
+        self.assertEqual(self.job('j')['tasks'][0]['status'], 'RETRYING')
+        conn.callbacks.get(timeout=5)()
+        self.assertEqual([t['attempt'] for t in self.channel.tasks()],
+                         [1, 2])
+
+
+class ResultCacheTest(DispatcherTest):
+
+    def test_long_chain_of_cached_results(self):
+        results = self.dispatcher.results = ResultCache(self.dispatcher.pool)
+        tasks = [{'id': 't0', 'name': 't0', 'task_name': 'x', 'args': [0]}]
+        for i in range(1, 2000):
+            results.put('x', [i], i)
+            tasks.append({'id': 't%d' % i, 'name': 't%d' % i,
+                          'task_name': 'x', 'args': [i],
+                          'depends': ['t%d' % (i - 1)]})
+        self.submit({'id': 'j', 'name': 'j', 'output': ['_t0.data'],
+                     'tasks': tasks})
+        [t0] = self.channel.tasks()
+        # Workers say which tasks' results may be cached
+        self.result(dict(t0, cache_ttl=60))
+        self.assertEqual(self.job('j')['status'], 'SUCCESS')
+        self.assertEqual(len(self.channel.tasks()), 1)
+
+
+class ShardTest(DispatcherTest):
+
+    def hold(self, *shards):
+        self.dispatcher.shards.held = set(shards)
+        self.dispatcher.shards.expires = dict.fromkeys(shards,
+                                                       time.time() + 60)
+
+    def test_bulk_jobs_of_other_shards_are_registered_before_the_reply(self):
+        # Job j is in shard 1, held here, and job l in shard 0
+        self.dispatcher.shards = ShardMap(self.dispatcher.pool, 2)
+        self.hold(1)
+        other = dict(JOB, id='l', tasks=[dict(JOB['tasks'][0], id='b')])
+        self.submit([JOB, other], 'bulk')
+        self.assertEqual(self.channel.sent('replies'), ['["j", "l"]'])
+        self.assertEqual(self.job('l')['status'], 'PENDING')
+        [(key, properties, body)] = [m for m in self.channel.published
+                                     if m[0].startswith('hub_jobs')]
+        self.assertEqual(key, 'hub_jobs.0')
+        self.assertEqual(properties.headers, {'redelivered': True})
+        self.assertEqual([t['id'] for t in self.channel.tasks()], ['a'])
+        # The holder of shard 0 carries on with l from the database
+        self.hold(0)
+        self.deliver(self.dispatcher.process_jobs, properties, body)
+        self.assertEqual([t['id'] for t in self.channel.tasks()], ['a', 'b'])
+        self.assertEqual(self.channel.sent('replies'), ['["j", "l"]'])
+
+
+if __name__ == '__main__':
+    unittest.main()
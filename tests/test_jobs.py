@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+'''
+Snapshots of jobs taken for the JobWriter: only what changed is copied,
+and snapshots of the same job merge without losing changes.
+
+Run from the repository root: python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.jobs import Job, JobSnapshot
+
+
+def make_job(tasks=5):
+    return Job().load(json.dumps({
+        'id': 'j', 'name': 'job',
+        'tasks': [{'id': 't%d' % i, 'name': 't%d' % i} for i in range(tasks)]}))
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def test_only_changed_tasks_are_copied(self):
+        job = make_job()
+        job.state.tasks[3].state.status = 'SUBMITTED'
+        snapshot = JobSnapshot(job)
+        job.mark_clean()
+        job.state.tasks[3].state.status = 'SUCCESS'
+        [task] = snapshot.dirty_tasks()
+        self.assertEqual((task.state.id, task.state.status),
+                         ('t3', 'SUBMITTED'))
+        self.assertEqual(snapshot.state.tasks, None)
+        self.assertEqual(list(snapshot.task_ids()),
+                         ['t0', 't1', 't2', 't3', 't4'])
+
+    def test_full_snapshot_copies_every_task(self):
+        job = make_job()
+        snapshot = JobSnapshot(job, full=True)
+        job.state.tasks[0].state.status = 'SUBMITTED'
+        self.assertEqual([t.state.status for t in snapshot.state.tasks],
+                         ['PENDING'] * 5)
+        self.assertEqual(len(snapshot.dirty_tasks()), 5)
+
+    def test_merge_keeps_older_changes(self):
+        job = make_job()
+        job.state.tasks[0].state.status = 'SUBMITTED'
+        older = JobSnapshot(job)
+        job.mark_clean()
+        job.state.tasks[0].state.attempt = 1
+        job.state.tasks[1].state.status = 'SUBMITTED'
+        job.state.status = 'RUNNING'
+        newer = JobSnapshot(job).merge(older)
+        tasks = dict((t.state.id, t) for t in newer.dirty_tasks())
+        self.assertEqual(sorted(tasks), ['t0', 't1'])
+        self.assertEqual(tasks['t0'].state.get_dirty(),
+                         set(['status', 'attempt']))
+        self.assertEqual(newer.state.get_dirty(), set(['status']))
+
+    def test_merge_into_full_stays_full(self):
+        job = make_job()
+        older = JobSnapshot(job, full=True)
+        job.state.tasks[2].state.status = 'SUBMITTED'
+        newer = JobSnapshot(job).merge(older)
+        self.assertTrue(newer.full)
+        self.assertEqual([t.state.status for t in newer.state.tasks],
+                         ['PENDING', 'PENDING', 'SUBMITTED', 'PENDING',
+                          'PENDING'])
+
+
+if __name__ == '__main__':
+    unittest.main()
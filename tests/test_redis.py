@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+'''
+Round trips made by HubRedis job writes: a job, however many tasks it
+has, is written by one pipelined MULTI/EXEC, and reads back the same.
+Runs against fakeredis, which speaks the Redis protocol in memory, and
+is skipped without it.
+
+Run from the repository root: python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import unittest
+
+try:
+    import fakeredis
+    import redis
+except ImportError:
+    fakeredis = None
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.database import HubRedis
+from hub.lib.jobs import Job
+
+if fakeredis is not None:
+    class CountingConnection(fakeredis.FakeConnection):
+        '''
+        Counts round trips: redis-py sends each command on its own, and
+        each pipeline, with one send.
+        '''
+        sends = 0
+
+        def send_packed_command(self, command, check_health=True):
+            CountingConnection.sends += 1
+            return super(CountingConnection, self).send_packed_command(
+                command, check_health)
+
+
+def make_job(tasks=50):
+    record = {'id': 'j', 'name': 'job',
+              'tasks': [{'id': 't0', 'name': 't0', 'timeout': 30}]}
+    record['tasks'] += [{'id': 't%d' % i, 'name': 't%d' % i,
+                         'depends': ['t0']} for i in range(1, tasks)]
+    return Job().load(json.dumps(record))
+
+
+@unittest.skipIf(fakeredis is None, 'fakeredis is not installed')
+class WriteJobTest(unittest.TestCase):
+
+    def setUp(self):
+        self.db = HubRedis('localhost', 6379, 0)
+        self.db.db = redis.StrictRedis(connection_pool=redis.ConnectionPool(
+            connection_class=CountingConnection,
+            server=fakeredis.FakeServer()))
+        CountingConnection.sends = 0
+
+    def round_trips(self, method, *args):
+        before = CountingConnection.sends
+        method(*args)
+        return CountingConnection.sends - before
+
+    def stored(self, job_id):
+        return json.loads(self.db.getjob(job_id))
+
+    def test_putjob_is_one_round_trip(self):
+        job = make_job()
+        self.assertEqual(self.round_trips(self.db.putjob, job), 1)
+        record = self.stored('j')
+        self.assertEqual(record['name'], 'job')
+        self.assertEqual([t['id'] for t in record['tasks']],
+                         ['t%d' % i for i in range(50)])
+        self.assertEqual(self.db.db.smembers('INCOMPLETE'), set())
+        self.assertEqual(self.db.db.zscore('JOBS', 'j'),
+                         job.state.start_time)
+
+    def test_updatejob_is_one_round_trip(self):
+        job = make_job()
+        self.db.putjob(job)
+        job.mark_clean()
+        [task] = job.get_next_tasks_to_run()
+        task.state.status = 'SUBMITTED'
+        task.state.start_time = 1.0
+        job.state.status = 'RUNNING'
+        self.assertEqual(self.round_trips(self.db.updatejob, job), 1)
+        record = self.stored('j')
+        self.assertEqual(record['status'], 'RUNNING')
+        self.assertEqual(
+            [(t['id'], t['status']) for t in record['tasks'][:2]],
+            [('t0', 'SUBMITTED'), ('t1', 'PENDING')])
+        self.assertEqual(self.db.db.smembers('INCOMPLETE'), set(['t0']))
+        self.assertEqual(self.db.db.zscore('DEADLINES', 't0'), 31.0)
+
+    def test_unchanged_job_writes_nothing(self):
+        job = make_job()
+        self.db.putjob(job)
+        job.mark_clean()
+        before = self.db.db.hgetall('t0')
+        # An empty pipeline isn't sent at all
+        self.assertEqual(self.round_trips(self.db.updatejob, job), 0)
+        self.assertEqual(self.db.db.hgetall('t0'), before)
+        self.assertEqual(len(self.stored('j')['tasks']), 50)
+
+    def test_getjob_is_two_round_trips(self):
+        self.db.putjob(make_job())
+        self.assertEqual(self.round_trips(self.db.getjob, 'j'), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+'''
+Results cached by ResultCache are only served for the version of a task
+which made them, and not at all once the task stops asking for caching.
+Looking a result up doesn't write to the database.
+
+Run from the repository root: python -m unittest discover tests
+'''
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.database import HubSqlite, HubDatabasePool
+from hub.lib.resultstore import ResultCache
+
+
+class Recording(object):
+    '''Stands in for a database pool, keeping the methods called.'''
+    def __init__(self, pool):
+        self.pool = pool
+        self.calls = []
+
+    def call(self, method, *args, **kwargs):
+        self.calls.append(method)
+        return self.pool.call(method, *args, **kwargs)
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hub.db')
+        self.pool = HubDatabasePool(HubSqlite, self.path, None, None, size=1)
+        self.results = ResultCache(self.pool)
+
+    def tearDown(self):
+        self.pool.close()
+        shutil.rmtree(self.dir)
+
+    def test_hit(self):
+        self.results.put('mul', [2, 3], 6, 60, 'tasks:1')
+        self.assertEqual(self.results.get('mul', [2, 3]), [6])
+        self.assertEqual(self.results.get('mul', [2, 4]), None)
+
+    def test_new_version_misses(self):
+        self.results.put('mul', [2, 3], 6, 60, 'tasks:1')
+        self.results.put('mul', [2, 4], 8, 60, 'tasks:2')
+        self.assertEqual(self.results.get('mul', [2, 3]), None)
+        self.assertEqual(self.results.get('mul', [2, 4]), [8])
+
+    def test_forget(self):
+        self.results.put('mul', [2, 3], 6, 60, 'tasks:1')
+        self.results.forget('mul')
+        self.assertEqual(self.results.get('mul', [2, 3]), None)
+        # Not looked up again after a restart either
+        restarted = ResultCache(self.pool)
+        restarted.load()
+        self.assertEqual(restarted.versions, {})
+
+    def test_version_survives_restart(self):
+        self.results.put('mul', [2, 3], 6, 60, 'tasks:1')
+        restarted = ResultCache(self.pool)
+        restarted.load()
+        self.assertEqual(restarted.get('mul', [2, 3]), [6])
+
+    def test_use_is_recorded_when_trimming(self):
+        pool = Recording(self.pool)
+        results = ResultCache(pool, max_entries=20)
+        results.put('mul', [2, 3], 6, 60, 'tasks:1')
+        for i in range(3):
+            self.assertEqual(results.get('mul', [2, 3]), [6])
+        self.assertEqual(pool.calls, ['putresult'] + ['getresult'] * 3)
+        # Every other store trims the cache
+        results.put('mul', [2, 4], 8, 60, 'tasks:1')
+        self.assertEqual(pool.calls[-3:],
+                         ['putresult', 'touchresults', 'trimresults'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python
+'''
+HubSqlite's schema: tables from before the schema was managed, holding
+a column of JSON per field, are brought into it with their jobs intact.
+
+Run from the repository root: python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from hub.lib.database import HubSqlite
+from hub.lib.error import DatabaseError
+
+# Tables as they were written before the schema was managed
+OLD_SCHEMA = (
+    "CREATE TABLE hub_jobs (id, name, status, start_time, output)",
+    "CREATE TABLE hub_tasks (id, parent_id, name, task_name, status, "
+    "start_time, timeout, args)",
+)
+
+
+class SchemaTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'hub.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def old_database(self, version=0):
+        conn = sqlite3.connect(self.path)
+        for statement in OLD_SCHEMA:
+            conn.execute(statement)
+        job = {'id': 'j', 'name': 'job', 'status': 'RUNNING',
+               'start_time': 1.0, 'output': ['_a.data']}
+        tasks = [{'id': 'a', 'parent_id': 'j', 'name': 'a', 'task_name': 'x',
+                  'status': 'SUBMITTED', 'start_time': 1.0, 'timeout': 30,
+                  'args': [1, 2]},
+                 {'id': 'b', 'parent_id': 'j', 'name': 'b', 'task_name': 'x',
+                  'status': 'PENDING'}]
+        for table, record in [('hub_jobs', job)] + \
+                [('hub_tasks', task) for task in tasks]:
+            conn.execute('INSERT INTO {0} ({1}) VALUES ({2})'.format(
+                table, ', '.join(record), ', '.join('?' * len(record))),
+                [json.dumps(v) for v in record.values()])
+        conn.execute('PRAGMA user_version={0}'.format(version))
+        conn.commit()
+        conn.close()
+        return job, tasks
+
+    def test_old_tables_are_migrated(self):
+        job, tasks = self.old_database()
+        db = HubSqlite(self.path, None, None)
+        record = json.loads(db.getjob('j'))
+        self.assertEqual(record.pop('tasks'), tasks)
+        self.assertEqual(record, job)
+        self.assertEqual(db.getjobid('b'), 'j')
+        self.assertEqual(db.gettaskdeadlines(), [('a', 'j', 31.0)])
+        self.assertEqual(db.findjobs(['j', 'k']), ['j'])
+        db.close()
+        # And opened as it is from then on
+        db = HubSqlite(self.path, None, None)
+        self.assertEqual(json.loads(db.getjob('j'))['name'], 'job')
+        db.close()
+
+    def test_unknown_version_is_refused(self):
+        self.old_database(version=2)
+        self.assertRaises(DatabaseError, HubSqlite, self.path, None, None)
+
+
+if __name__ == '__main__':
+    unittest.main()
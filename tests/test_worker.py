@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+'''
+Tasks run by the worker's pool: runs of the same task in different
+threads each have a state of their own, whether or not the task was
+declared with @task.
+
+Run from the repository root: python -m unittest discover tests
+'''
+import os
+import sys
+import json
+import time
+import unittest
+from multiprocessing.pool import ThreadPool
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+import hub.lib.api as api
+from hub.lib.tasks import Task
+from hub.lib.worker import run_task
+
+
+class Echo(Task):
+    '''A task written as a class, answering with its own task id.'''
+    name = 'echo'
+
+    def __call__(self):
+        task_id = self.state.id
+        # Give the other runs time to start
+        time.sleep(0.05)
+        return [task_id, self.state.id]
+
+
+class RunTaskTest(unittest.TestCase):
+
+    def setUp(self):
+        api.register(Echo())
+
+    def tearDown(self):
+        api.registry.pop('echo', None)
+
+    def test_concurrent_runs_have_their_own_state(self):
+        records = [json.dumps({'id': 't%d' % i, 'name': 'echo'})
+                   for i in range(8)]
+        pool = ThreadPool(8)
+        try:
+            results = pool.map(lambda record: json.loads(
+                run_task('echo', record)), records)
+        finally:
+            pool.close()
+        self.assertEqual([r['status'] for r in results], ['SUCCESS'] * 8)
+        self.assertEqual([r['data'] for r in results],
+                         [['t%d' % i] * 2 for i in range(8)])
+        # The registered task is left as it was
+        self.assertEqual(api.registry['echo'].state.name, None)
+
+
+if __name__ == '__main__':
+    unittest.main()